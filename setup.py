@@ -11,7 +11,7 @@ setup(name='wisegcn',
       license='LICENSE.txt',
       packages=setuptools.find_packages(),
       install_requires=['pygcn', 'healpy', 'configparser', 'astropy', 'pymysql', 'voevent-parse', 'numpy', 'scipy',
-                        'requests', 'lxml', 'ccdproc'],
+                        'requests', 'lxml'],
       classifiers=[
           'Development Status :: 4 - Beta',
           'Environment :: Console',
@@ -21,5 +21,6 @@ setup(name='wisegcn',
           'Topic :: Scientific/Engineering :: Astronomy',
           'Topic :: Text Processing :: Markup :: XML'
       ],
-      scripts=['bin/wisegcn-listen', 'bin/wisegcn-ingest']
+      scripts=['bin/wisegcn-listen', 'bin/wisegcn-ingest', 'bin/wisegcn-rules', 'bin/wisegcn-catalog',
+               'bin/wisegcn-coverage']
       )
@@ -1,10 +1,25 @@
+from . import catalog
+from . import coverage
 from . import email_alert
 from . import galaxy_list
 from . import handler
+from . import journal
+from . import listener
+from . import logger
+from . import luminosity_function
 from . import magnitudes
+from . import metrics
 from . import mysql_update
 from . import observing_tools
+from . import plan_output
+from . import rules
+from . import skymap
+from . import skymap_cache
+from . import skymap_summary
 from . import tile
 from . import treasuremap
+from . import upload
 from . import utils
+from . import voevent
 from . import wise
+from . import workers
@@ -0,0 +1,359 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import itertools
+import datetime
+import numpy as np
+import healpy as hp
+from configparser import ConfigParser
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+# compact catalog layout (see build_catalog)
+CATALOG_DTYPE = np.dtype([("id", "<i8"), ("ra", "<f4"), ("dec", "<f4"), ("dist", "<f4"), ("bmag", "<f4")])
+COLUMNS = CATALOG_DTYPE.names
+
+# source columns of the GladeID, RA, Dec, distance and Bmag in the GLADE 2.3 text catalog (0-based)
+GLADE_COLUMNS = (0, 7, 8, 9, 12)
+
+# the compact catalog is sorted by NESTED HEALPix pixel at SORT_NSIDE; it is built in BUCKET_NSIDE pixel buckets
+SORT_NSIDE = 1024
+BUCKET_NSIDE = 4
+
+# catalogs and ID indices already loaded by this process (shared copy-on-write with forked workers)
+_catalogs = {}
+_id_indices = {}
+
+
+def get_catalog_path():
+    """Returns the path to the galaxy catalog .npy file defined in config.ini"""
+    return config.get('CATALOG', 'PATH') + config.get('CATALOG', 'NAME') + '.npy'
+
+
+def load_catalog(cat_file=None, mmap_mode='r'):
+    """
+    Returns the galaxy catalog (glade_id, RA, DEC, distance, Bmag).
+    The catalog is memory-mapped and loaded only once per process.
+
+    :param cat_file: path to the catalog .npy file (default: taken from config.ini)
+    :param mmap_mode: numpy memory-map mode, use None to read the entire catalog into memory
+    :return: catalog array
+    """
+    if cat_file is None:
+        cat_file = get_catalog_path()
+
+    if cat_file not in _catalogs:
+        _catalogs[cat_file] = np.load(cat_file, mmap_mode=mmap_mode)
+
+    return _catalogs[cat_file]
+
+
+def column(galaxy_cat, name):
+    """
+    Returns a catalog column of either catalog layout: the compact structured catalog (see build_catalog), or the
+    legacy (N, 5) float64 array.
+
+    :param galaxy_cat: galaxy catalog (or rows of it)
+    :param name: id, ra, dec, dist or bmag
+    :return: column (float64, except for the id of the compact catalog, which is int64)
+    """
+    if galaxy_cat.dtype.names is None:
+        return galaxy_cat[:, COLUMNS.index(name)]
+    if name == "id":
+        return galaxy_cat[name]
+    return galaxy_cat[name].astype(np.float64)
+
+
+def as_rows(galaxy_cat):
+    """Returns catalog rows of either layout as a (N, 5) float64 array (glade_id, RA, DEC, distance, Bmag)"""
+    if galaxy_cat.dtype.names is None:
+        return galaxy_cat
+    return np.column_stack([galaxy_cat[name].astype(np.float64) for name in COLUMNS])
+
+
+def get_id_index_path(cat_file=None):
+    """Returns the path to the GladeID index file, stored next to the catalog"""
+    if cat_file is None:
+        cat_file = get_catalog_path()
+    return cat_file[:-len('.npy')] + '_id_index.npy' if cat_file.endswith('.npy') else cat_file + '_id_index.npy'
+
+
+def build_id_index(cat_file=None):
+    """
+    Builds the persistent GladeID index of the catalog, and saves it next to the catalog.
+    The index is a (2, N) int64 array of the sorted GladeIDs and their catalog rows.
+
+    :param cat_file: path to the catalog .npy file (default: taken from config.ini)
+    :return: path to the index file
+    """
+    if cat_file is None:
+        cat_file = get_catalog_path()
+    galaxy_cat = load_catalog(cat_file)
+    index_file = get_id_index_path(cat_file)
+    glade_ids = column(galaxy_cat, "id")
+    sorter = np.argsort(glade_ids, kind="stable")
+    np.save(index_file, np.vstack((glade_ids[sorter].astype(np.int64), sorter)))
+    _id_indices.pop(cat_file, None)
+    return index_file
+
+
+def load_id_index(cat_file=None):
+    """Returns the (memory-mapped) GladeID index of the catalog, building it if it doesn't exist or is outdated"""
+    if cat_file is None:
+        cat_file = get_catalog_path()
+
+    if cat_file not in _id_indices:
+        index_file = get_id_index_path(cat_file)
+        if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(cat_file):
+            build_id_index(cat_file)
+        _id_indices[cat_file] = np.load(index_file, mmap_mode='r')
+
+    return _id_indices[cat_file]
+
+
+def find_rows(glade_ids, cat_file=None):
+    """
+    Returns the catalog row indices of GladeIDs.
+
+    :param glade_ids: GladeID or array of GladeIDs
+    :param cat_file: path to the catalog .npy file (default: taken from config.ini)
+    :return: row indices (-1 for GladeIDs not in the catalog)
+    """
+    sorted_ids, sorted_rows = load_id_index(cat_file)
+    glade_ids = np.atleast_1d(glade_ids)
+    pos = np.clip(np.searchsorted(sorted_ids, glade_ids), 0, len(sorted_ids) - 1)
+    rows = np.array(sorted_rows[pos])
+    rows[sorted_ids[pos] != glade_ids] = -1
+    return rows
+
+
+def get_manifest_path(cat_file=None):
+    """Returns the path to the catalog manifest, stored next to the catalog"""
+    if cat_file is None:
+        cat_file = get_catalog_path()
+    return cat_file[:-len('.npy')] + '_manifest.json' if cat_file.endswith('.npy') else cat_file + '_manifest.json'
+
+
+def load_manifest(cat_file=None):
+    """Returns the catalog manifest (see build_catalog), or None if there is none"""
+    try:
+        with open(get_manifest_path(cat_file)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def file_checksum(filename, blocksize=1 << 24):
+    """SHA-256 of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source_info(source, columns):
+    stat = os.stat(source)
+    return {"path": os.path.abspath(source), "size": stat.st_size, "mtime": stat.st_mtime,
+            "columns": list(columns) if columns is not None else None}
+
+
+def read_source(source, columns=None, chunksize=1000000, delimiter=None):
+    """
+    Streams a source catalog in chunks: a text file, an HDF5 file (requires h5py), or a catalog .npy file (legacy
+    (N, 5) float64, or compact).
+
+    :param source: path to the source catalog
+    :param columns: source columns of the GladeID, RA, Dec, distance [Mpc] and Bmag: 0-based column numbers of a text
+                    file (default: GLADE_COLUMNS), or dataset paths of an HDF5 file
+    :param chunksize: number of rows per chunk
+    :param delimiter: text column delimiter (default: whitespace)
+    :return: generator of (n, 5) float64 arrays (missing values are nan)
+    """
+    if source.endswith('.npy'):
+        cat = np.load(source, mmap_mode='r')
+        for start in range(0, len(cat), chunksize):
+            yield as_rows(np.array(cat[start:start + chunksize]))
+    elif source.endswith(('.h5', '.hdf5')):
+        if h5py is None:
+            raise ImportError("Reading HDF5 catalogs requires h5py (pip install h5py).")
+        if columns is None:
+            raise ValueError("The HDF5 dataset of every column must be given.")
+        with h5py.File(source, "r") as f:
+            datasets = [f[name] for name in columns]
+            for start in range(0, len(datasets[0]), chunksize):
+                yield np.column_stack([np.asarray(d[start:start + chunksize], dtype=np.float64) for d in datasets])
+    else:
+        if columns is None:
+            columns = GLADE_COLUMNS
+        with open(source) as f:
+            while True:
+                lines = list(itertools.islice(f, chunksize))
+                if not lines:
+                    break
+                yield np.atleast_2d(np.genfromtxt(lines, usecols=columns, delimiter=delimiter, dtype=np.float64,
+                                                  missing_values="null", filling_values=np.nan,
+                                                  invalid_raise=False))
+
+
+def _compact(chunk):
+    """Applies the cuts find_galaxy_list applies (a positive distance and a B magnitude), and converts the rows to
+    the compact dtype"""
+    good = (chunk[:, 3] > 0) & ~np.isnan(chunk[:, 4]) & np.isfinite(chunk[:, 0]) & np.isfinite(chunk[:, 1]) & \
+        np.isfinite(chunk[:, 2])
+    chunk = chunk[good]
+    rows = np.empty(len(chunk), dtype=CATALOG_DTYPE)
+    for i, name in enumerate(COLUMNS):
+        rows[name] = chunk[:, i]
+    return rows
+
+
+def _sort_pixels(rows):
+    return hp.ang2pix(SORT_NSIDE, np.deg2rad(90 - rows["dec"].astype(np.float64)),
+                      np.deg2rad(rows["ra"].astype(np.float64)), nest=True)
+
+
+def _write_catalog(chunks, cat_file, sources, log):
+    """Writes the compact, HEALPix-sorted catalog from a stream of compact row chunks, in bounded memory: the rows are
+    first spread into coarse pixel bucket files, then every bucket is sorted and appended to the catalog"""
+    n_buckets = hp.nside2npix(BUCKET_NSIDE)
+    shift = 2 * (int(np.log2(SORT_NSIDE)) - int(np.log2(BUCKET_NSIDE)))
+    counts = np.zeros(n_buckets, dtype=np.int64)
+
+    tmp_dir = tempfile.mkdtemp(prefix="wisegcn-catalog-", dir=os.path.dirname(os.path.abspath(cat_file)))
+    try:
+        bucket_files = {}
+        n_read = 0
+        for rows in chunks:
+            bucket = _sort_pixels(rows) >> shift
+            order = np.argsort(bucket, kind="stable")
+            bucket, rows = bucket[order], rows[order]
+            starts = np.flatnonzero(np.diff(bucket, prepend=-1))
+            for start, stop in zip(starts, np.append(starts[1:], len(bucket))):
+                b = int(bucket[start])
+                if b not in bucket_files:
+                    bucket_files[b] = open(os.path.join(tmp_dir, f"{b}.bin"), "wb")
+                bucket_files[b].write(rows[start:stop].tobytes())
+                counts[b] += stop - start
+            n_read += len(rows)
+            log.info(f"Read {n_read} galaxies...")
+        for f in bucket_files.values():
+            f.close()
+
+        tmp_file = os.path.join(tmp_dir, "catalog.npy")
+        out = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=CATALOG_DTYPE, shape=(int(counts.sum()),))
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        for b in np.flatnonzero(counts):
+            rows = np.fromfile(os.path.join(tmp_dir, f"{b}.bin"), dtype=CATALOG_DTYPE)
+            out[offsets[b]:offsets[b + 1]] = rows[np.lexsort((rows["id"], _sort_pixels(rows)))]
+        out.flush()
+        del out
+
+        manifest = {"rows": int(counts.sum()),
+                    "dtype": np.lib.format.dtype_to_descr(CATALOG_DTYPE),
+                    "order": "nested",
+                    "nside": SORT_NSIDE,
+                    "bucket_nside": BUCKET_NSIDE,
+                    "bucket_offsets": offsets.tolist(),
+                    "filters": "dist > 0, Bmag not nan",
+                    "sources": sources,
+                    "sha256": file_checksum(tmp_file),
+                    "created": datetime.datetime.utcnow().isoformat()}
+        os.replace(tmp_file, cat_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with open(get_manifest_path(cat_file), "w") as f:
+        json.dump(manifest, f, indent=1)
+    _catalogs.pop(cat_file, None)
+    _id_indices.pop(cat_file, None)
+    log.info(f"Wrote {manifest['rows']} galaxies to {cat_file}.")
+
+    # rebuild the files derived from the catalog now, rather than on the first alert
+    from wisegcn.luminosity_function import build_completeness_table
+    log.info(f"Wrote the GladeID index to {build_id_index(cat_file)}.")
+    log.info(f"Wrote the completeness table to {build_completeness_table(cat_file)}.")
+    return manifest
+
+
+def build_catalog(source, cat_file=None, columns=None, chunksize=1000000, delimiter=None, force=False, log=None):
+    """
+    Builds the compact galaxy catalog from a source catalog, streamed in chunks (bounded memory): the galaxies that
+    pass the find_galaxy_list cuts, with an int64 GladeID and float32 coordinates, distance and Bmag (CATALOG_DTYPE),
+    sorted by NESTED HEALPix pixel, for memory-mapping. A manifest (with the file's SHA-256), the GladeID index (see
+    build_id_index) and the completeness table (see luminosity_function.build_completeness_table) are written next to
+    it.
+
+    :param source: path to the source catalog (see read_source)
+    :param cat_file: path to the catalog .npy file (default: taken from config.ini)
+    :param columns: source columns (see read_source)
+    :param chunksize: number of rows per chunk
+    :param delimiter: text column delimiter (default: whitespace)
+    :param force: rebuild even if the catalog is up to date with the source
+    :param log: logger
+    :return: manifest
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+    if cat_file is None:
+        cat_file = get_catalog_path()
+
+    sources = [_source_info(source, columns)]
+    manifest = load_manifest(cat_file)
+    if not force and os.path.exists(cat_file) and manifest is not None and manifest["sources"] == sources:
+        log.info(f"{cat_file} is up to date with {source}.")
+        return manifest
+
+    chunks = (_compact(chunk) for chunk in read_source(source, columns, chunksize, delimiter))
+    return _write_catalog(chunks, cat_file, sources, log)
+
+
+def update_catalog(source, cat_file=None, columns=None, chunksize=1000000, delimiter=None, log=None):
+    """
+    Updates the compact catalog incrementally from a source of new or corrected galaxies: they replace the catalog
+    galaxies with the same GladeIDs (or remove them, if they don't pass the cuts), and the rest are kept.
+    The update is read into memory, the catalog is streamed. The GladeID index and the completeness table are rebuilt.
+
+    :param source: path to the update catalog (see read_source)
+    :param cat_file: path to the catalog .npy file (default: taken from config.ini)
+    :param columns: update source columns (see read_source)
+    :param chunksize: number of rows per chunk
+    :param delimiter: text column delimiter (default: whitespace)
+    :param log: logger
+    :return: manifest
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+    if cat_file is None:
+        cat_file = get_catalog_path()
+
+    update = [chunk for chunk in read_source(source, columns, chunksize, delimiter)]
+    update = np.concatenate(update) if update else np.empty((0, len(COLUMNS)))
+    replaced = update[:, 0]
+    log.info(f"Updating {len(update)} galaxies.")
+
+    def chunks():
+        for chunk in read_source(cat_file, chunksize=chunksize):
+            yield _compact(chunk[~np.isin(chunk[:, 0], replaced)])
+        yield _compact(update)
+
+    manifest = load_manifest(cat_file)
+    sources = (manifest["sources"] if manifest is not None else []) + [_source_info(source, columns)]
+    return _write_catalog(chunks(), cat_file, sources, log)
+
+
+def verify_catalog(cat_file=None):
+    """Checks the catalog file against the SHA-256 in its manifest"""
+    if cat_file is None:
+        cat_file = get_catalog_path()
+    manifest = load_manifest(cat_file)
+    return manifest is not None and file_checksum(cat_file) == manifest["sha256"]
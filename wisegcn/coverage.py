@@ -0,0 +1,193 @@
+import os
+import time
+import logging
+import healpy as hp
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+from configparser import ConfigParser
+from wisegcn.skymap import distance_cdf
+from wisegcn.skymap_cache import load_skymap
+from wisegcn.treasuremap import get_night_path, read_primary_header
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+# prefixes of the objects of the plan targets (see wise.process_galaxy_list and wise.process_tiles)
+TARGET_PREFIXES = ("GladeID", "Tile")
+
+
+def _get(option, default):
+    return config.get('COVERAGE', option) if config.has_option('COVERAGE', option) else default
+
+
+def get_max_distance():
+    """Distance [Mpc] up to which the brightest expected event is brighter than the sensitivity"""
+    brightest_mag = min(config.getfloat('GALAXIES', 'MINMAG'), config.getfloat('GALAXIES', 'MAXMAG'))
+    return 10 ** ((config.getfloat('GALAXIES', 'SENSITIVITY') - brightest_mag + 5) / 5) / 1e6
+
+
+def init_coverage(skymap_path, max_distance=None):
+    """
+    Starts tracking the probability covered by the night's frames.
+
+    :param skymap_path: path to skymap FITS file (read from the shared cache, if available)
+    :param max_distance: distance [Mpc] to which the frames are deep enough, for the 3D coverage (default: see
+                         get_max_distance)
+    :return: coverage state
+    """
+    if max_distance is None:
+        max_distance = get_max_distance()
+    skymap = load_skymap(skymap_path)
+    return {"skymap": skymap,
+            "nside": hp.npix2nside(len(skymap["prob"])),
+            "max_distance": max_distance,
+            "covered": np.zeros(len(skymap["prob"]), dtype=bool),
+            "seen": set(),
+            "frames": 0,
+            "prob_2d": 0.,
+            "prob_3d": 0.}
+
+
+def add_pointing(coverage, ra, dec, fov):
+    """
+    Adds the footprint of a frame to the coverage: only the newly covered pixels are accounted for.
+
+    :param coverage: coverage state (see init_coverage)
+    :param ra: pointing center RA [deg]
+    :param dec: pointing center Dec [deg]
+    :param fov: field of view [deg^2] (approximated by a disc of the same area)
+    :return: number of newly covered pixels
+    """
+    vec = hp.ang2vec(np.deg2rad(90 - dec), np.deg2rad(ra))
+    pix = hp.query_disc(coverage["nside"], vec, np.deg2rad(np.sqrt(fov / np.pi)))
+    pix = pix[~coverage["covered"][pix]]
+    coverage["covered"][pix] = True
+
+    skymap = coverage["skymap"]
+    prob = skymap["prob"][pix]
+    coverage["prob_2d"] += np.sum(prob)
+    good = np.isfinite(skymap["dist_mu"][pix]) & (skymap["dist_sigma"][pix] > 0)
+    coverage["prob_3d"] += np.sum(prob[good] * distance_cdf(coverage["max_distance"], skymap["dist_mu"][pix[good]],
+                                                            skymap["dist_sigma"][pix[good]]))
+    return len(pix)
+
+
+def update_coverage(coverage, date, telescopes, log=None):
+    """
+    Adds the frames that landed since the last update (only their primary headers are read).
+
+    :param coverage: coverage state (see init_coverage)
+    :param date: night date (YYYYMMDD)
+    :param telescopes: telescope names
+    :param log: logger
+    :return: number of new frames
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    settle = float(_get('SETTLE', '5'))
+    n_new = 0
+    for telescope in telescopes:
+        path = get_night_path(date, telescope)
+        if not os.path.isdir(path):
+            continue
+        for entry in os.scandir(path):
+            if entry.path in coverage["seen"] or not entry.name.lower().endswith((".fits", ".fit", ".fts")):
+                continue
+            if time.time() - entry.stat().st_mtime < settle:
+                # the frame may still be written, take it on the next update
+                continue
+            coverage["seen"].add(entry.path)
+            header = read_primary_header(entry.path)
+            if not (header["object"] or "").startswith(TARGET_PREFIXES) or not header["ra"] or not header["dec"]:
+                continue
+            coo = SkyCoord(ra=header["ra"], dec=header["dec"], unit=(u.hourangle, u.deg))
+            add_pointing(coverage, coo.ra.deg, coo.dec.deg, config.getfloat(telescope, 'FOV'))
+            coverage["frames"] += 1
+            n_new += 1
+
+    if n_new > 0:
+        log.info(f"{n_new} new frames, {coverage['frames']} in total: covered {100 * coverage['prob_2d']:.2f}% of "
+                 f"the 2D probability, {100 * coverage['prob_3d']:.2f}% of the 3D probability "
+                 f"(within {coverage['max_distance']:.0f} Mpc).")
+    return n_new
+
+
+def get_night_date(until):
+    """Returns the date (YYYYMMDD) of the night directories of the observing night ending at until (sunrise)"""
+    return (until - 1 * u.day).strftime("%Y%m%d")
+
+
+def rescore_galaxies(coverage, galaxies):
+    """
+    Re-scores the galaxies given the frames taken so far, and re-ranks them. A covered galaxy was observed deep enough
+    to detect the event with probability of its distance factor, so its score is scaled by 1 - distance factor (the
+    chance the event is there but was missed); the scores are then renormalized, so the uncovered galaxies gain the
+    probability the covered ones lost.
+
+    :param coverage: coverage state (see init_coverage)
+    :param galaxies: galaxy list (see galaxy_list.find_galaxy_list)
+    :return: galaxy list with the updated scores, in their new rank order (galaxies left with no score are dropped)
+    """
+    pix = hp.ang2pix(coverage["nside"], np.deg2rad(90 - galaxies[:, 2]), np.deg2rad(galaxies[:, 1]))
+    distance_factor = galaxies[:, 6]
+    score = galaxies[:, 5] * np.where(coverage["covered"][pix], 1 - distance_factor, 1)
+    total = np.sum(score)
+    if total > 0:
+        score = score / total
+
+    # rank as find_galaxy_list does: by the (updated) probability the galaxy hosts a detectable event
+    ranking_idx = np.argsort(score * distance_factor, kind="stable")[::-1]
+    ranking_idx = ranking_idx[score[ranking_idx] * distance_factor[ranking_idx] > 0]
+    rescored = galaxies[ranking_idx].copy()
+    rescored[:, 5] = score[ranking_idx]
+    return rescored
+
+
+def track_coverage(skymap_path, date, galaxies=None, alertname='GW', ra_event=None, dec_event=None, until=None,
+                   log=None):
+    """
+    Watches the night directories (polling), accumulates the covered probability as frames land, and periodically
+    pushes a refreshed plan of the galaxies, re-scored given the frames taken so far (see rescore_galaxies).
+
+    :param skymap_path: path to skymap FITS file
+    :param date: night date (YYYYMMDD, None - the night ending at until, see get_night_date)
+    :param galaxies: galaxy list (see galaxy_list.find_galaxy_list), None to only track the coverage
+    :param alertname: alert name
+    :param ra_event: event most probable RA (see galaxy_list.find_galaxy_list)
+    :param dec_event: event most probable Dec (see galaxy_list.find_galaxy_list)
+    :param until: stop tracking at this Time (default: next sunrise)
+    :param log: logger
+    :return: coverage state
+    """
+    from wisegcn import wise
+
+    if log is None:
+        log = logging.getLogger(__name__)
+    if until is None:
+        until = wise.get_observing_night(log)[1]
+    if date is None:
+        date = get_night_date(until)
+
+    interval = float(_get('INTERVAL', '60'))
+    rerank_interval = float(_get('RERANK_INTERVAL', '1800'))
+    telescopes = wise.get_telescopes()
+
+    coverage = init_coverage(skymap_path)
+    last_rerank = time.monotonic()
+    changed = False
+    while Time.now() < until:
+        changed |= update_coverage(coverage, date, telescopes, log) > 0
+
+        if galaxies is not None and changed and time.monotonic() - last_rerank >= rerank_interval:
+            rescored = rescore_galaxies(coverage, galaxies)
+            log.info(f"Pushing a refreshed plan of the {len(rescored)} re-scored galaxies.")
+            wise.process_galaxy_list(rescored, alertname=alertname, ra_event=ra_event, dec_event=dec_event, log=log)
+            last_rerank = time.monotonic()
+            changed = False
+
+        time.sleep(interval)
+
+    return coverage
@@ -5,11 +5,26 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import COMMASPACE, formatdate
 from configparser import ConfigParser
+from functools import lru_cache
+from wisegcn import metrics
+import threading
 import logging
+import atexit
+import queue
+import copy
+import time
+import os
 
 config = ConfigParser(inline_comment_prefixes=';')
 config.read("config.ini")
 
+_smtp = None  # reused SMTP session
+_smtp_server = None
+_smtp_lock = threading.RLock()
+_queue = None  # emails waiting for the background dispatcher
+_dispatcher = None
+_dispatcher_pid = None  # a forked worker starts its own dispatcher
+
 
 def send_mail(subject, text, html="",
               send_from=config.get('EMAIL', 'FROM'),
@@ -26,38 +41,169 @@ def send_mail(subject, text, html="",
     if log is None:
         log = logging.getLogger(__name__)
 
+    # encode the attachments now, the files may be overwritten before a queued email is delivered
+    attachments = {}
+    for f in files or []:
+        try:
+            attachments[f] = _attachment(f)
+        except OSError as e:
+            log.error("Failed to attach {} to email: {}".format(f, e))
+
+    mail = {"subject": subject, "text": text, "html": html, "send_from": send_from,
+            "send_to": list(send_to), "cc_to": list(cc_to), "bcc_to": list(bcc_to),
+            "attachments": attachments, "server": server, "log": log}
+
+    if config.getboolean('EMAIL', 'ASYNC') if config.has_option('EMAIL', 'ASYNC') else False:
+        # deliver in the background
+        _start_dispatcher()
+        _queue.put(mail)
+    else:
+        _deliver(mail)
+
+    return
+
+
+def _attachment(filename):
+    """Returns the encoded attachment, cached by file name, modification time and size"""
+    stat = os.stat(filename)
+    return _encode_attachment(filename, stat.st_mtime, stat.st_size)
+
+
+@lru_cache(maxsize=32)
+def _encode_attachment(filename, mtime, size):
+    with open(filename, "rb") as fil:
+        part = MIMEApplication(
+            fil.read(),
+            Name=basename(filename)
+        )
+    # After the file is closed
+    part['Content-Disposition'] = 'attachment; filename="%s"' % basename(filename)
+    # lets the html refer to an attached image as cid:<file name>
+    part['Content-ID'] = '<%s>' % basename(filename)
+    return part
+
+
+def _format_message(mail):
     msg = MIMEMultipart()
-    msg['From'] = send_from
-    msg['To'] = COMMASPACE.join(send_to)
-    msg['CC'] = COMMASPACE.join(cc_to)
-    msg['BCC'] = COMMASPACE.join(bcc_to)
+    msg['From'] = mail["send_from"]
+    msg['To'] = COMMASPACE.join(mail["send_to"])
+    msg['CC'] = COMMASPACE.join(mail["cc_to"])
+    msg['BCC'] = COMMASPACE.join(mail["bcc_to"])
     msg['Date'] = formatdate(localtime=True)
-    msg['Subject'] = subject
+    msg['Subject'] = mail["subject"]
 
-    msg.attach(MIMEText(text, 'plain'))
-    if not (not html):
-        msg.attach(MIMEText(html, 'html'))
+    msg.attach(MIMEText(mail["text"], 'plain'))
+    if not (not mail["html"]):
+        msg.attach(MIMEText(mail["html"], 'html'))
+
+    for part in mail["attachments"].values():
+        msg.attach(copy.copy(part))
+
+    return msg
+
+
+def _get_smtp(server):
+    """Returns an open SMTP session to the server, reusing the current one if it is still alive"""
+    global _smtp, _smtp_server
+    if _smtp is not None and _smtp_server == server:
+        try:
+            if _smtp.noop()[0] == 250:
+                return _smtp
+        except smtplib.SMTPException:
+            pass
+        except OSError:
+            pass
+    close_session()
+    _smtp = smtplib.SMTP(server)
+    _smtp_server = server
+    return _smtp
+
+
+def close_session():
+    """Closes the SMTP session"""
+    global _smtp, _smtp_server
+    with _smtp_lock:
+        if _smtp is not None:
+            try:
+                _smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                _smtp.close()
+        _smtp = None
+        _smtp_server = None
 
-    for f in files or []:
-        with open(f, "rb") as fil:
-            part = MIMEApplication(
-                fil.read(),
-                Name=basename(f)
-            )
-        # After the file is closed
-        part['Content-Disposition'] = 'attachment; filename="%s"' % basename(f)
-        msg.attach(part)
 
+def _deliver(mail):
+    log = mail["log"]
     try:
-        smtp = smtplib.SMTP(server)
-        smtp.sendmail(send_from, send_to+cc_to+bcc_to, msg.as_string())
-        smtp.close()
+        msg = _format_message(mail)
+        with _smtp_lock:
+            smtp = _get_smtp(mail["server"])
+            smtp.sendmail(mail["send_from"], mail["send_to"] + mail["cc_to"] + mail["bcc_to"], msg.as_string())
         log.debug("Email sent.")
+    except smtplib.SMTPResponseException as e:
+        metrics.inc("wisegcn_failures_total", component="smtp")
+        log.error("Failed to send email! Error {}: {}".format(e.smtp_code, e.smtp_error))
+        close_session()
     except Exception as e:
-        code, msg = e.args
-        log.error("Failed to send email! Error {}: {}".format(code, msg))
+        metrics.inc("wisegcn_failures_total", component="smtp")
+        log.error("Failed to send email! Error: {!r}".format(e))
+        close_session()
+
+
+def _digest(mails):
+    """Merges a burst of emails to the same recipients into one"""
+    if len(mails) == 1:
+        return mails[0]
+    digest = dict(mails[0])
+    digest["subject"] = "[GW@Wise] Digest: " + "; ".join(m["subject"].replace("[GW@Wise] ", "") for m in mails)
+    digest["text"] = "\n\n".join(f"{m['subject']}\n{m['text']}" for m in mails)
+    digest["html"] = "<hr>".join(m["html"] if m["html"] else format_html(m["text"].replace("\n", "<br>"))
+                                 for m in mails)
+    # the same (cached) attachment is attached only once
+    digest["attachments"] = {id(part): part for m in mails for part in m["attachments"].values()}
+    return digest
+
+
+def _dispatch():
+    window = config.getfloat('EMAIL', 'DIGEST') if config.has_option('EMAIL', 'DIGEST') else 0
+    while True:
+        mails = [_queue.get()]
+        if window > 0:
+            # collect the burst
+            deadline = time.monotonic() + window
+            while True:
+                try:
+                    mails.append(_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            groups = {}
+            for m in mails:
+                key = (m["send_from"], tuple(m["send_to"]), tuple(m["cc_to"]), tuple(m["bcc_to"]), m["server"])
+                groups.setdefault(key, []).append(m)
+            for group in groups.values():
+                _deliver(_digest(group))
+        else:
+            _deliver(mails[0])
+        for m in mails:
+            _queue.task_done()
 
-    return
+
+def _start_dispatcher():
+    global _queue, _dispatcher, _dispatcher_pid
+    with _smtp_lock:
+        if _dispatcher is None or _dispatcher_pid != os.getpid():
+            _queue = queue.Queue()
+            _dispatcher = threading.Thread(target=_dispatch, name="mail-dispatcher", daemon=True)
+            _dispatcher.start()
+            _dispatcher_pid = os.getpid()
+            # the alerts don't wait for their emails, deliver the queued ones before exiting
+            atexit.register(flush_mail)
+
+
+def flush_mail():
+    """Waits until all the queued emails are delivered (called at exit, see _start_dispatcher)"""
+    if _queue is not None and _dispatcher_pid == os.getpid():
+        _queue.join()
 
 
 def format_html(text, img=None, img_width=300):
@@ -90,10 +236,18 @@ def format_html(text, img=None, img_width=300):
     return html
 
 
-def format_alert(params, area=None):
+def format_alert(params, area=None, summary=None):
+    """
+    Formats the alert email.
+
+    :param params: VOEvent parameters
+    :param area: 50% (and 90%) credible areas [deg^2]
+    :param summary: sky map summary (see skymap_summary.summarize_skymap): adds the number of modes, the distance
+                    and the preview image, which should be attached to the email
+    :return: html
+    """
     from astropy.time import Time
     import numpy as np
-    from wisegcn.utils import get_sky_area
 
     # healpix map image path
     image_url = params["skymap_fits"][0:params["skymap_fits"].find("fits.gz")]
@@ -122,6 +276,13 @@ def format_alert(params, area=None):
             <b>90% Probability Area [deg<sup>2</sup>]:</b> {np.round(area[1], 2)}<br>
         """
 
+    if summary is not None:
+        html = html + f"""\
+            <b>90% Probability Modes:</b> {summary["modes"]}<br>
+            <b>90% Probability Distance [Mpc]:</b> {np.round(summary["dist_mean"], 0)} &plusmn; \
+{np.round(summary["dist_std"], 0)}<br>
+        """
+
     html = html + f"""\
             <b>Nature [BNS / NSBH / MassGap / BBH / Terrestrial]:</b> {np.round(float(params["BNS"])*100, 1)}% / 
                 {np.round(float(params["NSBH"])*100, 1)}% / 
@@ -132,6 +293,14 @@ def format_alert(params, area=None):
             <b>Probability of Remnant Emission:</b> {np.round(float(params["HasRemnant"])*100, 1)}%<br>
         </p>
         <p>
+    """
+
+    if summary is not None:
+        html = html + f"""\
+            <img src="cid:{basename(summary["preview"])}" width="360" border="0"><br>
+        """
+
+    html = html + f"""\
             <img src="{image_url+"png"}" width="500" border="0"> 
             <img src="{image_url+"volume.png"}" width="300" border="0">
         </p>
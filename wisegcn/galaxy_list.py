@@ -1,16 +1,50 @@
 import healpy as hp
 import numpy as np
-from scipy.special import gammaincinv
-from scipy.special import gammaincc
 from configparser import ConfigParser
 from wisegcn.email_alert import send_mail
 from wisegcn import magnitudes as mag
 from wisegcn import mysql_update
+from wisegcn import wise
+from wisegcn import metrics
+from wisegcn.catalog import load_catalog, column, as_rows, COLUMNS
+from wisegcn.luminosity_function import completeness_cutoff, completeness_weights
+from wisegcn.skymap import distance_pdf
+from wisegcn.shared import share_arrays, attach_arrays, release
+from wisegcn.skymap_cache import SKYMAP_FIELDS, get_skymap_arrays, share_skymap, attach_skymap, unshare_skymap
+import multiprocessing
 import logging
+from functools import partial
 from astropy import units as u
 from astropy.coordinates import Angle
-from astropy.table import Table
-from scipy.stats import norm
+
+# long-lived galaxy scoring pool (see get_scoring_pool)
+_scoring_pool = None
+_scoring_nproc = 0
+
+
+def get_scoring_pool(nproc):
+    """
+    Returns the galaxy scoring pool, forked once and reused by all the alerts: its processes inherit the memory-mapped
+    catalog (copy-on-write), so only the sky map of each alert is shared with them.
+
+    :param nproc: number of processes
+    :return: process pool
+    """
+    global _scoring_pool, _scoring_nproc
+    if _scoring_pool is None or _scoring_nproc != nproc:
+        close_scoring_pool()
+        _scoring_pool = multiprocessing.get_context("fork").Pool(processes=nproc)
+        _scoring_nproc = nproc
+    return _scoring_pool
+
+
+def close_scoring_pool():
+    global _scoring_pool, _scoring_nproc
+    if _scoring_pool is not None:
+        _scoring_pool.close()
+        _scoring_pool.join()
+        _scoring_pool = None
+        _scoring_nproc = 0
 
 
 def find_galaxy_list(skymap_path, log=None):
@@ -27,6 +61,9 @@ def find_galaxy_list(skymap_path, log=None):
     completeness = config.getfloat('GALAXIES', 'COMPLETENESS')
     min_galaxies = config.getfloat('GALAXIES', 'MINGALAXIES')  # minimal number of galaxies to output
     max_galaxies = config.getint('GALAXIES', 'MAXGALAXIES')  # maximal number of galaxies to use
+    nproc = config.getint('GALAXIES', 'NPROC') if config.has_option('GALAXIES', 'NPROC') else 1  # scoring processes
+    visible_only = config.getboolean('GALAXIES', 'VISIBLE_ONLY') if config.has_option('GALAXIES', 'VISIBLE_ONLY') \
+        else True  # rank only galaxies observable from Wise tonight
 
     # magnitude of event in r-band. values are value from Barnes... +-1.5 mag
     minmag = config.getfloat('GALAXIES', 'MINMAG')  # Estimated brightest KN abs mag
@@ -41,38 +78,36 @@ def find_galaxy_list(skymap_path, log=None):
     # Schechter function parameters:
     alpha = config.getfloat('GALAXIES', 'ALPHA')
     MB_star = config.getfloat('GALAXIES', 'MB_STAR')  # random slide from https://www.astro.umd.edu/~richard/ASTRO620/LumFunction-pp.pdf but not really...?
+    completeness_weighting = config.getboolean('GALAXIES', 'COMPLETENESS_WEIGHTING') \
+        if config.has_option('GALAXIES', 'COMPLETENESS_WEIGHTING') else False  # per-distance-shell weighting
 
     if log is None:
         log = logging.getLogger(__name__)
 
     # Read the HEALPix sky map:
     try:
-        prob, dist_mu, dist_sigma, dist_norm = hp.read_map(skymap_path, field=None, verbose=False)
+        skymap = get_skymap_arrays(skymap_path)
+        prob, dist_mu, dist_sigma, dist_norm = (skymap[key] for key in SKYMAP_FIELDS)
     except Exception as e:
         log.error('Failed to read sky map!')
         send_mail(subject="[GW@Wise] Failed to read LVC sky map",
                   text='''FITS file: {}
                           Exception: {}'''.format(skymap_path, e),
                   log=log)
+        raise
 
     # Load the galaxy catalog (glade_id, RA, DEC, distance, Bmag):
-    galaxy_cat = np.load(cat_file)
-    galaxy_cat = Table(galaxy_cat, names=('ID', 'RA', 'Dec', 'Dist', 'Bmag'))
-    galaxy_cat = galaxy_cat[np.where(galaxy_cat['Dist'] > 0)]  # remove entries with a negative distance
-    galaxy_cat = galaxy_cat[np.where(~np.isnan(galaxy_cat['Bmag']))]  # remove entries with no Bmag
+    galaxy_cat = load_catalog(cat_file)
+    # remove entries with a negative distance or no Bmag (the compact catalog is built without them, so it is kept
+    # memory-mapped)
+    good = (column(galaxy_cat, "dist") > 0) & ~np.isnan(column(galaxy_cat, "bmag"))
+    if not good.all():
+        galaxy_cat = galaxy_cat[good]
 
     # Skymap parameters:
     npix = len(prob)
     nside = hp.npix2nside(npix)
 
-    # Convert galaxy WCS (RA, DEC) to spherical coordinates (theta, phi):
-    theta = 0.5 * np.pi - np.deg2rad(galaxy_cat['Dec'])
-    phi = np.deg2rad(galaxy_cat['RA'])
-    d = np.array(galaxy_cat['Dist'])
-
-    # Convert galaxy coordinates to skymap pixels:
-    galaxy_pix = hp.ang2pix(nside, theta, phi)
-
     # Most probable sky location
     theta_maxprob, phi_maxprob = hp.pix2ang(nside, np.argmax(prob))
     ra_maxprob = np.rad2deg(phi_maxprob)
@@ -83,103 +118,83 @@ def find_galaxy_list(skymap_path, log=None):
     dec_maxprob = Angle(dec_maxprob * u.deg)
 
     # Find given percent probability zone (default is 99%):
-    prob_cutoff = 1
-    prob_sum = 0
-    npix_credzone = 0
-
-    prob_sorted = np.sort(prob, kind="stable")
-    while prob_sum < credzone:
-        prob_sum = prob_sum + prob_sorted[-1]
-        prob_cutoff = prob_sorted[-1]
-        prob_sorted = prob_sorted[:-1]
-        npix_credzone = npix_credzone + 1
+    prob_sorted = np.sort(prob, kind="stable")[::-1]
+    prob_cumsum = np.cumsum(prob_sorted)
+    npix_credzone = credzone_npix(prob_cumsum, credzone)
+    prob_cutoff = prob_sorted[npix_credzone - 1]
 
     # area = npix_credzone * hp.nside2pixarea(nside, degrees=True)
 
     ####################################################
 
-    # calculate probability for galaxies by the localization map:
-    p = prob[galaxy_pix]
-    p_dist = dist_norm[galaxy_pix] * norm(dist_mu[galaxy_pix], dist_sigma[galaxy_pix]).pdf(d)
+    if nproc > 1 and multiprocessing.current_process().daemon:
+        log.warning("Pool workers can't fork, scoring galaxies in a single process.")
+        nproc = 1
+
+    scoring_args = (sensitivity, minL, maxL, min_dist_factor)
+    if nproc > 1:
+        # score the catalog shards in the long-lived pool: its processes load the memory-mapped catalog themselves
+        # (only a filtered catalog is copied to shared memory), and the sky map is copied only if it wasn't already
+        # shared for this alert
+        log.debug(f"Scoring galaxies using {nproc} processes.")
+        if good.all():
+            blocks, spec = [], {"cat_file": cat_file}
+        else:
+            blocks, spec = share_arrays({"galaxy_cat": galaxy_cat})
+        skymap_handle = share_skymap(skymap_path, arrays=skymap)
+        if skymap_handle is None:
+            # sky map sharing is disabled (EVENT FILES/SKYMAP_CACHE), copy it for the pool
+            skymap_blocks, skymap_spec = share_arrays(skymap)
+            blocks += skymap_blocks
+            skymap_handle = {"shm": skymap_spec}
+        select = partial(select_galaxies_parallel, get_scoring_pool(nproc), spec, skymap_handle, len(galaxy_cat),
+                         nproc)
+    else:
+        select = partial(select_galaxies, galaxy_cat, skymap)
+    try:
+        # cutoffs - 99% of probability by angles and 3sigma by distance:
+        within_idx, terms = select(prob_cutoff, nsigmas_in_d, scoring_args)
 
-    # cutoffs - 99% of probability by angles and 3sigma by distance:
-    within_dist_idx = np.where(np.abs(d - dist_mu[galaxy_pix]) < nsigmas_in_d*dist_sigma[galaxy_pix])
-    within_credzone_idx = np.where(p >= prob_cutoff)
-    within_idx = np.intersect1d(within_credzone_idx, within_dist_idx)
+        do_mass_cutoff = True
 
-    do_mass_cutoff = True
+        # Relax credzone limits if no galaxies are found:
+        if within_idx.size == 0:
+            npix_credzone = max(npix_credzone, credzone_npix(prob_cumsum, relaxed_credzone))
+            prob_cutoff = prob_sorted[npix_credzone - 1]
+            within_idx, terms = select(prob_cutoff, relaxed_nsigmas_in_d, scoring_args)
+            do_mass_cutoff = False
+    finally:
+        if nproc > 1:
+            release(blocks, unlink=True)
+            unshare_skymap(skymap_path)
 
-    # Relax credzone limits if no galaxies are found:
     if within_idx.size == 0:
-        while prob_sum < relaxed_credzone:
-            if prob_sorted.size == 0:
-                break
-            prob_sum = prob_sum + prob_sorted[-1]
-            prob_cutoff = prob_sorted[-1]
-            prob_sorted = prob_sorted[:-1]
-            npix_credzone = npix_credzone + 1
-        within_dist_idx = np.where(np.abs(d - dist_mu[galaxy_pix]) < relaxed_nsigmas_in_d * dist_sigma[galaxy_pix])
-        within_credzone_idx = np.where(p >= prob_cutoff)
-        within_idx = np.intersect1d(within_credzone_idx, within_dist_idx)
-        do_mass_cutoff = False
-
-    p = p[within_idx]
-    p = (p * (p_dist[within_idx]))  # d**2?
-
-    galaxy_cat = galaxy_cat[within_idx]
-
-    if len(galaxy_cat) == 0:
         log.warning("No galaxies in field!")
-        log.warning("99.995% of probability is ", npix_credzone*hp.nside2pixarea(nside, degrees=True), "deg^2")
+        log.warning("99.995% of probability is %.2f deg^2", npix_credzone*hp.nside2pixarea(nside, degrees=True))
         log.warning("Peaking at (deg) RA = {}, Dec = {}".format(
             ra_maxprob.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
             dec_maxprob.to_string(sep=':', precision=2, alwayssign=True, pad=True)))
         return
 
-    # Normalize luminosity to account for mass:
-    luminosity = mag.L_nu_from_magAB(galaxy_cat['Bmag'] - 5 * np.log10(galaxy_cat['Dist'] * (10 ** 5)))
-    luminosity_norm = luminosity / np.sum(luminosity)
-    normalization = np.sum(p * luminosity_norm)
-    score = p * luminosity_norm / normalization
+    galaxy_cat = galaxy_cat[within_idx]
+    p, abs_mag, luminosity, distance_factor = terms
+    if completeness_weighting:
+        # weight by the catalog completeness of the galaxy's distance shell (precomputed per catalog)
+        luminosity = luminosity * completeness_weights(column(galaxy_cat, "dist"), cat_file)
+    luminosity_norm, score = normalize_scores(p, luminosity)
+    metrics.inc("wisegcn_galaxies_scored_total", len(score))
 
     # Take 50% of mass:
-
-    # The area under the Schechter function between L=inf and the brightest galaxy in the field:
-    missing_piece = gammaincc(alpha + 2, 10 ** (-(min(galaxy_cat['Bmag'] - 5*np.log10(galaxy_cat['Dist']*(10**5))) - MB_star) / 2.5))
-    # there are no galaxies brighter than this in the field, so don't count that part of the Schechter function
-
-    while do_mass_cutoff:
-        MB_max = MB_star + 2.5 * np.log10(gammaincinv(alpha + 2, completeness + missing_piece))
-
-        if (min(galaxy_cat['Bmag'] - 5*np.log10(galaxy_cat['Dist']*(10**5))) - MB_star) > 0:
-            MB_max = 100  # if the brightest galaxy in the field is fainter than the cutoff brightness - don't cut by brightness
-
-        brightest = np.where(galaxy_cat['Bmag'] - 5*np.log10(galaxy_cat['Dist']*(10**5)) < MB_max)
-        # print MB_max
-        if len(brightest[0]) < min_galaxies:
-            # Not enough galaxies, allowing fainter galaxies
-            if completeness >= 0.9:  # Tried hard enough, just take all of them
-                completeness = 1  # Just to be consistent
-                do_mass_cutoff = False
-            else:
-                completeness = (completeness + (1. - completeness) / 2)
-        else:  # got enough galaxies
+    if do_mass_cutoff:
+        MB_max, completeness = completeness_cutoff(abs_mag, alpha, MB_star, completeness, min_galaxies)
+        if MB_max is not None:
+            brightest = np.where(abs_mag < MB_max)
             galaxy_cat = galaxy_cat[brightest]
             p = p[brightest]
             luminosity_norm = luminosity_norm[brightest]
             score = score[brightest]
-            do_mass_cutoff = False
-
-    # Account for the distance
-    absolute_sensitivity = sensitivity - 5 * np.log10(galaxy_cat['Dist'] * (10 ** 5))
-
-    absolute_sensitivity_lum = mag.f_nu_from_magAB(absolute_sensitivity)
-    distance_factor = np.zeros(len(galaxy_cat))
-
-    distance_factor[:] = ((maxL - absolute_sensitivity_lum) / (maxL - minL))
-    distance_factor[min_dist_factor > (maxL - absolute_sensitivity_lum) / (maxL - minL)] = min_dist_factor
-    distance_factor[absolute_sensitivity_lum < minL] = 1
-    distance_factor[absolute_sensitivity > maxL] = min_dist_factor
+            distance_factor = distance_factor[brightest]
+        log.debug(f"Completeness {completeness:.3f}: {galaxy_cat.shape[0]} galaxies.")
 
     # Sort galaxies by probability
     ranking_idx = np.argsort(p*luminosity_norm*distance_factor, kind="stable")[::-1]
@@ -202,6 +217,13 @@ def find_galaxy_list(skymap_path, log=None):
     # # 99percent_area = area of map in [deg^2] consisting 99% (using only the map from LIGO)
     # stats = {"Ngalaxies_50percent": galaxies50per, "actual_percentage": sum*100, "seen_percentage": sum_seen, "99percent_area": area}
 
+    # Drop the galaxies Wise can't observe tonight, before limiting the number of galaxies:
+    if visible_only:
+        t, t_sunrise = wise.get_observing_night(log)
+        visible = wise.is_visible_at_wise(column(galaxy_cat, "ra"), column(galaxy_cat, "dec"), t, t_sunrise)
+        log.info(f"{np.count_nonzero(visible)} of {len(visible)} galaxies are observable tonight.")
+        ranking_idx = ranking_idx[visible[ranking_idx]]
+
     # Limit the maximal number of galaxies to use:
     if len(ranking_idx) > max_galaxies:
         n = max_galaxies
@@ -210,16 +232,142 @@ def find_galaxy_list(skymap_path, log=None):
 
     # Create sorted galaxy list (glade_id, RA, DEC, distance(Mpc), Bmag, score, distance factor (between 0-1))
     # The score is normalized so that all the galaxies in the field sum to 1 (before applying luminosity cutoff)
-    galaxylist = np.ndarray((n, 7))
-    for i in range(ranking_idx.shape[0])[:n]:
-        ind = ranking_idx[i]
-        galaxylist[i, :] = [galaxy_cat[ind]['ID'], galaxy_cat[ind]['RA'], galaxy_cat[ind]['Dec'], galaxy_cat[ind]['Dist'], galaxy_cat[ind]['Bmag'],
-                            score[ind], distance_factor[ind]]
+    ranking_idx = ranking_idx[:n]
+    galaxylist = np.column_stack((as_rows(galaxy_cat[ranking_idx]), score[ranking_idx], distance_factor[ranking_idx]))
 
+    for i in range(n):
         # Update galaxy table in SQL database:
         lvc_galaxy_dict = {'voeventid': '(SELECT MAX(id) from voevent_lvc)',
-                           'score': score[ind],
-                           'gladeid': galaxy_cat[ind]['ID']}
+                           'score': galaxylist[i, 5],
+                           'gladeid': galaxylist[i, 0]}
         mysql_update.insert_values('lvc_galaxies', lvc_galaxy_dict)
 
     return galaxylist, ra_maxprob, dec_maxprob
+
+
+def credzone_npix(prob_cumsum, credzone):
+    """Number of most probable pixels needed to cover credzone (prob_cumsum is the cumulative sum of the sorted
+    descending probabilities)"""
+    return min(int(np.searchsorted(prob_cumsum, credzone, side="left")) + 1, len(prob_cumsum))
+
+
+def galaxy_terms(p, d, dist_mu, dist_sigma, dist_norm, bmag, sensitivity, minL, maxL, min_dist_factor):
+    """
+    Fused scoring kernel: the per-galaxy (elementwise) terms of the galaxy score.
+
+    :param p: 2D probability of the galaxy pixels
+    :param d: galaxy distances [Mpc]
+    :param dist_mu: distance location parameter of the galaxy pixels
+    :param dist_sigma: distance scale parameter of the galaxy pixels
+    :param dist_norm: distance normalization of the galaxy pixels
+    :param bmag: galaxy apparent B magnitudes
+    :param sensitivity: estimated faintest apparent magnitude we can see
+    :param minL: flux of the faintest expected event
+    :param maxL: flux of the brightest expected event
+    :param min_dist_factor: minimal distance factor
+    :return: 3D probability density, absolute B magnitude, luminosity and distance factor
+    """
+    # 3D posterior density
+    p = p * distance_pdf(d, dist_mu, dist_sigma, dist_norm)  # d**2?
+
+    # distance modulus, computed once
+    dist_mod = d * 1e5
+    np.log10(dist_mod, out=dist_mod)
+    dist_mod *= 5
+    abs_mag = bmag - dist_mod
+
+    luminosity = mag.L_nu_from_magAB(abs_mag)
+
+    # Account for the distance
+    absolute_sensitivity = sensitivity - dist_mod
+    absolute_sensitivity_lum = mag.f_nu_from_magAB(absolute_sensitivity)
+    distance_factor = maxL - absolute_sensitivity_lum
+    distance_factor /= (maxL - minL)
+    distance_factor[min_dist_factor > distance_factor] = min_dist_factor
+    distance_factor[absolute_sensitivity_lum < minL] = 1
+    distance_factor[absolute_sensitivity > maxL] = min_dist_factor
+
+    return p, abs_mag, luminosity, distance_factor
+
+
+def normalize_scores(p, luminosity):
+    """Normalize luminosity to account for mass, and the scores so that all the galaxies in the field sum to 1"""
+    luminosity_norm = luminosity / np.sum(luminosity)
+    score = p * luminosity_norm
+    score /= np.sum(score)
+    return luminosity_norm, score
+
+
+def select_galaxies(galaxy_cat, skymap, prob_cutoff, nsigmas_in_d, scoring_args):
+    """
+    Find the galaxies within the credible zone and distance limits, and compute their per-galaxy terms.
+
+    :param galaxy_cat: galaxy catalog (or a shard of it)
+    :param skymap: dictionary of the prob, dist_mu, dist_sigma and dist_norm HEALPix arrays (see skymap_cache)
+    :param prob_cutoff: minimal pixel probability
+    :param nsigmas_in_d: sigmas to consider in distance
+    :param scoring_args: sensitivity, minL, maxL and min_dist_factor (see galaxy_terms)
+    :return: indices of the selected galaxies, and their galaxy_terms
+    """
+    nside = hp.npix2nside(len(skymap["prob"]))
+
+    # Convert galaxy WCS (RA, DEC) to spherical coordinates (theta, phi):
+    ra, dec, d, bmag = (column(galaxy_cat, name) for name in COLUMNS[1:])
+    theta = 0.5 * np.pi - np.deg2rad(dec)
+    phi = np.deg2rad(ra)
+
+    # Convert galaxy coordinates to skymap pixels:
+    galaxy_pix = hp.ang2pix(nside, theta, phi)
+
+    # calculate probability for galaxies by the localization map:
+    p = skymap["prob"][galaxy_pix]
+    mu = skymap["dist_mu"][galaxy_pix]
+    sigma = skymap["dist_sigma"][galaxy_pix]
+
+    idx = np.flatnonzero((p >= prob_cutoff) & (np.abs(d - mu) < nsigmas_in_d*sigma))
+    galaxy_pix = galaxy_pix[idx]
+    return idx, galaxy_terms(p[idx], d[idx], mu[idx], sigma[idx], skymap["dist_norm"][galaxy_pix], bmag[idx],
+                             *scoring_args)
+
+
+def _select_galaxies_shard(spec, skymap_handle, start, stop, prob_cutoff, nsigmas_in_d, scoring_args):
+    blocks, skymap_blocks = [], []
+    arrays = galaxy_cat = skymap = None
+    try:
+        if "cat_file" in spec:
+            # the memory-mapped catalog (inherited from the parent, if it was loaded before the pool was forked)
+            galaxy_cat = load_catalog(spec["cat_file"])
+        else:
+            blocks, arrays = attach_arrays(spec)
+            galaxy_cat = arrays.pop("galaxy_cat")
+        skymap_blocks, skymap = attach_skymap(skymap_handle)
+        idx, terms = select_galaxies(galaxy_cat[start:stop], skymap, prob_cutoff, nsigmas_in_d, scoring_args)
+    finally:
+        del arrays, galaxy_cat, skymap
+        release(blocks)
+        release(skymap_blocks)
+    return idx + start, terms
+
+
+def select_galaxies_parallel(pool, spec, skymap_handle, n, nshards, prob_cutoff, nsigmas_in_d, scoring_args):
+    """
+    Same as select_galaxies, over catalog shards scored in a process pool.
+    The shards are merged in catalog order, so the result is identical to select_galaxies.
+
+    :param pool: process pool (see get_scoring_pool)
+    :param spec: share_arrays spec of the galaxy_cat array, or {"cat_file": <path>} to use the memory-mapped catalog
+    :param skymap_handle: share_skymap handle of the sky map
+    :param n: catalog length
+    :param nshards: number of shards
+    :param prob_cutoff: minimal pixel probability
+    :param nsigmas_in_d: sigmas to consider in distance
+    :param scoring_args: sensitivity, minL, maxL and min_dist_factor (see galaxy_terms)
+    :return: indices of the selected galaxies, and their galaxy_terms
+    """
+    bounds = np.linspace(0, n, nshards + 1).astype(int)
+    results = pool.starmap(_select_galaxies_shard,
+                           [(spec, skymap_handle, bounds[i], bounds[i + 1], prob_cutoff, nsigmas_in_d, scoring_args)
+                            for i in range(nshards)])
+    idx = np.concatenate([r[0] for r in results])
+    terms = tuple(np.concatenate([r[1][k] for r in results]) for k in range(len(results[0][1])))
+    return idx, terms
@@ -1,124 +1,131 @@
 import gcn.notice_types
 from astropy.utils.data import download_file
 from astropy.io import ascii
+from astropy.coordinates import Angle
+from astropy import units as u
+import healpy as hp
+import numpy as np
 import shutil
 import ntpath
 from wisegcn.email_alert import send_mail, format_alert, format_html
 from wisegcn import galaxy_list
 from wisegcn import wise
 from wisegcn import mysql_update
-from wisegcn.utils import get_sky_area
+from wisegcn import journal
+from wisegcn.skymap_summary import summarize_skymap, get_area
+from wisegcn.voevent import parse_voevent
+from wisegcn.skymap_cache import share_skymap, unshare_skymap, get_skymap_arrays
+from wisegcn.logger import init_log, close_log
+from wisegcn import metrics
+from wisegcn import rules
 from configparser import ConfigParser
-import voeventparse as vp
 import logging
 import os
+import time
 
 config = ConfigParser(inline_comment_prefixes=';')
 config.read("config.ini")
 
 
-def init_log(filename="log.log"):
-    log_path = config.get('LOG', 'PATH')  # log file path
-    console_log_level = config.get('LOG', 'CONSOLE_LEVEL')  # logging level
-    file_log_level = config.get('LOG', 'FILE_LEVEL')  # logging level
+# Notice types to respond to
+LVC_NOTICE_TYPES = (gcn.notice_types.LVC_PRELIMINARY,
+                    gcn.notice_types.LVC_INITIAL,
+                    gcn.notice_types.LVC_UPDATE,
+                    gcn.notice_types.LVC_RETRACTION)
 
-    # create log folder
-    if not os.path.exists(log_path):
-        os.makedirs(log_path)
 
-    log = logging.getLogger(__name__)
-    log.setLevel(logging.DEBUG)
-
-    # console handler
-    h = logging.StreamHandler()
-    h.setLevel(logging.getLevelName(console_log_level))
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S")
-    h.setFormatter(formatter)
-    log.addHandler(h)
-
-    # log file handler
-    h = logging.FileHandler(log_path + filename + ".log", "w", encoding=None, delay="true")
-    h.setLevel(logging.getLevelName(file_log_level))
-    formatter = logging.Formatter(
-        "%(asctime)s - %(levelname)s [%(filename)s:%(lineno)s]: %(message)s", "%Y-%m-%d %H:%M:%S")
-    h.setFormatter(formatter)
-    log.addHandler(h)
-
-    return log
-
-
-def close_log(log):
-    handlers = list(log.handlers)
-    for h in handlers:
-        log.removeHandler(h)
-        h.flush()
-        h.close()
+def get_role():
+    """Respond only to 'test'/'observation' events"""
+    is_test = config.getboolean('GENERAL', 'TEST') if config.has_option('GENERAL', 'TEST') else False
+    return 'test' if is_test else 'observation'
 
 
 # Function to call every time a GCN is received.
 # Run only for notices of type
 # LVC_PRELIMINARY, LVC_INITIAL, LVC_UPDATE, or LVC_RETRACTION.
-@gcn.handlers.include_notice_types(
-    gcn.notice_types.LVC_PRELIMINARY,
-    gcn.notice_types.LVC_INITIAL,
-    gcn.notice_types.LVC_UPDATE,
-    gcn.notice_types.LVC_RETRACTION)
+@gcn.handlers.include_notice_types(*LVC_NOTICE_TYPES)
 def process_gcn(payload, root):
-    alerts_path = config.get('ALERT FILES', 'PATH')  # event alert file path
-    fits_path = config.get('EVENT FILES', 'PATH')  # event FITS file path
-    is_test = config.getboolean('GENERAL', 'TEST') if config.has_option('GENERAL', 'TEST') else False
-
-    # Respond only to 'test'/'observation' events
-    if is_test:
-        role = 'test'
-    else:
-        role = 'observation'
-
+    role = get_role()
     if root.attrib['role'] != role:
         logging.info('Not {}, aborting.'.format(role))
+        metrics.inc("wisegcn_notices_filtered_total", reason="role")
+        return
+
+    params = parse_voevent(payload)
+    if params is None:
+        logging.error('Failed to parse VOEvent, aborting.')
         return
 
-    ivorn = root.attrib['ivorn']
-    filename = ntpath.basename(ivorn).split('#')[1]
+    process_alert(payload, params)
+
+
+def process_alert(payload, params):
+    """
+    Process an LVC notice, whose parameters were already read (see voevent.parse_voevent).
+    The completed stages are checkpointed in the journal (see journal.begin_alert): if the processing is interrupted,
+    it is resumed from the last completed stage, without repeating the database inserts, emails and uploads.
+
+    :param payload: VOEvent XML (bytes)
+    :param params: VOEvent parameters
+    """
+    filename = ntpath.basename(params['ivorn']).split('#')[1]
     log = init_log(filename)
+    timer = metrics.StageTimer(log)
+    try:
+        timer.enter("filter")
+        if not is_accepted(params, log):
+            return
+        # only the alerts that pass the rules are journaled
+        done = journal.begin_alert(filename, payload, params)
+        if done:
+            log.info(f"Resuming, completed stages: {', '.join(done)}.")
+        _process_alert(payload, params, filename, timer, done, log)
+    except Exception as e:
+        log.exception("Failed to process alert.")
+        journal.finish_alert(filename, error=e)
+        raise
+    else:
+        journal.finish_alert(filename)
+    finally:
+        # Finish and delete logger (queued emails are delivered in the background, see email_alert.send_mail)
+        timer.stop()
+        close_log(log)
+
+
+def is_accepted(params, log):
+    """Should the alert be processed? Retractions are, other alerts only if they pass the rules (see rules.evaluate)"""
+    if int(params['Packet_Type']) == gcn.notice_types.LVC_RETRACTION:
+        return True
+
+    # Respond only to 'CBC' (compact binary coalescence candidates) events of specific merger types, with low
+    # enough FAR (see rules.compile_rules)
+    decision = rules.evaluate(params)
+    log.debug(f"Rules {decision.rules}: " + "; ".join(decision.trace))
+    if not decision.accepted:
+        log.info('Not CBC, aborting.' if decision.reason == "group" else "Uninteresting alert, aborting.")
+        metrics.inc("wisegcn_notices_filtered_total", reason=decision.reason)
+        return False
+    return True
+
+
+def _process_alert(payload, params, filename, timer, done, log):
+    alerts_path = config.get('ALERT FILES', 'PATH')  # event alert file path
+    fits_path = config.get('EVENT FILES', 'PATH')  # event FITS file path
+
+    ivorn = params['ivorn']
 
     # Is retracted?
-    if gcn.handlers.get_notice_type(root) == gcn.notice_types.LVC_RETRACTION:
+    if int(params['Packet_Type']) == gcn.notice_types.LVC_RETRACTION:
         # Save alert to file
         with open(alerts_path + filename + '.xml', "wb") as f:
             f.write(payload)
         log.info("Event {} retracted, doing nothing.".format(filename))
-        send_mail(subject="[GW@Wise] {}".format(filename.split('-')[0]),
-                  text="GCN/LVC retraction {} received, doing nothing.".format(filename),
-                  html=format_html("<b>Alert retracted.</b><br>"),
-                  files=[alerts_path + filename + '.xml'])
-        return
-
-    v = vp.loads(payload)
-
-    # Read all of the VOEvent parameters from the "What" section
-    params = {elem.attrib['name']:
-              elem.attrib['value']
-              for elem in v.iterfind('.//Param')}
-
-    # Respond only to 'CBC' (compact binary coalescence candidates) events.
-    # Change 'CBC' to 'Burst' to respond to only unmodeled burst events.
-    if params['Group'] != 'CBC':
-        log.info('Not CBC, aborting.')
-        return
-
-    # Respond only to specific merger types
-    if ((config.getfloat("GENERAL", "BNS_MIN") < float(params["BNS"])) |
-            (config.getfloat("GENERAL", "NSBH_MIN") < float(params["NSBH"])) |
-            (config.getfloat("GENERAL", "MASSGAP_MIN") < float(params["MassGap"])) |
-            (config.getfloat("GENERAL", "BBH_MIN") < float(params["BBH"])) |
-            (config.getfloat("GENERAL", "HASNS_MIN") < float(params["HasNS"])) |
-            (config.getfloat("GENERAL", "HASREMNANT_MIN") < float(params["HasRemnant"]))) & \
-            (config.getfloat("GENERAL", "TERRESTRIAL_MAX") >= float(params["Terrestrial"])) & \
-            (config.getfloat("GENERAL", "FAR_MAX") >= float(params["FAR"])*60*60*24*365):
-        pass
-    else:
-        log.info("Uninteresting alert, aborting.")
+        if "email" not in done:
+            send_mail(subject="[GW@Wise] {}".format(filename.split('-')[0]),
+                      text="GCN/LVC retraction {} received, doing nothing.".format(filename),
+                      html=format_html("<b>Alert retracted.</b><br>"),
+                      files=[alerts_path + filename + '.xml'])
+            journal.complete_stage(filename, "email")
         return
 
     # Save alert to file
@@ -126,71 +133,105 @@ def process_gcn(payload, root):
         f.write(payload)
     log.info("GCN/LVC alert {} received, started processing.".format(ivorn))
 
-    # Read VOEvent attributes
-    keylist = ['ivorn', 'role', 'version']
-    for key in keylist:
-        params[key] = v.attrib[key]
-
-    # Read Who
-    params['author_ivorn'] = v.Who.Author.contactName
-    params['date_ivorn'] = v.Who.Date
-
-    # Read WhereWhen
-    params['observatorylocation_id'] = v.WhereWhen.ObsDataLocation.ObservatoryLocation.attrib['id']
-    params['astrocoordsystem_id'] = v.WhereWhen.ObsDataLocation.ObservationLocation.AstroCoordSystem.attrib['id']
-    params['isotime'] = v.WhereWhen.ObsDataLocation.ObservationLocation.AstroCoords.Time.TimeInstant.ISOTime
-
-    # Read How
-    description = ""
-    for item in v.How.iterfind('Description'):
-        description = description + ", " + item
-    params['how_description'] = description
-
     # Insert VOEvent to the database
-    mysql_update.insert_voevent('voevent_lvc', params, log)
+    timer.enter("database")
+    if "database" not in done:
+        mysql_update.insert_voevent('voevent_lvc', params, log)
+        journal.complete_stage(filename, "database")
 
     # Download the HEALPix sky map FITS file.
-    tmp_path = download_file(params['skymap_fits'], cache=False)
+    timer.enter("skymap")
     skymap_path = fits_path + filename + "_" + ntpath.basename(params['skymap_fits'])
-    shutil.move(tmp_path, skymap_path)
-
-    # Respond only to alerts with reasonable localization
-    credzones = [0.5, 0.9, config.getfloat("GENERAL", "AREA_CREDZONE"), config.getfloat("TILE", "CREDZONE")]
-    area = get_sky_area(skymap_path, credzone=credzones)
-    if area[2] > config.getfloat("GENERAL", "AREA_MAX"):
-        log.info(f"""{credzones[2]} area is {area[2]} > {config.get("GENERAL", "AREA_MAX")} deg^2, aborting.""")
-        send_mail(subject="[GW@Wise] {}".format(params["GraceID"]),
-                  text=f"""Attached {filename} GCN/LVC alert received, but {credzones[2]} area is {area[2]} > \
-                          {config.get("GENERAL", "AREA_MAX")} deg^2, aborting.""",
-                  html=format_alert(params, area[0:1]),
-                  files=[alerts_path + filename + '.xml'],
-                  log=log)
-        return
-
-    # Send alert email
-    send_mail(subject="[GW@Wise] {}".format(params["GraceID"]),
-              text="Attached {} GCN/LVC alert received, started processing.".format(filename),
-              html=format_alert(params, area[0:2]),
-              files=[alerts_path+filename+'.xml'],
-              log=log)
-
-    if area[3] > config.getfloat("TILE", "AREA_MAX"):
-        # Create the galaxy list
-        galaxies, ra, dec = galaxy_list.find_galaxy_list(skymap_path, log=log)
-        # Save galaxy list to csv file and send it
-        ascii.write(galaxies, "galaxy_list.csv", format="csv", overwrite=True,
-                    names=["GladeID", "RA", "Dec", "Dist", "Bmag", "Score", "Distance factor"])
-        send_mail(subject="[GW@Wise] {} Galaxy list".format(params["GraceID"]),
-                  text="{} GCN/LVC alert galaxy list is attached.".format(filename),
-                  files=["galaxy_list.csv"],
-                  log=log)
-
-        # Create Wise plan
-        wise.process_galaxy_list(galaxies, alertname=ivorn.split('/')[-1], ra_event=ra, dec_event=dec, log=log)
-    else:
-        # Tile the credible region
-        wise.process_tiles(skymap_path, alertname=ivorn.split('/')[-1], log=log)
+    if "skymap" not in done or not os.path.exists(skymap_path):
+        tmp_path = download_file(params['skymap_fits'], cache=False)
+        shutil.move(tmp_path, skymap_path)
+        journal.complete_stage(filename, "skymap", skymap_path)
+    metrics.set_gauge("wisegcn_skymap_bytes", os.path.getsize(skymap_path))
+
+    # Load the sky map once, and share it with the galaxy scoring, tiling and planning
+    share_skymap(skymap_path)
+    try:
+        metrics.set_gauge("wisegcn_skymap_nside", hp.npix2nside(len(get_skymap_arrays(skymap_path)["prob"])))
+
+        # Respond only to alerts with reasonable localization
+        credzones = [0.5, 0.9, config.getfloat("GENERAL", "AREA_CREDZONE"), config.getfloat("TILE", "CREDZONE")]
+        summary = summarize_skymap(skymap_path, credzones=credzones, log=log)
+        area = get_area(summary, credzones)
+        if area[2] > config.getfloat("GENERAL", "AREA_MAX"):
+            log.info(f"""{credzones[2]} area is {area[2]} > {config.get("GENERAL", "AREA_MAX")} deg^2, aborting.""")
+            metrics.inc("wisegcn_notices_filtered_total", reason="area")
+            if "email" not in done:
+                send_mail(subject="[GW@Wise] {}".format(params["GraceID"]),
+                          text=f"""Attached {filename} GCN/LVC alert received, but {credzones[2]} area is {area[2]} \
+                                  > {config.get("GENERAL", "AREA_MAX")} deg^2, aborting.""",
+                          html=format_alert(params, area[0:1], summary),
+                          files=[alerts_path + filename + '.xml', summary["preview"]],
+                          log=log)
+                journal.complete_stage(filename, "email")
+            return
+
+        if wise.is_progressive() and "quick_plan" not in done and "plan" not in done:
+            # a quick plan first, replaced by the full plan below
+            timer.enter("quick_plan")
+            try:
+                wise.process_quick_plan(skymap_path, alertname=ivorn.split('/')[-1], started=timer.started, log=log)
+            except Exception:
+                # the quick plan is only a head start, carry on with the full plan
+                log.exception("Failed to create the quick plan, continuing with the full plan.")
+            else:
+                journal.complete_stage(filename, "quick_plan")
+
+        # Send alert email
+        timer.enter("email")
+        if "email" not in done:
+            send_mail(subject="[GW@Wise] {}".format(params["GraceID"]),
+                      text="Attached {} GCN/LVC alert received, started processing.".format(filename),
+                      html=format_alert(params, area[0:2], summary),
+                      files=[alerts_path+filename+'.xml', summary["preview"]],
+                      log=log)
+            journal.complete_stage(filename, "email")
+
+        if area[3] > config.getfloat("TILE", "AREA_MAX"):
+            # Create the galaxy list
+            timer.enter("galaxies")
+            if "galaxies" in done and os.path.exists(done["galaxies"]["file"]):
+                galaxies = np.load(done["galaxies"]["file"])
+                ra, dec = Angle(done["galaxies"]["ra"] * u.deg), Angle(done["galaxies"]["dec"] * u.deg)
+            else:
+                result = galaxy_list.find_galaxy_list(skymap_path, log=log)
+                if result is None:
+                    log.warning("No galaxies to observe, aborting.")
+                    if wise.is_progressive():
+                        wise.withdraw_quick_plan(ivorn.split('/')[-1], log=log)
+                    return
+                galaxies, ra, dec = result
+                journal.complete_stage(filename, "galaxies",
+                                       {"file": journal.save_array(filename, "galaxies", galaxies),
+                                        "ra": ra.deg, "dec": dec.deg})
+            if "galaxy_email" not in done:
+                # Save galaxy list to csv file and send it
+                ascii.write(galaxies, "galaxy_list.csv", format="csv", overwrite=True,
+                            names=["GladeID", "RA", "Dec", "Dist", "Bmag", "Score", "Distance factor"])
+                send_mail(subject="[GW@Wise] {} Galaxy list".format(params["GraceID"]),
+                          text="{} GCN/LVC alert galaxy list is attached.".format(filename),
+                          files=["galaxy_list.csv"],
+                          log=log)
+                journal.complete_stage(filename, "galaxy_email")
+
+            # Create Wise plan
+            timer.enter("plan")
+            if "plan" not in done:
+                wise.process_galaxy_list(galaxies, alertname=ivorn.split('/')[-1], ra_event=ra, dec_event=dec,
+                                         log=log)
+                journal.complete_stage(filename, "plan")
+        else:
+            # Tile the credible region
+            timer.enter("plan")
+            if "plan" not in done:
+                wise.process_tiles(skymap_path, alertname=ivorn.split('/')[-1], log=log)
+                journal.complete_stage(filename, "plan")
+        wise.record_plan_latency("full", time.perf_counter() - timer.started, log)
+    finally:
+        unshare_skymap(skymap_path)
 
-    # Finish and delete logger
     log.info("Done.")
-    close_log(log)
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import numpy as np
+from configparser import ConfigParser
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    alert TEXT PRIMARY KEY,
+    payload BLOB,
+    params TEXT,
+    status TEXT,
+    attempts INTEGER,
+    error TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    alert TEXT,
+    stage TEXT,
+    artifact TEXT,
+    updated REAL,
+    PRIMARY KEY (alert, stage)
+);
+"""
+
+
+def _get(option, default):
+    return config.get('JOURNAL', option) if config.has_option('JOURNAL', option) else default
+
+
+def get_journal_path():
+    """Returns the path to the journal SQLite database defined in config.ini (empty - the journal is disabled)"""
+    return _get('PATH', '').strip()
+
+
+def is_enabled():
+    return get_journal_path() != ''
+
+
+def _connect():
+    # a connection per call: the journal is written by the forked workers too
+    conn = sqlite3.connect(get_journal_path(), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_artifact_path(alert, name):
+    """Returns the path of a checkpointed artifact file of an alert, next to the journal database"""
+    return os.path.join(os.path.dirname(os.path.abspath(get_journal_path())), f"{alert}_{name}")
+
+
+def begin_alert(alert, payload, params):
+    """
+    Records that the processing of an alert started (or resumed).
+
+    :param alert: alert ID (the VOEvent ivorn fragment)
+    :param payload: VOEvent XML (bytes)
+    :param params: VOEvent parameters
+    :return: dictionary of the completed stages -> their artifacts (empty if the journal is disabled)
+    """
+    if not is_enabled():
+        return {}
+
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO alerts VALUES (?, ?, ?, 'running', 0, NULL, ?)",
+                         (alert, payload, json.dumps(params, default=str), time.time()))
+            conn.execute("UPDATE alerts SET status='running', attempts=attempts+1, updated=? WHERE alert=?",
+                         (time.time(), alert))
+        rows = conn.execute("SELECT stage, artifact FROM stages WHERE alert=?", (alert,)).fetchall()
+    finally:
+        conn.close()
+    return {stage: json.loads(artifact) for stage, artifact in rows}
+
+
+def complete_stage(alert, stage, artifact=None):
+    """
+    Checkpoints a completed stage of an alert, so it is not redone if the alert is resumed.
+
+    :param alert: alert ID
+    :param stage: stage name
+    :param artifact: JSON-serializable result of the stage (e.g. the paths of the files it wrote)
+    """
+    if not is_enabled():
+        return
+
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?)",
+                         (alert, stage, json.dumps(artifact), time.time()))
+    finally:
+        conn.close()
+
+
+def finish_alert(alert, error=None):
+    """Records that the processing of an alert ended: done, or failed with an error"""
+    if not is_enabled():
+        return
+
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("UPDATE alerts SET status=?, error=?, updated=? WHERE alert=?",
+                         ("done" if error is None else "failed", None if error is None else repr(error),
+                          time.time(), alert))
+    finally:
+        conn.close()
+
+
+def pending_alerts(include_failed=True, max_attempts=None):
+    """
+    Returns the alerts whose processing was interrupted (e.g. by a crash or a restart of the listener), or failed.
+
+    :param include_failed: include the alerts that failed with an exception
+    :param max_attempts: skip the alerts already attempted this many times (default: JOURNAL/MAX_ATTEMPTS in
+                         config.ini)
+    :return: list of (alert ID, payload, params)
+    """
+    if not is_enabled():
+        return []
+    if max_attempts is None:
+        max_attempts = int(_get('MAX_ATTEMPTS', '3'))
+
+    statuses = ("running", "failed") if include_failed else ("running",)
+    conn = _connect()
+    try:
+        rows = conn.execute(f"SELECT alert, payload, params FROM alerts WHERE status IN "
+                            f"({', '.join('?' * len(statuses))}) AND attempts < ? ORDER BY updated",
+                            statuses + (max_attempts,)).fetchall()
+    finally:
+        conn.close()
+    return [(alert, bytes(payload), json.loads(params)) for alert, payload, params in rows]
+
+
+def resume_alerts(dispatch, include_failed=True, log=None):
+    """
+    Resumes the interrupted and failed alerts from their last completed stage (up to JOURNAL/MAX_ATTEMPTS attempts).
+
+    :param dispatch: function(payload, params) processing an alert (e.g. workers.dispatch_alert)
+    :param include_failed: also retry the alerts that failed with an exception
+    :param log: logger
+    :return: number of alerts resumed
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    alerts = pending_alerts(include_failed)
+    for alert, payload, params in alerts:
+        log.info(f"Resuming the processing of alert {alert}.")
+        dispatch(payload, params)
+    return len(alerts)
+
+
+def get_alert(alert):
+    """
+    Returns the journal record of an alert.
+
+    :param alert: alert ID
+    :return: parameters (see voevent.parse_voevent), status and dictionary of the completed stages -> their artifacts
+             (None if the alert is not in the journal, or the journal is disabled)
+    """
+    if not is_enabled():
+        return None
+
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT params, status FROM alerts WHERE alert=?", (alert,)).fetchone()
+        stages = conn.execute("SELECT stage, artifact FROM stages WHERE alert=?", (alert,)).fetchall()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return json.loads(row[0]), row[1], {stage: json.loads(artifact) for stage, artifact in stages}
+
+
+def save_array(alert, name, array):
+    """Checkpoints an array (e.g. the galaxy list) as a .npy file, returns its path"""
+    path = get_artifact_path(alert, name + ".npy")
+    np.save(path, array)
+    return path
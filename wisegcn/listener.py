@@ -0,0 +1,217 @@
+import asyncio
+import datetime
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import fromstring, ParseError
+from xml.sax.saxutils import escape
+from configparser import ConfigParser
+from wisegcn.voevent import get_root, parse_voevent, extract_params
+from wisegcn import metrics
+
+try:
+    from confluent_kafka import Consumer
+except ImportError:
+    Consumer = None
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+# processes the alerts one at a time, off the event loop (so heartbeats are answered meanwhile)
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="alert")
+_tasks = set()
+
+
+def _get(option, default):
+    return config.get('LISTENER', option) if config.has_option('LISTENER', option) else default
+
+
+def get_listener_mode():
+    """Returns the listener mode defined in config.ini: pygcn (default), voevent or kafka"""
+    return _get('MODE', 'pygcn').strip().lower()
+
+
+def _packet(message):
+    """VOEvent Transport Protocol packet: 4-byte big-endian length, followed by the message"""
+    return struct.pack("!I", len(message)) + message
+
+
+def _form_response(role, origin, response):
+    timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            f'<trn:Transport role="{role}" version="1.0" '
+            'xmlns:trn="http://telescope-networks.org/schema/Transport/v1.1" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            'xsi:schemaLocation="http://telescope-networks.org/schema/Transport/v1.1 '
+            'http://telescope-networks.org/schema/Transport-v1.1.xsd">'
+            f'<Origin>{escape(origin)}</Origin>'
+            f'<Response>{escape(response)}</Response>'
+            f'<TimeStamp>{timestamp}</TimeStamp>'
+            '</trn:Transport>').encode("utf-8")
+
+
+def _process(payload, params, log):
+    from wisegcn.workers import dispatch_alert
+    try:
+        dispatch_alert(payload, params)
+    except Exception as e:
+        log.exception(f"Failed to process {params['ivorn']}: {e!r}")
+
+
+def _done(task):
+    _tasks.discard(task)
+    metrics.inc("wisegcn_queue_depth", -1, queue="listener")
+
+
+def on_voevent(payload, log):
+    """
+    Filters a VOEvent with the fast path parser, and hands over the relevant LVC notices for processing (in the
+    background). Irrelevant notices are dropped after reading only their first elements.
+
+    :param payload: VOEvent XML (bytes)
+    :param log: logger
+    :return: VOEvent parameters, or None if the VOEvent was filtered out
+    """
+    from wisegcn.handler import get_role, LVC_NOTICE_TYPES
+
+    role = get_role()
+    params = parse_voevent(payload, roles=[role], notice_types=LVC_NOTICE_TYPES)
+    if params is None:
+        log.debug("Ignored notice.")
+        # only the root element, and the first parameters up to Packet_Type, are read again
+        reason = "role" if get_root(payload)[1].get('role') != role else "notice_type"
+        notice_type = (extract_params(payload, {"Packet_Type"}) or {}).get("Packet_Type", "other")
+        metrics.inc("wisegcn_notices_received_total", type=notice_type)
+        metrics.inc("wisegcn_notices_filtered_total", reason=reason)
+        return None
+
+    log.info(f"Received {params['ivorn']}.")
+    metrics.inc("wisegcn_notices_received_total", type=params['Packet_Type'])
+    metrics.inc("wisegcn_queue_depth", queue="listener")
+    task = asyncio.get_running_loop().run_in_executor(_executor, _process, payload, params, log)
+    _tasks.add(task)
+    task.add_done_callback(_done)
+    return params
+
+
+async def _serve_voevent(reader, writer, ivorn, timeout, log):
+    while True:
+        # the server sends an iamalive message every minute
+        header = await asyncio.wait_for(reader.readexactly(4), timeout)
+        length, = struct.unpack("!I", header)
+        payload = await asyncio.wait_for(reader.readexactly(length), timeout)
+
+        tag, attrib = get_root(payload)
+        if tag == "Transport":
+            if attrib.get('role') == 'iamalive':
+                try:
+                    origin = fromstring(payload).findtext("{*}Origin", default="")
+                except ParseError:
+                    origin = ""
+                writer.write(_packet(_form_response("iamalive", origin, ivorn)))
+                await writer.drain()
+                log.debug("Received iamalive, replied iamalive.")
+            continue
+        elif tag != "VOEvent":
+            log.warning(f"Received an unknown message ({tag}), ignoring.")
+            continue
+
+        # acknowledge before processing
+        writer.write(_packet(_form_response("ack", attrib.get('ivorn', ''), ivorn)))
+        await writer.drain()
+        on_voevent(payload, log)
+
+
+async def listen_voevent(host=None, port=None, ivorn=None, log=None):
+    """
+    Listens to a VOEvent Transport Protocol server (e.g. GCN) with asyncio, reconnecting with exponential back-off.
+
+    :param host: server host (default: LISTENER/HOST in config.ini)
+    :param port: server port (default: LISTENER/PORT in config.ini)
+    :param ivorn: client IVORN (default: LISTENER/IVORN in config.ini)
+    :param log: logger
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+    if host is None:
+        host = _get('HOST', '45.58.43.186')
+    if port is None:
+        port = int(_get('PORT', '8099'))
+    if ivorn is None:
+        ivorn = _get('IVORN', 'ivo://python_voeventclient/anonymous')
+    timeout = float(_get('TIMEOUT', '90'))
+
+    backoff = 1
+    while True:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.error(f"Failed to connect to {host}:{port} ({e!r}), retrying in {backoff} s...")
+            await asyncio.sleep(backoff)
+            backoff = min(2 * backoff, 64)
+            continue
+
+        log.info(f"Connected to {host}:{port}.")
+        backoff = 1
+        try:
+            await _serve_voevent(reader, writer, ivorn, timeout, log)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError) as e:
+            log.error(f"Connection to {host}:{port} lost ({e!r}), reconnecting...")
+        finally:
+            writer.close()
+
+
+async def listen_kafka(servers=None, topics=None, group_id=None, log=None):
+    """
+    Consumes VOEvents from a Kafka broker (e.g. GCN Kafka, or a local stand-in broker for testing).
+
+    :param servers: bootstrap servers (default: LISTENER/KAFKA_SERVER in config.ini)
+    :param topics: list of topics (default: LISTENER/KAFKA_TOPICS in config.ini)
+    :param group_id: consumer group ID (default: LISTENER/KAFKA_GROUP in config.ini)
+    :param log: logger
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+    if Consumer is None:
+        raise ImportError("Kafka input requires confluent-kafka (pip install confluent-kafka).")
+    if servers is None:
+        servers = _get('KAFKA_SERVER', 'localhost:9092')
+    if topics is None:
+        topics = [topic.strip() for topic in _get('KAFKA_TOPICS', '').split(',') if topic.strip()]
+    if group_id is None:
+        group_id = _get('KAFKA_GROUP', 'wisegcn')
+
+    consumer = Consumer({'bootstrap.servers': servers, 'group.id': group_id, 'auto.offset.reset': 'latest'})
+    consumer.subscribe(topics)
+    log.info(f"Subscribed to {', '.join(topics)} at {servers}.")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            message = await loop.run_in_executor(None, consumer.poll, 1.0)
+            if message is None:
+                continue
+            if message.error():
+                log.error(f"Kafka error: {message.error()}")
+                continue
+            on_voevent(message.value(), log)
+    finally:
+        consumer.close()
+
+
+def listen(mode=None, log=None):
+    """
+    Runs the asyncio listener (until interrupted or killed).
+
+    :param mode: voevent or kafka (default: LISTENER/MODE in config.ini)
+    :param log: logger
+    """
+    if mode is None:
+        mode = get_listener_mode()
+
+    if mode == "voevent":
+        asyncio.run(listen_voevent(log=log))
+    elif mode == "kafka":
+        asyncio.run(listen_kafka(log=log))
+    else:
+        raise ValueError(f"Unknown listener mode '{mode}' (available: voevent, kafka).")
@@ -0,0 +1,159 @@
+import os
+import json
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import numpy as np
+from configparser import ConfigParser
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s [%(filename)s:%(lineno)s]: %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# running queue listeners: alert ID -> listener, and its queue handler on the alert logger
+_listeners = {}
+
+
+def _get(option, default):
+    return config.get('LOG', option) if config.has_option('LOG', option) else default
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single-line JSON object, with the alert ID and processing stage"""
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record, DATE_FORMAT),
+                 "level": record.levelname,
+                 "alert": getattr(record, "alert", None),
+                 "stage": getattr(record, "stage", None),
+                 "message": record.getMessage(),
+                 "file": record.filename,
+                 "line": record.lineno}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts the records on a bounded queue without formatting them: the message is merged with its arguments by the
+    listener thread. When the queue is full, the record is dropped (and counted) rather than blocking the alert.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AlertFilter(logging.Filter):
+    """Passes only the records of one alert (see init_log)"""
+
+    def __init__(self, alert):
+        super().__init__()
+        self.alert = alert
+
+    def filter(self, record):
+        return getattr(record, "alert", None) == self.alert
+
+
+def init_log(filename="log.log"):
+    """
+    Starts logging an alert: records are queued, and written to the console and to a JSON lines log file by a
+    listener thread. All the alerts share one logger, the handlers are per alert (selected by the alert ID).
+
+    :param filename: alert ID, also the log file name (without the .log extension)
+    :return: logger adapter, carrying the alert ID and processing stage (see set_stage)
+    """
+    log_path = config.get('LOG', 'PATH')  # log file path
+    console_log_level = logging.getLevelName(config.get('LOG', 'CONSOLE_LEVEL'))  # logging level
+    file_log_level = logging.getLevelName(config.get('LOG', 'FILE_LEVEL'))  # logging level
+
+    # create log folder
+    if not os.path.exists(log_path):
+        os.makedirs(log_path)
+
+    logger = logging.getLogger(__name__)
+    log = logging.LoggerAdapter(logger, {"alert": filename, "stage": None})
+    close_log(log)
+    # records below both handler levels are discarded before they are queued
+    logger.setLevel(min(console_log_level, file_log_level))
+    logger.propagate = False
+
+    # console handler
+    console = logging.StreamHandler()
+    console.setLevel(console_log_level)
+    console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", DATE_FORMAT))
+
+    # log file handler
+    file = logging.FileHandler(log_path + filename + ".log", "w", encoding=None, delay=True)
+    file.setLevel(file_log_level)
+    if _get('FORMAT', 'json').strip().lower() == 'json':
+        file.setFormatter(JsonFormatter())
+    else:
+        file.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+
+    q = queue.Queue(maxsize=int(_get('QUEUE_SIZE', '10000')))
+    listener = QueueListener(q, console, file, respect_handler_level=True)
+    listener.start()
+    handler = BoundedQueueHandler(q)
+    handler.addFilter(AlertFilter(filename))
+    logger.addHandler(handler)
+    _listeners[filename] = listener, handler
+
+    return log
+
+
+def set_stage(log, stage):
+    """Sets the processing stage reported in the log records of an alert logger (see init_log)"""
+    if isinstance(log, logging.LoggerAdapter):
+        log.extra["stage"] = stage
+
+
+def close_log(log):
+    """Stops the alert's listener thread (writing out the queued records), and closes its handlers"""
+    if not isinstance(log, logging.LoggerAdapter) or log.extra["alert"] not in _listeners:
+        return
+    listener, handler = _listeners.pop(log.extra["alert"])
+    log.logger.removeHandler(handler)
+    listener.stop()
+
+    if handler.dropped > 0:
+        record = log.logger.makeRecord(log.logger.name, logging.WARNING, __file__, 0,
+                                       f"Log queue was full, dropped {handler.dropped} records.", None, None)
+        for target in listener.handlers:
+            target.handle(record)
+    handler.close()
+    for h in listener.handlers:
+        h.flush()
+        h.close()
+
+
+def dump_table(log, name, columns):
+    """
+    Writes a per-target debug table to a separate columnar dump (.npz, one array per column) next to the alert log,
+    instead of a line per target in the log. Only done if the logger is enabled for DEBUG.
+
+    :param log: logger (see init_log)
+    :param name: table name, appended to the alert ID in the file name
+    :param columns: dictionary of column name -> array
+    :return: path to the dump file, or None
+    """
+    if not log.isEnabledFor(logging.DEBUG):
+        return None
+
+    alert = log.extra["alert"] if isinstance(log, logging.LoggerAdapter) else "log"
+    filename = config.get('LOG', 'PATH') + f"{alert}_{name}.npz"
+    np.savez(filename, **{key: np.asarray(value) for key, value in columns.items()})
+    log.debug(f"Wrote the {name} table ({len(next(iter(columns.values())))} rows) to {filename}.")
+    return filename
@@ -0,0 +1,174 @@
+import os
+import numpy as np
+from collections import namedtuple
+from scipy.special import gammainc, gammaincc, gamma
+from configparser import ConfigParser
+from wisegcn import magnitudes as mag
+from wisegcn.catalog import get_catalog_path, load_catalog, column
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+# Schechter luminosity function tables, tabulated on an absolute magnitude grid:
+# brighter_fraction[i] is the fraction of the luminosity density in galaxies brighter than abs_mag[i],
+# cutoff_level[i] is the completeness level (as used by find_galaxy_list) whose magnitude cutoff is abs_mag[i]
+LuminosityTable = namedtuple("LuminosityTable", ["abs_mag", "brighter_fraction", "cutoff_level"])
+
+_tables = {}
+
+
+def get_luminosity_table(alpha, mb_star, mag_min=-30, mag_max=-5, step=1e-3):
+    """
+    Returns the (cached) luminosity function table of a Schechter function.
+
+    :param alpha: Schechter function faint-end slope
+    :param mb_star: Schechter function characteristic absolute magnitude
+    :param mag_min: brightest tabulated absolute magnitude
+    :param mag_max: faintest tabulated absolute magnitude
+    :param step: magnitude grid step
+    :return: LuminosityTable
+    """
+    key = (alpha, mb_star, mag_min, mag_max, step)
+    if key not in _tables:
+        abs_mag = np.arange(mag_min, mag_max + step, step)
+        brighter_fraction = gammaincc(alpha + 2, 10 ** (-(abs_mag - mb_star) / 2.5))
+        cutoff_level = gammainc(alpha + 2, 10 ** ((abs_mag - mb_star) / 2.5))
+        # keep the strictly increasing part, for interpolation
+        keep = np.concatenate(([True], np.diff(cutoff_level) > 0))
+        _tables[key] = LuminosityTable(abs_mag[keep], brighter_fraction[keep], cutoff_level[keep])
+    return _tables[key]
+
+
+def brighter_fraction(table, abs_mag):
+    """Fraction of the luminosity density in galaxies brighter than abs_mag"""
+    return np.interp(abs_mag, table.abs_mag, table.brighter_fraction)
+
+
+def cutoff_magnitude(table, level):
+    """Absolute magnitude cutoff of a completeness level (+inf if level is 1, nan if level > 1)"""
+    cutoff = np.interp(level, table.cutoff_level, table.abs_mag, right=np.inf)
+    return np.where(np.asarray(level) > 1, np.nan, cutoff)
+
+
+def completeness_sequence(completeness, max_completeness=0.9):
+    """The completeness levels to try: halve the incompleteness until reaching max_completeness"""
+    sequence = [completeness]
+    while sequence[-1] < max_completeness:
+        sequence.append(sequence[-1] + (1 - sequence[-1]) / 2)
+    return np.array(sequence)
+
+
+def completeness_cutoff(abs_mag, alpha, mb_star, completeness, min_galaxies, max_completeness=0.9):
+    """
+    Finds the absolute magnitude cutoff keeping the galaxies that make up the given completeness of the luminosity
+    in the field, relaxing the completeness (see completeness_sequence) until at least min_galaxies galaxies are kept.
+
+    :param abs_mag: absolute magnitudes of the galaxies in the field
+    :param alpha: Schechter function faint-end slope
+    :param mb_star: Schechter function characteristic absolute magnitude
+    :param completeness: initial completeness
+    :param min_galaxies: minimal number of galaxies to keep
+    :param max_completeness: if even this completeness doesn't keep enough galaxies, don't cut
+    :return: magnitude cutoff (keep abs_mag < cutoff), or None if there is no cut, and the completeness used
+    """
+    abs_mag = np.sort(abs_mag)
+    brightest_mag = abs_mag[0]
+    if brightest_mag - mb_star > 0 or len(abs_mag) < min_galaxies:
+        # the brightest galaxy is fainter than the cutoff brightness, or there are not enough galaxies anyway
+        return None, 1
+
+    table = get_luminosity_table(alpha, mb_star)
+
+    # there are no galaxies brighter than this in the field, so don't count that part of the Schechter function
+    missing_piece = brighter_fraction(table, brightest_mag)
+
+    sequence = completeness_sequence(completeness, max_completeness)
+    levels = sequence + missing_piece
+
+    # at least min_galaxies are brighter than the cutoff once the level exceeds the level of the
+    # min_galaxies-th brightest galaxy
+    n = int(np.ceil(min_galaxies))
+    threshold = np.interp(abs_mag[n - 1], table.abs_mag, table.cutoff_level) if n > 0 else -np.inf
+    k = np.searchsorted(levels, threshold, side="right")
+
+    if k == len(levels) or levels[k] > 1:
+        # not enough galaxies, take all of them
+        return None, 1
+
+    return float(cutoff_magnitude(table, levels[k])), sequence[k]
+
+
+def get_completeness_path(cat_file=None):
+    """Returns the path to the distance-shell completeness table, stored next to the catalog"""
+    if cat_file is None:
+        cat_file = get_catalog_path()
+    return cat_file[:-len('.npy')] + '_completeness.npy' if cat_file.endswith('.npy') else \
+        cat_file + '_completeness.npy'
+
+
+def build_completeness_table(cat_file=None, shell_width=None, alpha=None, mb_star=None, phi_star=None):
+    """
+    Computes the catalog's B-band luminosity completeness in distance shells (the catalog's luminosity density
+    relative to the Schechter function's), and saves it next to the catalog.
+
+    :param cat_file: path to the catalog .npy file (default: taken from config.ini)
+    :param shell_width: distance shell width [Mpc] (default: GALAXIES/COMPLETENESS_SHELL in config.ini)
+    :param alpha: Schechter function faint-end slope (default: GALAXIES/ALPHA in config.ini)
+    :param mb_star: Schechter function characteristic absolute magnitude (default: GALAXIES/MB_STAR in config.ini)
+    :param phi_star: Schechter function normalization [Mpc^-3] (default: GALAXIES/PHI_STAR in config.ini)
+    :return: path to the completeness table file
+    """
+    if cat_file is None:
+        cat_file = get_catalog_path()
+    if shell_width is None:
+        shell_width = config.getfloat('GALAXIES', 'COMPLETENESS_SHELL')
+    if alpha is None:
+        alpha = config.getfloat('GALAXIES', 'ALPHA')
+    if mb_star is None:
+        mb_star = config.getfloat('GALAXIES', 'MB_STAR')
+    if phi_star is None:
+        phi_star = config.getfloat('GALAXIES', 'PHI_STAR')
+
+    galaxy_cat = load_catalog(cat_file)
+    d = column(galaxy_cat, "dist")
+    bmag = column(galaxy_cat, "bmag")
+    good = (d > 0) & ~np.isnan(bmag)
+    d, bmag = d[good], bmag[good]
+    luminosity = mag.L_nu_from_magAB(bmag - 5 * np.log10(d * 1e5))
+
+    edges = np.arange(0, d.max() + shell_width, shell_width)
+    observed, edges = np.histogram(d, bins=edges, weights=luminosity)
+    volume = 4 / 3 * np.pi * (edges[1:] ** 3 - edges[:-1] ** 3)
+    expected = phi_star * mag.L_nu_from_magAB(mb_star) * gamma(alpha + 2)
+    completeness = np.minimum(observed / volume / expected, 1)
+
+    completeness_file = get_completeness_path(cat_file)
+    np.save(completeness_file, np.vstack((edges[:-1], edges[1:], completeness)))
+    return completeness_file
+
+
+def load_completeness_table(cat_file=None):
+    """Returns the distance-shell completeness table (shell lower edges, upper edges and completeness), building it
+    if it doesn't exist or is outdated"""
+    if cat_file is None:
+        cat_file = get_catalog_path()
+
+    completeness_file = get_completeness_path(cat_file)
+    if not os.path.exists(completeness_file) or os.path.getmtime(completeness_file) < os.path.getmtime(cat_file):
+        build_completeness_table(cat_file)
+    return np.load(completeness_file)
+
+
+def completeness_weights(d, cat_file=None, min_completeness=0.01):
+    """
+    Per-galaxy completeness weights: a catalogued galaxy also stands for the missing luminosity of its distance
+    shell, so it is weighted by 1/completeness of its shell (at most 1/min_completeness).
+
+    :param d: galaxy distances [Mpc]
+    :param cat_file: path to the catalog .npy file (default: taken from config.ini)
+    :param min_completeness: minimal completeness to consider
+    :return: weights
+    """
+    d_lo, d_hi, completeness = load_completeness_table(cat_file)
+    shell = np.clip(np.searchsorted(d_hi, d, side="left"), 0, len(d_hi) - 1)
+    return 1 / np.maximum(completeness[shell], min_completeness)
@@ -0,0 +1,282 @@
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from configparser import ConfigParser
+from wisegcn.logger import set_stage
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+# latency histogram bucket upper bounds [s]
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# name -> type, help
+METRICS = {
+    "wisegcn_notices_received_total": ("counter", "Notices received, by notice type."),
+    "wisegcn_notices_filtered_total": ("counter", "Notices filtered out, by reason."),
+    "wisegcn_stage_seconds": ("histogram", "Alert processing latency, by stage."),
+    "wisegcn_alert_seconds": ("histogram", "Alert processing latency, from the first stage to the last."),
+    "wisegcn_plan_latency_seconds": ("histogram", "Latency from the alert to the plan, by phase (quick, full)."),
+    "wisegcn_latency_budget_exceeded_total": ("counter", "Plans that exceeded the latency budget, by phase."),
+    "wisegcn_skymap_bytes": ("gauge", "Size of the last sky map FITS file."),
+    "wisegcn_skymap_nside": ("gauge", "HEALPix nside of the last sky map."),
+    "wisegcn_galaxies_scored_total": ("counter", "Galaxies scored."),
+    "wisegcn_targets_planned_total": ("counter", "Targets planned, by telescope."),
+    "wisegcn_failures_total": ("counter", "Failures, by component (db, smtp, upload)."),
+    "wisegcn_queue_depth": ("gauge", "Alerts waiting or being processed, by queue."),
+}
+
+_lock = threading.Lock()
+_values = {}  # (name, labels) -> value, or histogram bucket counts followed by the sum and count
+_owner = os.getpid()  # the process serving the metrics
+_updates = None  # updates from the forked workers to the owner
+_server = None
+
+
+def _get(option, default):
+    return config.get('METRICS', option) if config.has_option('METRICS', option) else default
+
+
+def _apply(op, name, labels, value):
+    key = (name, labels)
+    with _lock:
+        if op == "inc":
+            _values[key] = _values.get(key, 0) + value
+        elif op == "set":
+            _values[key] = value
+        else:
+            h = _values.setdefault(key, [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+
+def _record(op, name, value, labels):
+    labels = tuple(sorted((key, str(label)) for key, label in labels.items()))
+    if _updates is not None and os.getpid() != _owner:
+        # forked worker: hand the update over to the process serving the metrics
+        _updates.put((op, name, labels, value))
+    else:
+        _apply(op, name, labels, value)
+
+
+def inc(name, value=1, **labels):
+    """Increments a counter (or gauge)"""
+    _record("inc", name, value, labels)
+
+
+def set_gauge(name, value, **labels):
+    """Sets a gauge"""
+    _record("set", name, value, labels)
+
+
+def observe(name, value, **labels):
+    """Adds an observation to a histogram"""
+    _record("observe", name, value, labels)
+
+
+class StageTimer:
+    """Times the processing stages of an alert into wisegcn_stage_seconds, and sets the logged stage (see
+    logger.set_stage)"""
+
+    def __init__(self, log=None):
+        self.log = log
+        self.stage = None
+        self.started = self.stage_started = time.perf_counter()
+
+    def enter(self, stage):
+        now = time.perf_counter()
+        if self.stage is not None:
+            observe("wisegcn_stage_seconds", now - self.stage_started, stage=self.stage)
+        self.stage, self.stage_started = stage, now
+        if self.log is not None:
+            set_stage(self.log, stage)
+
+    def stop(self):
+        """Times the last stage, and the whole alert"""
+        self.enter(None)
+        observe("wisegcn_alert_seconds", time.perf_counter() - self.started)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for key, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def render():
+    """Returns the metrics in the Prometheus text exposition format"""
+    with _lock:
+        items = sorted((key, list(value) if isinstance(value, list) else value) for key, value in _values.items())
+
+    lines = []
+    for name, (kind, text) in METRICS.items():
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), value in items:
+            if metric != name:
+                continue
+            if kind == "histogram":
+                for bound, count in zip(BUCKETS + ("+Inf",), value[:-2] + value[-1:]):
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(filename):
+    """Writes the metrics for the node exporter's textfile collector (atomically)"""
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(render())
+    os.replace(tmp_filename, filename)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _collect(textfile, interval, log):
+    last_write = 0
+    while True:
+        try:
+            _apply(*_updates.get(timeout=interval))
+        except queue.Empty:
+            pass
+        if textfile and time.monotonic() - last_write >= interval:
+            try:
+                write_textfile(textfile)
+            except OSError as e:
+                log.error(f"Failed to write the metrics to {textfile}: {e}")
+            last_write = time.monotonic()
+
+
+def start_metrics(port=None, address=None, textfile=None, log=None):
+    """
+    Serves the metrics over HTTP (scrape http://address:port/metrics) and/or writes them periodically to a textfile.
+    Call before forking the workers (see workers.init_pool), so their updates reach this process.
+
+    :param port: HTTP port (default: METRICS/PORT in config.ini, 0 to disable)
+    :param address: HTTP address (default: METRICS/ADDRESS in config.ini)
+    :param textfile: textfile collector file (default: METRICS/TEXTFILE in config.ini, empty to disable)
+    :param log: logger
+    :return: HTTP server, or None
+    """
+    global _owner, _updates, _server
+
+    if log is None:
+        log = logging.getLogger(__name__)
+    if port is None:
+        port = int(_get('PORT', '0'))
+    if address is None:
+        address = _get('ADDRESS', '127.0.0.1')
+    if textfile is None:
+        textfile = _get('TEXTFILE', '')
+
+    if not port and not textfile:
+        return None
+
+    _owner = os.getpid()
+    _updates = multiprocessing.get_context("fork").Queue()
+    threading.Thread(target=_collect, args=(textfile, float(_get('INTERVAL', '15')), log),
+                     name="metrics-collector", daemon=True).start()
+
+    if port:
+        _server = ThreadingHTTPServer((address, port), _Handler)
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        log.info(f"Serving metrics at http://{address}:{port}/metrics.")
+    if textfile:
+        log.info(f"Writing metrics to {textfile}.")
+    return _server
+
+
+def check_metrics():
+    """
+    Self-check of the exposition: records sample metrics, serves them on an ephemeral port, scrapes /metrics and checks
+    the response (headers, the body against render, the sample line syntax and the cumulative histogram buckets).
+
+    :return: list of problems found (empty if none)
+    """
+    inc("wisegcn_notices_received_total", type="check")
+    inc("wisegcn_notices_filtered_total", reason='quote " backslash \\ newline \n')
+    set_gauge("wisegcn_skymap_nside", 512)
+    for value in (0.05, 3, 1000):
+        observe("wisegcn_stage_seconds", value, stage="check")
+
+    problems = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-check", daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(url + "/metrics", timeout=10) as response:
+            status, content_type, body = response.status, response.headers["Content-Type"], response.read().decode()
+        try:
+            urllib.request.urlopen(url + "/other", timeout=10)
+            problems.append("/other did not return 404")
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                problems.append(f"/other returned {e.code} instead of 404")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if status != 200:
+        problems.append(f"/metrics returned {status}")
+    if not content_type.startswith("text/plain; version=0.0.4"):
+        problems.append(f"unexpected Content-Type: {content_type}")
+    if body != render():
+        problems.append("the scraped body differs from render()")
+
+    buckets = {}
+    for line in body.splitlines():
+        if line.startswith("#"):
+            if line.split()[1] not in ("HELP", "TYPE") or line.split()[2] not in METRICS:
+                problems.append(f"bad comment line: {line}")
+            continue
+        name, _, value = line.rpartition(" ")
+        metric = name.split("{")[0]
+        if metric.rsplit("_", 1)[0] not in METRICS and metric not in METRICS:
+            problems.append(f"unknown metric: {line}")
+        if "{" in name and not name.endswith("}"):
+            problems.append(f"bad labels: {line}")
+        try:
+            float(value)
+        except ValueError:
+            problems.append(f"bad value: {line}")
+            continue
+        if metric == "wisegcn_stage_seconds_bucket" and 'stage="check"' in name:
+            buckets[name.split('le="')[1].split('"')[0]] = float(value)
+
+    counts = [buckets.get(str(bound)) for bound in BUCKETS + ("+Inf",)]
+    if None in counts or counts != sorted(counts) or counts[0] != 1 or counts[-1] != 3:
+        problems.append(f"bad histogram buckets: {buckets}")
+    return problems
+
+
+if __name__ == '__main__':
+    found = check_metrics()
+    print("\n".join(found) if found else "Metrics exposition OK.")
+    raise SystemExit(1 if found else 0)
@@ -1,6 +1,7 @@
 import pymysql.cursors
 from configparser import ConfigParser
 import logging
+from wisegcn import metrics
 
 
 def connect():
@@ -28,8 +29,9 @@ def insert_values(table, dict_to_insert, log=None):
         cursor.execute(query)
         conn.commit()
         cursor.close()
-    except pymysql.err.InternalError as e:
-        code, msg = e.args
+    except pymysql.err.MySQLError as e:
+        code, msg = (e.args[0], e.args[-1]) if len(e.args) > 1 else (None, e)
+        metrics.inc("wisegcn_failures_total", component="db")
         log.error("Failed to insert values into table {}.".format(table))
         log.error("Error code = {}".format(code))
         log.error(msg)
@@ -49,8 +51,9 @@ def get_columns(table, log=None):
         col = cursor.fetchall()
         cursor.close()
         cols = [x['COLUMN_NAME'] for x in col if 'COLUMN_NAME' in x]
-    except pymysql.err.InternalError as e:
-        code, msg = e.args
+    except pymysql.err.MySQLError as e:
+        code, msg = (e.args[0], e.args[-1]) if len(e.args) > 1 else (None, e)
+        metrics.inc("wisegcn_failures_total", component="db")
         log.error("Failed to retrieve columns from table {}.".format(table))
         log.error("Error code = {}".format(code))
         log.error(msg)
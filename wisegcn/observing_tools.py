@@ -1,7 +1,13 @@
-from astropy.coordinates import SkyCoord, EarthLocation, AltAz, get_sun, get_moon
+from astropy.coordinates import SkyCoord, EarthLocation, AltAz, Angle, GCRS, TETE, get_sun, get_moon
 from astropy import units as u
 from astropy.time import Time
 import numpy as np
+import logging
+
+SIDEREAL_RATE = 1.0027379  # sidereal hours per solar hour
+LST_STEP = 10 / (24 * 60)  # [day] LST table step
+LST_TOLERANCE = 1e-3  # [arcsec] LST table interpolation tolerance
+MOON_STEP = 0.5  # [hr] Moon ephemeris step of the visibility windows, interpolated in between
 
 
 def change_iers_url(url="http://maia.usno.navy.mil/ser7/finals2000A.all"):
@@ -50,73 +56,350 @@ def next_sunrise(lat, lon, alt, t=Time.now(), sun_alt_twilight=-12*u.deg):
     return t_vec[sunrise_idx]
 
 
+_locations = {}
+_lst_tables = {}  # (longitude [deg], night) -> table times [day from the start of the night], LST [hr]
+
+
+def get_location(lat, lon, alt):
+    """Returns the site EarthLocation, built only once per site"""
+    key = (Angle(lat).deg, Angle(lon).deg, u.Quantity(alt, u.m).value)
+    if key not in _locations:
+        _locations[key] = EarthLocation(lat=lat, lon=lon, height=alt)
+    return _locations[key]
+
+
+def _lst_table(lon_deg, night):
+    """
+    Apparent LST over a night (from local noon to local noon) at LST_STEP, unwrapped so it can be interpolated. Built
+    once per site and night, and checked against astropy halfway between the samples, where the interpolation error is
+    largest.
+    """
+    key = (lon_deg, night)
+    if key not in _lst_tables:
+        if len(_lst_tables) >= 32:
+            _lst_tables.clear()
+        start = Time(night, -lon_deg / 360, format='jd', scale='utc')
+        offsets = np.arange(0, 1 + 2 * LST_STEP, LST_STEP)
+        lst = (start + offsets * u.day).sidereal_time('apparent', lon_deg * u.deg).hour
+        lst = lst[0] + np.concatenate(([0], np.cumsum(np.mod(np.diff(lst), 24))))
+
+        mid = offsets[:-1] + LST_STEP / 2
+        exact = (start + mid * u.day).sidereal_time('apparent', lon_deg * u.deg).hour
+        error = np.max(np.abs(np.mod(np.interp(mid, offsets, lst) - exact + 12, 24) - 12)) * 15 * 3600
+        if error > LST_TOLERANCE:
+            logging.getLogger(__name__).warning(f"LST table interpolation error is {error:.2g} arcsec.")
+
+        _lst_tables[key] = (offsets, lst)
+    return _lst_tables[key]
+
+
+def local_sidereal_time(lon, t=Time.now()):
+    """
+    Apparent local sidereal time at the times t, interpolated from a table per site and night (see _lst_table),
+    instead of computing the nutation at every time.
+
+    :param lon: site longitude
+    :param t: Time (scalar or array)
+    :return: LST Angle [hourangle], of the shape of t
+    """
+    lon_deg = Angle(lon).deg
+    t = t.utc
+    # the night starts at local noon: JD (from noon UT) shifted by the longitude
+    jd1 = np.atleast_1d(t.jd1) + lon_deg / 360
+    jd2 = np.atleast_1d(t.jd2)
+    night = np.floor(jd1 + jd2)
+    lst = np.empty(jd1.shape)
+    for n in np.unique(night):
+        offsets, table = _lst_table(lon_deg, n)
+        mask = night == n
+        lst[mask] = np.interp((jd1[mask] - n) + jd2[mask], offsets, table)
+    return Angle(np.mod(lst, 24).reshape(np.shape(t.jd1)) * u.hourangle)
+
+
+def next_transit(ra, lon, t=Time.now()):
+    """Next meridian transit times of N targets after t (from the LST table, see local_sidereal_time)"""
+    lst = local_sidereal_time(lon, t).to_value(u.hourangle)
+    ha = np.mod(np.atleast_1d(Angle(ra).to_value(u.hourangle)) - lst, 24)
+    return t + ha / SIDEREAL_RATE * u.hour
+
+
+def _grid(ra, dec, t):
+    """N targets (column) x M times (row)"""
+    obj = SkyCoord(ra=np.atleast_1d(ra)[:, np.newaxis], dec=np.atleast_1d(dec)[:, np.newaxis], frame='icrs')
+    t = t.reshape(1, -1) if t.ndim else t.reshape(1, 1)
+    return obj, t
+
+
+def lunar_distance_grid(ra, dec, lat, lon, alt, t=Time.now()):
+    """Lunar distance of N targets at M times, as an (N, M) array"""
+    obj, t = _grid(ra, dec, t)
+    moon = get_moon(t, location=get_location(lat, lon, alt))
+    return obj.separation(moon)
+
+
+def calc_airmass_grid(ra, dec, lat, lon, alt, t=Time.now()):
+    """Airmass (sec z) of N targets at M times, as an (N, M) array"""
+    obj, t = _grid(ra, dec, t)
+    obj_altaz = obj.transform_to(AltAz(obstime=t, location=get_location(lat, lon, alt)))
+    return obj_altaz.secz
+
+
+def calc_hourangle_grid(ra, lon, t=Time.now()):
+    """Hour angle (wrapped to [-12, 12) hr) of N targets at M times, as an (N, M) array"""
+    t = t.reshape(1, -1) if t.ndim else t.reshape(1, 1)
+    lst = local_sidereal_time(lon, t).to_value(u.hourangle)
+    ha = lst - np.atleast_1d(Angle(ra).to_value(u.hourangle))[:, np.newaxis]
+    return Angle(np.mod(ha + 12, 24) - 12, u.hourangle)
+
+
+def is_observable_grid(ra, dec, lat, lon, alt, t=Time.now(), ha_min=-4.6*u.hourangle, ha_max=4.6*u.hourangle,
+                       airmass_min=1.02, airmass_max=3, min_lunar_distance=30*u.deg, return_values=False):
+    """
+    Are N targets observable at M times?
+
+    :return: (N, M) boolean mask, and if return_values, (N, M) arrays of the airmass, hour angle [hr] and lunar
+             distance [deg] (-999 where not tested, as in is_observable)
+    """
+    airmass = calc_airmass_grid(ra, dec, lat, lon, alt, t)
+    ha = calc_hourangle_grid(ra, lon, t)
+    lunar_dist = lunar_distance_grid(ra, dec, lat, lon, alt, t)
+
+    airmass_ok = (airmass > airmass_min) & (airmass < airmass_max)
+    ha_ok = airmass_ok & (ha > ha_min) & (ha < ha_max)
+    observable = ha_ok & (lunar_dist >= min_lunar_distance)
+
+    if return_values:
+        return (observable, airmass, np.where(airmass_ok, ha.value, -999),
+                np.where(ha_ok, lunar_dist.value, -999))
+    else:
+        return observable
+
+
+def _unit_vectors(coord):
+    xyz = coord.cartesian.xyz.value
+    return xyz / np.linalg.norm(xyz, axis=0)
+
+
+def _hour_angle_limit(airmass, sin_lat, cos_lat, sin_dec, cos_dec):
+    """The hour angle [hr] at which the targets cross the airmass, and the cosine of that hour angle (> 1 if they
+    never reach that airmass, < -1 if they are always below it)"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos_h = (1 / airmass - sin_lat * sin_dec) / (cos_lat * cos_dec)
+    return np.rad2deg(np.arccos(np.clip(cos_h, -1, 1))) / 15, cos_h
+
+
+def _visibility(ra, dec, lat, lon, alt, t1, t2, ha_min, ha_max, airmass_min, airmass_max, min_lunar_distance):
+    """
+    Computes the visibility windows (see visibility_windows).
+
+    :return: start and end of the windows [hr from t1] (NaN if not observable), and a function returning the airmass,
+             hour angle [hr] and lunar distance [deg] of the targets at given times [hr from t1]
+    """
+    location = get_location(lat, lon, alt)
+    ra = np.atleast_1d(Angle(ra).deg)
+    dec = np.atleast_1d(Angle(dec).deg)
+    n = len(ra)
+    hours = max((t2 - t1).to_value(u.hour), 0)
+
+    # apparent (true equator and equinox) coordinates, to compare with the apparent LST
+    obj = SkyCoord(ra=ra*u.deg, dec=dec*u.deg, frame='icrs')
+    t_mid = t1 + hours / 2 * u.hour
+    apparent = obj.transform_to(TETE(obstime=t_mid, location=location))
+    ra_h = apparent.ra.to_value(u.hourangle)
+    sin_dec, cos_dec = np.sin(apparent.dec.rad), np.cos(apparent.dec.rad)
+    lat_rad = Angle(lat).rad
+    sin_lat, cos_lat = np.sin(lat_rad), np.cos(lat_rad)
+
+    # the hour angle at t1, and its range over the interval
+    h0 = np.mod(local_sidereal_time(lon, t1).to_value(u.hourangle) - ra_h + 12, 24) - 12
+    h_range = hours * SIDEREAL_RATE
+
+    # Moon directions at MOON_STEP (topocentric), interpolated linearly in between
+    knots = np.append(np.arange(0, hours, MOON_STEP), hours)
+    moon = _unit_vectors(get_moon(t1 + knots * u.hour, location=location))
+    target = _unit_vectors(obj.transform_to(GCRS(obstime=t_mid)))
+
+    def lunar_distance_at(hr):
+        hr = np.asarray(hr, dtype=float)
+        idx = np.clip(np.searchsorted(knots, hr, side='right') - 1, 0, max(len(knots) - 2, 0))
+        nxt = np.minimum(idx + 1, len(knots) - 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            f = np.where(nxt > idx, (hr - knots[idx]) / (knots[nxt] - knots[idx]), 0)
+        m = (1 - f) * moon[:, idx] + f * moon[:, nxt]
+        m /= np.linalg.norm(m, axis=0)
+        cos_dist = np.sum(m * target.reshape((3, n) + (1,) * (hr.ndim - 1)), axis=0)
+        return np.rad2deg(np.arccos(np.clip(cos_dist, -1, 1)))
+
+    def values_at(hr):
+        ha = np.mod(h0 + hr * SIDEREAL_RATE + 12, 24) - 12
+        sin_alt = sin_lat * sin_dec + cos_lat * cos_dec * np.cos(np.deg2rad(15 * ha))
+        with np.errstate(divide='ignore'):
+            airmass = 1 / sin_alt
+        return airmass, ha, lunar_distance_at(hr)
+
+    if hours == 0:
+        return np.full(n, np.nan), np.full(n, np.nan), values_at
+
+    # hour angle windows within the airmass limits, |h_low| < |h| < h_high (closed form), and the hour angle limits:
+    # the zenith is excluded above airmass_min, splitting the window in two
+    h_high, cos_h = _hour_angle_limit(airmass_max, sin_lat, cos_lat, sin_dec, cos_dec)
+    h_high[cos_h > 1] = -np.inf  # never reaches airmass_max
+    h_low, _ = _hour_angle_limit(airmass_min, sin_lat, cos_lat, sin_dec, cos_dec)
+    lo = Angle(ha_min).to_value(u.hourangle)
+    hi = Angle(ha_max).to_value(u.hourangle)
+    whole = h_low == 0
+    a = np.column_stack((np.maximum(-h_high, lo), np.where(whole, np.inf, np.maximum(h_low, lo))))
+    b = np.column_stack((np.where(whole, np.minimum(h_high, hi), np.minimum(-h_low, hi)), np.minimum(h_high, hi)))
+
+    # intersect with the hour angles over the interval (the windows of the next sidereal day too)
+    a = np.hstack((a, a + 24))
+    b = np.hstack((b, b + 24))
+    s = np.maximum(a, h0[:, np.newaxis])
+    e = np.minimum(b, (h0 + h_range)[:, np.newaxis])
+    valid = (a <= b) & (s <= e)
+    s = np.where(valid, (s - h0[:, np.newaxis]) / SIDEREAL_RATE, np.nan)
+    e = np.where(valid, (e - h0[:, np.newaxis]) / SIDEREAL_RATE, np.nan)
+
+    # the first time within each window far enough from the Moon: at the window start, or where the lunar distance
+    # crosses the limit, interpolated between the Moon knots
+    min_dist = Angle(min_lunar_distance).deg
+    s_filled = np.where(valid, s, 0)
+    e_filled = np.where(valid, e, 0)
+    ok_start = lunar_distance_at(s_filled) >= min_dist
+    ok_end = lunar_distance_at(e_filled) >= min_dist
+    ok_knots = lunar_distance_at(np.broadcast_to(knots, (n, len(knots)))) >= min_dist
+    inside = ((knots > s_filled[..., np.newaxis]) & (knots < e_filled[..., np.newaxis]) &
+              ok_knots[:, np.newaxis, :])
+    has_knot = inside.any(axis=-1)
+    first = np.argmax(inside, axis=-1)
+    p = np.where(has_knot, knots[first], e_filled)
+    prev_idx = np.where(has_knot, first, np.searchsorted(knots, e_filled, side='left')) - 1
+    prev = np.maximum(s_filled, knots[np.maximum(prev_idx, 0)])
+    d_prev = lunar_distance_at(prev)
+    d_p = lunar_distance_at(p)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        crossing = np.where(d_p > d_prev, prev + (min_dist - d_prev) / (d_p - d_prev) * (p - prev), p)
+    start = np.where(ok_start, s, np.where(has_knot | ok_end, np.clip(crossing, prev, p), np.nan))
+    start[~valid] = np.nan
+
+    # the earliest window
+    best = np.argmin(np.where(np.isnan(start), np.inf, start), axis=1)
+    rows = np.arange(n)
+    observable = ~np.isnan(start[rows, best])
+    return start[rows, best], np.where(observable, e[rows, best], np.nan), values_at
+
+
+def visibility_windows(ra, dec, lat, lon, alt, t1, t2, ha_min=-4.6*u.hourangle, ha_max=4.6*u.hourangle,
+                       airmass_min=1.02, airmass_max=3, min_lunar_distance=30*u.deg):
+    """
+    Analytic visibility windows of N targets between t1 and t2 (e.g. the evening and morning twilights), instead of
+    sampling the coordinate transforms: the rise and set times against the airmass and hour angle limits are closed
+    form (from the apparent declination, the latitude and the LST, see local_sidereal_time), intersected with the lunar
+    distance limit (from the Moon ephemeris at MOON_STEP, interpolated in between).
+
+    :return: the first time each target is observable, and the end of its airmass and hour angle window, as Times
+             (masked if not observable)
+    """
+    start, end, _ = _visibility(ra, dec, lat, lon, alt, t1, t2, ha_min, ha_max, airmass_min, airmass_max,
+                                min_lunar_distance)
+    observable = ~np.isnan(start)
+    t_start = t1 + np.where(observable, start, 0) * u.hour
+    t_end = t1 + np.where(observable, end, 0) * u.hour
+    t_start[~observable] = np.ma.masked
+    t_end[~observable] = np.ma.masked
+    return t_start, t_end
+
+
+def is_observable_in_interval_grid(ra, dec, lat, lon, alt, t1, t2, ha_min=-4.6*u.hourangle, ha_max=4.6*u.hourangle,
+                                   airmass_min=1.02, airmass_max=3, min_lunar_distance=30*u.deg,
+                                   return_values=False):
+    """
+    Are N targets observable at some time between t1 and t2 (see visibility_windows)?
+
+    :return: boolean mask, and if return_values, the airmass, hour angle [hr] and lunar distance [deg] when the target
+             becomes observable (or at t2, if not observable, -999 where not tested as in is_observable_grid)
+    """
+    start, end, values_at = _visibility(ra, dec, lat, lon, alt, t1, t2, ha_min, ha_max, airmass_min, airmass_max,
+                                        min_lunar_distance)
+    is_observe = ~np.isnan(start)
+
+    if return_values:
+        airmass, ha, lunar_dist = values_at(np.where(is_observe, start, max((t2 - t1).to_value(u.hour), 0)))
+        airmass_ok = (airmass > airmass_min) & (airmass < airmass_max)
+        ha_ok = airmass_ok & (ha > Angle(ha_min).to_value(u.hourangle)) & (ha < Angle(ha_max).to_value(u.hourangle))
+        return (is_observe, airmass, np.where(is_observe | airmass_ok, ha, -999),
+                np.where(is_observe | ha_ok, lunar_dist, -999))
+    else:
+        return is_observe
+
+
 def lunar_distance(ra, dec, lat, lon, alt, t=Time.now()):
     """what is the lunar distance?"""
-    obs = EarthLocation(lat=lat, lon=lon, height=alt)
-    obj = SkyCoord(ra=ra, dec=dec, frame='icrs')
-    moon = get_moon(t, location=obs)
-    return obj.separation(moon)
+    return lunar_distance_grid(ra, dec, lat, lon, alt, t)[0, 0]
 
 
 def calc_airmass(ra, dec, lat, lon, alt, t=Time.now()):
-    obs = EarthLocation(lat=lat, lon=lon, height=alt)
-    obj = SkyCoord(ra=ra, dec=dec, frame='icrs')
-    obj_altaz = obj.transform_to(AltAz(obstime=t, location=obs))
-    airmass = obj_altaz.secz
-    return airmass
+    return calc_airmass_grid(ra, dec, lat, lon, alt, t)[0, 0]
 
 
 def calc_hourangle(ra, lon, t=Time.now()):
-    lst = t.sidereal_time('apparent', lon)
-    ha = lst - ra
-    return ha
+    return calc_hourangle_grid(ra, lon, t)[0, 0]
 
 
 def is_observable(ra, dec, lat, lon, alt, t=Time.now(), ha_min=-4.6*u.hourangle, ha_max=4.6*u.hourangle,
                   airmass_min=1.02, airmass_max=3, min_lunar_distance=30*u.deg, return_values=False):
-    # is the object visible?
-    airmass = calc_airmass(ra, dec, lat, lon, alt, t)
-    if airmass <= airmass_min or airmass >= airmass_max:
-        if return_values:
-            return False, airmass, -999, -999
-        else:
-            return False
-
-    # is the hour angle within the limits?
-    ha = calc_hourangle(ra, lon, t)
-    if ha <= ha_min or ha >= ha_max:
-        if return_values:
-            return False, airmass, ha.value, -999
-        else:
-            return False
-
-    # is the object far enough from the moon?
-    lunar_dist = lunar_distance(ra, dec, lat, lon, alt, t)
-    if lunar_dist < min_lunar_distance:
-        if return_values:
-            return False, airmass, ha.value, lunar_dist.value
-        else:
-            return False
-
+    # is the object visible, within the hour angle limits and far enough from the moon?
+    result = is_observable_grid(ra, dec, lat, lon, alt, t, ha_min, ha_max, airmass_min, airmass_max,
+                                min_lunar_distance, return_values)
     if return_values:
-        return True, airmass, ha.value, lunar_dist.value
+        observable, airmass, ha, lunar_dist = result
+        return bool(observable[0, 0]), airmass[0, 0], ha[0, 0], lunar_dist[0, 0]
     else:
-        return True
+        return bool(result[0, 0])
 
 
 def is_observable_in_interval(ra, dec, lat, lon, alt, t1, t2, ha_min=-4.6*u.hourangle, ha_max=4.6*u.hourangle,
                   airmass_min=1.02, airmass_max=3, min_lunar_distance=30*u.deg, return_values=False):
-    t_vec = t1 + np.arange(0, ((t2-t1).to(u.hour)).value, 1) * u.hour
-
-    observable, airmass, ha, lunar_dist = is_observable(ra, dec, lat, lon, alt, t_vec[0], ha_min, ha_max,
-                                                        airmass_min, airmass_max, return_values=True)
-    i = 1
-    while (not observable) and (i < len(t_vec)):
-        observable, airmass, ha, lunar_dist = is_observable(ra, dec, lat, lon, alt, t_vec[i], ha_min, ha_max,
-                                                            airmass_min, airmass_max, min_lunar_distance, return_values=True)
-        i = i + 1
-
+    result = is_observable_in_interval_grid(ra, dec, lat, lon, alt, t1, t2, ha_min, ha_max, airmass_min,
+                                            airmass_max, min_lunar_distance, return_values)
     if return_values:
-        return observable, airmass, ha, lunar_dist
+        observable, airmass, ha, lunar_dist = result
+        return bool(observable[0]), airmass[0], ha[0], lunar_dist[0]
     else:
-        return observable
+        return bool(result[0])
+
+
+def is_visible_in_interval(ra, dec, lat, lon, t1, t2, ha_min=-4.6*u.hourangle, ha_max=4.6*u.hourangle,
+                           airmass_max=3, margin=0.1*u.hourangle):
+    """
+    Cheap analytic visibility test of arrays of targets, without coordinate transforms: does the target reach
+    airmass (sec z) below airmass_max, within the hour angle limits, at some time between t1 and t2?
+    This sets the declination limits (|dec - lat| < arccos(1/airmass_max)) and the RA window (from the LST range of
+    the interval and the hour angle limits). The Moon is ignored, and the limits are widened by margin, so the result
+    is a superset of is_observable_in_interval, meant for pre-filtering.
+
+    :return: boolean mask
+    """
+    ra_h = np.atleast_1d(Angle(ra).to_value(u.hourangle))
+    dec_rad = np.atleast_1d(Angle(dec).to_value(u.rad))
+    lat_rad = Angle(lat).to_value(u.rad)
+    margin = Angle(margin).to_value(u.hourangle)
+
+    # the hour angle at which the target crosses the airmass limit
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos_h = (1 / airmass_max - np.sin(lat_rad) * np.sin(dec_rad)) / (np.cos(lat_rad) * np.cos(dec_rad))
+    h_airmass = np.rad2deg(np.arccos(np.clip(cos_h, -1, 1))) / 15
+    h_airmass[cos_h > 1] = -np.inf  # never reaches the airmass limit (outside the declination limits)
+
+    lo = np.maximum(Angle(ha_min).to_value(u.hourangle), -h_airmass) - margin
+    hi = np.minimum(Angle(ha_max).to_value(u.hourangle), h_airmass) + margin
+
+    # hour angle at t1, and its range over the interval (in sidereal hours)
+    lst_start = local_sidereal_time(lon, t1).to_value(u.hourangle)
+    night_length = (t2 - t1).to_value(u.hour) * SIDEREAL_RATE + margin
+    if night_length >= 24:
+        return lo <= hi
+
+    # the hour angle at t1, measured from the start of the window (wrapped to [0, 24))
+    h_start = np.mod(lst_start - ra_h - lo, 24)
+    return (lo <= hi) & ((h_start <= hi - lo) | (h_start + night_length >= 24))
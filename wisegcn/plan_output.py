@@ -0,0 +1,168 @@
+import json
+import numpy as np
+from configparser import ConfigParser
+from schedulertml import rtml
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+# printf-style formats of the plan table columns (RA and Dec are written in sexagesimal)
+CSV_FORMATS = {"Index": "%d", "GladeID": "%.0f", "Airmass": "%+.2f", "HA": "%+.2f", "LunarDist": "%.2f",
+               "Dist": "%.2f", "Bmag": "%.2f", "Score": "%.6g", "Dist factor": "%.2f", "Probability": "%.6g"}
+
+_backends = {}
+
+
+def register_backend(name):
+    """
+    Decorator registering a plan output backend.
+    A backend is called as backend(targets, telescope, alertname), and returns the name of the file it wrote.
+    """
+    def decorator(func):
+        _backends[name] = func
+        return func
+    return decorator
+
+
+def get_plan_formats():
+    """Returns the plan output formats defined in config.ini (default: rtml, csv)"""
+    formats = config.get('OBSERVING', 'PLAN_FORMATS') if config.has_option('OBSERVING', 'PLAN_FORMATS') \
+        else 'rtml, csv'
+    return [f.strip() for f in formats.split(',') if f.strip()]
+
+
+def _sexagesimal(values, precision=2, alwayssign=False):
+    """Vectorized sexagesimal formatting (e.g. [+]DD:MM:SS.ss) of values in hours or degrees"""
+    values = np.asarray(values, dtype=float)
+    scale = 10 ** precision
+    total = np.round(np.abs(values) * 3600 * scale).astype(np.int64)
+    units, rem = np.divmod(total, 3600 * scale)
+    minutes, rem = np.divmod(rem, 60 * scale)
+    seconds, fraction = np.divmod(rem, scale)
+
+    if alwayssign:
+        sign = np.where(values < 0, '-', '+')
+    else:
+        sign = np.where(values < 0, '-', '')
+    strings = np.char.add(sign, np.char.zfill(units.astype(str), 2))
+    strings = np.char.add(strings, ':')
+    strings = np.char.add(strings, np.char.zfill(minutes.astype(str), 2))
+    strings = np.char.add(strings, ':')
+    strings = np.char.add(strings, np.char.zfill(seconds.astype(str), 2))
+    if precision > 0:
+        strings = np.char.add(strings, '.')
+        strings = np.char.add(strings, np.char.zfill(fraction.astype(str), precision))
+    return strings
+
+
+def format_ra(ra, precision=2):
+    """Formats RA [deg] as HH:MM:SS.ss"""
+    return _sexagesimal(np.asarray(ra, dtype=float) / 15, precision)
+
+
+def format_dec(dec, precision=2):
+    """Formats Dec [deg] as +DD:MM:SS.ss"""
+    return _sexagesimal(dec, precision, alwayssign=True)
+
+
+def format_columns(targets):
+    """Returns the formatted plan table columns (targets.meta["columns"]), as a dictionary of string arrays"""
+    columns = {}
+    for col in targets.meta["columns"]:
+        if col == "RA":
+            columns[col] = format_ra(targets["ra"])
+        elif col == "Dec":
+            columns[col] = format_dec(targets["dec"])
+        else:
+            columns[col] = np.char.mod(CSV_FORMATS.get(col, "%s"), np.asarray(targets[col]))
+    return columns
+
+
+def write_plan(targets, telescope, alertname, formats=None):
+    """
+    Writes an observing plan in all the requested formats.
+
+    :param targets: Table of targets, with name, ra [deg], dec [deg] and priority columns, and the plan table
+                    columns listed in targets.meta["columns"] (targets.meta["kind"] is either "Galaxy" or "Tile")
+    :param telescope: telescope name (config.ini section)
+    :param alertname: alert name
+    :param formats: list of backend names (default: OBSERVING/PLAN_FORMATS in config.ini)
+    :return: dictionary of the written file names, by format
+    """
+    if formats is None:
+        formats = get_plan_formats()
+
+    filenames = {}
+    for fmt in formats:
+        if fmt not in _backends:
+            raise ValueError(f"Unknown plan output format '{fmt}' (available: {', '.join(_backends)}).")
+        filenames[fmt] = _backends[fmt](targets, telescope, alertname)
+
+    return filenames
+
+
+@register_backend("csv")
+def write_csv(targets, telescope, alertname):
+    filename = f"{telescope}_{targets.meta['kind']}List.csv"
+    columns = format_columns(targets)
+    lines = columns[targets.meta["columns"][0]]
+    for col in targets.meta["columns"][1:]:
+        lines = np.char.add(np.char.add(lines, ','), columns[col])
+    with open(filename, "w") as fid:
+        fid.write(",".join(targets.meta["columns"]) + "\n")
+        fid.writelines(np.char.add(lines, "\n"))
+    return filename
+
+
+@register_backend("json")
+def write_json(targets, telescope, alertname):
+    filename = config.get('WISE', 'PATH') + alertname + '_' + telescope + '.json'
+    columns = format_columns(targets)
+    plan = {"alert": alertname,
+            "telescope": telescope,
+            "targets": [{"name": str(targets["name"][i]),
+                         "ra": float(targets["ra"][i]),
+                         "dec": float(targets["dec"][i]),
+                         "priority": int(targets["priority"][i]),
+                         **{col: str(columns[col][i]) for col in columns}}
+                        for i in range(len(targets))]}
+    with open(filename, "w") as fid:
+        json.dump(plan, fid, indent=1)
+    return filename
+
+
+@register_backend("rtml")
+def write_rtml(targets, telescope, alertname):
+    filename = config.get('WISE', 'PATH') + alertname + '_' + telescope + '.xml'
+    root = rtml.init(name=config.get('OBSERVING', 'USER'),
+                     email=config.get('OBSERVING', 'EMAIL'))
+
+    ra = np.char.mod("%.6f", np.asarray(targets["ra"]))
+    dec = np.char.mod("%+.6f", np.asarray(targets["dec"]))
+    for i in range(len(targets)):
+        root = rtml.add_request(root,
+                                request_id=targets["name"][i],
+                                bestefforts=config.get('OBSERVING', 'BESTEFFORTS'),
+                                user=config.get('OBSERVING', 'USER'),
+                                description=config.get('OBSERVING', 'DESCRIPTION'),
+                                project=alertname,
+                                airmass_min=config.get(telescope, 'AIRMASS_MIN'),
+                                airmass_max=config.get(telescope, 'AIRMASS_MAX'),
+                                hourangle_min=config.get(telescope, 'HOURANGLE_MIN'),
+                                hourangle_max=config.get(telescope, 'HOURANGLE_MAX'),
+                                priority=str(targets["priority"][i]))
+
+        rtml.add_target(root,
+                        request_id=targets["name"][i],
+                        ra=ra[i],
+                        dec=dec[i],
+                        name=targets["name"][i])
+
+        rtml.add_picture(root,
+                         filt=config.get(telescope, 'FILTER'),
+                         target_name=targets["name"][i],
+                         exptime=config.get(telescope, 'EXPTIME'),
+                         binning=config.get(telescope, 'BINNING'))
+
+    rtml.write(root, filename)
+    return filename
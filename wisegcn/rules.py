@@ -0,0 +1,287 @@
+import os
+import operator
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from gcn.notice_types import LVC_RETRACTION
+from configparser import ConfigParser
+from wisegcn.voevent import extract_params
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+YEAR = 60 * 60 * 24 * 365  # [s]
+
+# classification conditions (parameter, threshold option): at least one must pass
+CLASSIFICATION = (("BNS", "BNS_MIN"),
+                  ("NSBH", "NSBH_MIN"),
+                  ("MassGap", "MASSGAP_MIN"),
+                  ("BBH", "BBH_MIN"),
+                  ("HasNS", "HASNS_MIN"),
+                  ("HasRemnant", "HASREMNANT_MIN"))
+
+OPERATORS = {">": operator.gt, "<=": operator.le}
+
+# a parameter (multiplied by scale) compared to a threshold; reason is reported if it fails
+Condition = namedtuple("Condition", ["param", "op", "threshold", "scale", "reason", "option"])
+
+# accepted, reason the alert was rejected (None if accepted), name of the rule set applied, and the decision trace
+Decision = namedtuple("Decision", ["accepted", "reason", "rules", "trace"])
+
+_rules = None
+
+
+def _value(params, name):
+    try:
+        return float(params.get(name))
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class RuleSet:
+    """
+    Compiled alert filtering thresholds: the alert must belong to the group, pass at least one of the classification
+    conditions, and pass all of the required conditions.
+
+    :param name: rule set name
+    :param selector: dictionary of parameter -> value, the alerts the rule set applies to (empty - all)
+    :param group: accepted group (e.g. CBC)
+    :param any_of: classification conditions
+    :param all_of: required conditions
+    """
+
+    def __init__(self, name, selector, group, any_of, all_of):
+        self.name = name
+        self.selector = selector
+        self.group = group
+        self.any_of = tuple(any_of)
+        self.all_of = tuple(all_of)
+
+    @property
+    def params(self):
+        """The parameters needed to select and evaluate the rule set"""
+        return {"Group"} | set(self.selector) | {c.param for c in self.any_of + self.all_of}
+
+    def matches(self, params):
+        return all(params.get(key) == value for key, value in self.selector.items())
+
+    def matches_batch(self, columns, n):
+        mask = np.ones(n, dtype=bool)
+        for key, value in self.selector.items():
+            mask &= columns[key] == value
+        return mask
+
+    @staticmethod
+    def _check(c, params, trace):
+        value = _value(params, c.param) * c.scale
+        passed = bool(OPERATORS[c.op](value, c.threshold))
+        trace.append(f"{c.param}={value:.6g} {c.op} {c.threshold:g} ({c.option}): {'pass' if passed else 'fail'}")
+        return passed
+
+    def evaluate(self, params):
+        """Evaluates the rules on the alert parameters, returns the Decision"""
+        trace = []
+        failed = []
+
+        group = params.get("Group")
+        trace.append(f"Group={group} == {self.group}: {'pass' if group == self.group else 'fail'}")
+        if group != self.group:
+            failed.append("group")
+
+        classified = False
+        for c in self.any_of:
+            classified |= self._check(c, params, trace)
+        if not classified:
+            failed.append("classification")
+        for c in self.all_of:
+            if not self._check(c, params, trace):
+                failed.append(c.reason)
+
+        reason = failed[0] if failed else None
+        return Decision(reason is None, reason, self.name, trace)
+
+    def evaluate_batch(self, columns, n):
+        """
+        Evaluates the rules on columns of alert parameters.
+
+        :param columns: dictionary of parameter -> array (strings for Group and the selector parameters, floats for
+                        the conditions, nan if missing)
+        :param n: number of alerts
+        :return: boolean array of the accepted alerts, and an array of the rejection reasons ('' if accepted)
+        """
+        group = columns["Group"] == self.group
+        classified = np.zeros(n, dtype=bool)
+        for c in self.any_of:
+            classified |= OPERATORS[c.op](columns[c.param] * c.scale, c.threshold)
+
+        # the first failing condition is the reason, so fill in the reasons in reverse order
+        reason = np.full(n, "", dtype=object)
+        for c in reversed(self.all_of):
+            reason[~OPERATORS[c.op](columns[c.param] * c.scale, c.threshold)] = c.reason
+        reason[~classified] = "classification"
+        reason[~group] = "group"
+        return reason == "", reason
+
+
+def _compile(name, selector, section, cfg):
+    def threshold(option):
+        return cfg.getfloat(section, option) if cfg.has_option(section, option) else cfg.getfloat('GENERAL', option)
+
+    group = cfg.get(section, 'GROUP') if cfg.has_option(section, 'GROUP') else 'CBC'
+    any_of = [Condition(param, ">", threshold(option), 1, "classification", option)
+              for param, option in CLASSIFICATION]
+    all_of = [Condition("Terrestrial", "<=", threshold('TERRESTRIAL_MAX'), 1, "classification", 'TERRESTRIAL_MAX'),
+              Condition("FAR", "<=", threshold('FAR_MAX'), YEAR, "far", 'FAR_MAX')]
+    return RuleSet(name, selector, group, any_of, all_of)
+
+
+def compile_rules(cfg=None):
+    """
+    Compiles the alert filtering rules from the config: the GENERAL thresholds, overridden for specific alerts by
+    [RULES <param>=<value>, ...] sections (e.g. [RULES Pipeline=gstlal] or [RULES Pipeline=pycbc, AlertType=Initial]).
+    An alert is evaluated by the most specific matching rule set.
+
+    :param cfg: ConfigParser (default: config.ini)
+    :return: list of RuleSets, the most specific first, and the GENERAL rule set last
+    """
+    if cfg is None:
+        cfg = config
+
+    rulesets = []
+    for section in cfg.sections():
+        if not section.startswith("RULES "):
+            continue
+        selector = {}
+        for term in section[len("RULES "):].split(','):
+            key, _, value = term.partition('=')
+            selector[key.strip()] = value.strip()
+        rulesets.append(_compile(section, selector, section, cfg))
+    rulesets.sort(key=lambda rs: len(rs.selector), reverse=True)
+    rulesets.append(_compile("GENERAL", {}, 'GENERAL', cfg))
+    return rulesets
+
+
+def get_rules():
+    """Returns the rules compiled from config.ini (compiled once)"""
+    global _rules
+    if _rules is None:
+        _rules = compile_rules()
+    return _rules
+
+
+def required_params(rulesets=None):
+    """The parameters the rules need (to extract from the VOEvents, see voevent.extract_params)"""
+    if rulesets is None:
+        rulesets = get_rules()
+    return set().union(*(rs.params for rs in rulesets))
+
+
+def evaluate(params, rulesets=None):
+    """
+    Evaluates an alert with the most specific matching rule set.
+
+    :param params: VOEvent parameters (see voevent.parse_voevent or voevent.extract_params)
+    :param rulesets: compiled rules (default: get_rules)
+    :return: Decision
+    """
+    if rulesets is None:
+        rulesets = get_rules()
+    for rs in rulesets:
+        if rs.matches(params):
+            return rs.evaluate(params)
+
+
+def evaluate_batch(params_list, rulesets=None):
+    """
+    Evaluates many alerts at once (vectorized).
+
+    :param params_list: list of VOEvent parameter dictionaries
+    :param rulesets: compiled rules (default: get_rules)
+    :return: boolean array of the accepted alerts, array of the rejection reasons ('' if accepted), and array of the
+             names of the rule sets applied
+    """
+    if rulesets is None:
+        rulesets = get_rules()
+
+    n = len(params_list)
+    columns = {}
+    for rs in rulesets:
+        for name in {"Group"} | set(rs.selector):
+            columns[name] = np.array([params.get(name) for params in params_list], dtype=object)
+        for c in rs.any_of + rs.all_of:
+            if c.param not in columns:
+                columns[c.param] = np.array([_value(params, c.param) for params in params_list], dtype=float)
+
+    accepted = np.zeros(n, dtype=bool)
+    reason = np.full(n, "", dtype=object)
+    applied = np.full(n, "", dtype=object)
+    remaining = np.ones(n, dtype=bool)
+    for rs in rulesets:
+        mask = remaining & rs.matches_batch(columns, n)
+        rs_accepted, rs_reason = rs.evaluate_batch(columns, n)
+        accepted[mask] = rs_accepted[mask]
+        reason[mask] = rs_reason[mask]
+        applied[mask] = rs.name
+        remaining &= ~mask
+    return accepted, reason, applied
+
+
+def _read_params(filename, names):
+    with open(filename, "rb") as f:
+        return extract_params(f.read(), names)
+
+
+def read_archive(filenames, names, nproc=1):
+    """
+    Reads the given parameters from archived VOEvent files.
+
+    :param filenames: VOEvent XML file names
+    :param names: parameter names (see required_params)
+    :param nproc: number of processes
+    :return: list of parameter dictionaries (None for files that are not valid XML)
+    """
+    names = sorted(names)
+    if nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            return list(executor.map(_read_params, filenames, [names] * len(filenames),
+                                     chunksize=max(len(filenames) // (4 * nproc), 1)))
+    return [_read_params(filename, names) for filename in filenames]
+
+
+def evaluate_archive(filenames, rulesets=None, nproc=None, log=None):
+    """
+    Evaluates the rules over an archive of historical VOEvents, e.g. to assess threshold changes.
+    Retractions and files that are not valid XML are not evaluated.
+
+    :param filenames: VOEvent XML file names
+    :param rulesets: compiled rules (default: get_rules)
+    :param nproc: number of processes (default: all CPUs)
+    :param log: logger
+    :return: dictionary of columns: file, accepted, reason (the rejection reason, retraction or invalid) and rules
+             (the name of the rule set applied)
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+    if rulesets is None:
+        rulesets = get_rules()
+    if nproc is None:
+        nproc = os.cpu_count()
+
+    params_list = read_archive(filenames, required_params(rulesets) | {"Packet_Type"}, nproc=nproc)
+
+    n = len(filenames)
+    accepted = np.zeros(n, dtype=bool)
+    reason = np.full(n, "invalid", dtype=object)
+    applied = np.full(n, "", dtype=object)
+    retraction = np.array([params is not None and params.get("Packet_Type") == str(LVC_RETRACTION)
+                           for params in params_list], dtype=bool)
+    reason[retraction] = "retraction"
+    valid = np.flatnonzero(np.array([params is not None for params in params_list], dtype=bool) & ~retraction)
+    if len(valid) > 0:
+        accepted[valid], reason[valid], applied[valid] = evaluate_batch([params_list[i] for i in valid], rulesets)
+
+    reasons, counts = np.unique(reason[~accepted].astype(str), return_counts=True)
+    log.info(f"Accepted {np.sum(accepted)}/{n} alerts" +
+             "".join(f", {count} rejected ({r})" for r, count in zip(reasons, counts)) + ".")
+    return {"file": np.array(filenames, dtype=object), "accepted": accepted, "reason": reason, "rules": applied}
@@ -0,0 +1,49 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def share_arrays(arrays):
+    """
+    Copy arrays into shared memory blocks.
+
+    :param arrays: dictionary of numpy arrays
+    :return: list of shared memory blocks (keep them alive while in use), and a picklable spec for attach_arrays
+    """
+    blocks = []
+    spec = {}
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        blocks.append(shm)
+        spec[key] = (shm.name, arr.shape, np.lib.format.dtype_to_descr(arr.dtype))
+    return blocks, spec
+
+
+def attach_arrays(spec):
+    """
+    Attach (zero-copy) to arrays shared by share_arrays.
+    Meant for child processes, which share the owner's resource tracker (the owner unlinks the blocks).
+
+    :param spec: spec returned by share_arrays
+    :return: list of shared memory blocks, and a dictionary of numpy arrays backed by them
+    """
+    blocks = []
+    arrays = {}
+    for key, (name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=np.lib.format.descr_to_dtype(dtype), buffer=shm.buf)
+    return blocks, arrays
+
+
+def release(blocks, unlink=False):
+    """Close shared memory blocks (and unlink them, if owned)"""
+    for shm in blocks:
+        try:
+            shm.close()
+        except BufferError:
+            # still viewed by arrays, unmapped once they are gone
+            pass
+        if unlink:
+            shm.unlink()
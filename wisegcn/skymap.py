@@ -0,0 +1,226 @@
+import healpy as hp
+import numpy as np
+from collections import namedtuple
+from scipy.special import ndtr, ndtri
+from astropy.table import Table
+from wisegcn.catalog import load_catalog, find_rows, column
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+SQRT_2PI = np.sqrt(2 * np.pi)
+
+# A loaded 3D HEALPix sky map (credible_levels[i] is the 2D credible level of pixel i)
+Skymap = namedtuple("Skymap", ["prob", "dist_mu", "dist_sigma", "dist_norm", "nside", "credible_levels"])
+
+
+def read_skymap(skymap_path):
+    """
+    Reads a 3D HEALPix sky map once, for batch queries.
+
+    :param skymap_path: path to skymap FITS file
+    :return: Skymap
+    """
+    prob, dist_mu, dist_sigma, dist_norm = hp.read_map(skymap_path, field=None, verbose=False)
+    nside = hp.npix2nside(len(prob))
+    return Skymap(prob, dist_mu, dist_sigma, dist_norm, nside, find_credible_levels(prob))
+
+
+def find_credible_levels(prob):
+    """Returns the credible level of each pixel (the probability of all the pixels at least as probable)"""
+    sort_idx = np.flipud(np.argsort(prob, kind="stable"))
+    # accumulate in double precision, also for float32 sky maps
+    sorted_credible_levels = np.cumsum(prob[sort_idx], dtype=np.float64)
+    credible_levels = np.empty_like(sorted_credible_levels)
+    credible_levels[sort_idx] = sorted_credible_levels
+    return credible_levels
+
+
+def distance_pdf(d, dist_mu, dist_sigma, dist_norm):
+    """Distance likelihood dist_norm * N(d; dist_mu, dist_sigma), using in-place operations (or numexpr)"""
+    if ne is not None:
+        return ne.evaluate("dist_norm * exp(-0.5 * ((d - dist_mu) / dist_sigma)**2) / (dist_sigma * sqrt_2pi)",
+                           local_dict={"d": d, "dist_mu": dist_mu, "dist_sigma": dist_sigma,
+                                       "dist_norm": dist_norm, "sqrt_2pi": SQRT_2PI})
+    pdf = d - dist_mu
+    pdf /= dist_sigma
+    np.square(pdf, out=pdf)
+    pdf *= -0.5
+    np.exp(pdf, out=pdf)
+    pdf /= dist_sigma
+    pdf *= dist_norm
+    pdf /= SQRT_2PI
+    return pdf
+
+
+def _phi(x):
+    return np.exp(-0.5 * x ** 2) / SQRT_2PI
+
+
+def _r2_moment(r, dist_mu, dist_sigma):
+    """Returns the integral of x^2 * N(x; dist_mu, dist_sigma) between 0 and r (r may be np.inf)"""
+    a = -dist_mu / dist_sigma
+    t = (r - dist_mu) / dist_sigma
+    dphi = _phi(a) - np.where(np.isinf(t), 0, _phi(t))
+    dcdf = ndtr(t) - ndtr(a)
+    t_phi_t = np.where(np.isinf(t), 0, t * _phi(t))
+    return (dist_mu ** 2 * dcdf + 2 * dist_mu * dist_sigma * dphi +
+            dist_sigma ** 2 * (dcdf - t_phi_t + a * _phi(a)))
+
+
+def distance_moments(dist_mu, dist_sigma):
+    """
+    Returns the mean and standard deviation of the conditional distance distribution of a pixel,
+    p(r) ~ r^2 * N(r; dist_mu, dist_sigma) for r > 0.
+    """
+    z = dist_mu / dist_sigma
+    m0 = ndtr(z)
+    m1 = dist_mu * m0 + dist_sigma * _phi(z)
+    m2 = dist_mu * m1 + dist_sigma ** 2 * m0
+    m3 = dist_mu * m2 + 2 * dist_sigma ** 2 * m1
+    m4 = dist_mu * m3 + 3 * dist_sigma ** 2 * m2
+    mean = m3 / m2
+    std = np.sqrt(np.maximum(m4 / m2 - mean ** 2, 0))
+    return mean, std
+
+
+def distance_cdf(r, dist_mu, dist_sigma):
+    """Returns the cumulative conditional distance distribution of a pixel at distance r"""
+    return _r2_moment(r, dist_mu, dist_sigma) / _r2_moment(np.inf, dist_mu, dist_sigma)
+
+
+def distance_quantile(q, dist_mu, dist_sigma, niter=8):
+    """Returns the distance quantile q of the conditional distance distribution of a pixel (Newton iterations)"""
+    mean, std = distance_moments(dist_mu, dist_sigma)
+    norm = _r2_moment(np.inf, dist_mu, dist_sigma)
+    r = np.maximum(mean + ndtri(q) * std, 1e-3 * mean)
+    for i in range(niter):
+        pdf = r ** 2 * _phi((r - dist_mu) / dist_sigma) / dist_sigma / norm
+        r = r - (_r2_moment(r, dist_mu, dist_sigma) / norm - q) / pdf
+        r = np.maximum(r, 1e-3 * mean)
+    return r
+
+
+def query_points(skymap, ra, dec, dist=None, interval=0.9, volume_table=None):
+    """
+    Batch query of a loaded sky map.
+
+    :param skymap: Skymap (see read_skymap)
+    :param ra: RA in deg (scalar or array)
+    :param dec: Dec in deg (scalar or array)
+    :param dist: distance in Mpc (scalar or array, optional)
+    :param interval: probability of the central distance credible interval
+    :param volume_table: volume credible level table (see volume_credible_table) to add 3D credible levels (optional)
+    :return: Table of the 2D probability (prob), 2D credible level (credible_level), conditional distance mean,
+             standard deviation and credible interval (dist_mean, dist_std, dist_lower, dist_upper), and,
+             if dist is given, 3D probability density (dp_dv) [Mpc^-3]
+    """
+    ra = np.atleast_1d(ra).astype(float)
+    dec = np.atleast_1d(dec).astype(float)
+    pix = hp.ang2pix(skymap.nside, 0.5 * np.pi - np.deg2rad(dec), np.deg2rad(ra))
+
+    # distance properties are per pixel, compute them only once per pixel
+    upix, inverse = np.unique(pix, return_inverse=True)
+    mu = skymap.dist_mu[upix]
+    sigma = skymap.dist_sigma[upix]
+    dist_mean, dist_std = distance_moments(mu, sigma)
+    dist_lower = distance_quantile(0.5 - interval / 2, mu, sigma)
+    dist_upper = distance_quantile(0.5 + interval / 2, mu, sigma)
+
+    result = Table({"ra": ra, "dec": dec,
+                    "prob": skymap.prob[pix],
+                    "credible_level": skymap.credible_levels[pix],
+                    "dist_mean": dist_mean[inverse],
+                    "dist_std": dist_std[inverse],
+                    "dist_lower": dist_lower[inverse],
+                    "dist_upper": dist_upper[inverse]})
+
+    if dist is not None:
+        dist = np.broadcast_to(np.asarray(dist, dtype=float), ra.shape)
+        result["dist"] = dist
+        result["dp_dv"] = skymap.prob[pix] / hp.nside2pixarea(skymap.nside) * \
+            distance_pdf(dist, skymap.dist_mu[pix], skymap.dist_sigma[pix], skymap.dist_norm[pix])
+        if volume_table is not None:
+            rho, cum_prob, cum_volume = volume_table
+            # the density grid is descending, np.interp needs ascending values
+            result["volume_credible_level"] = np.interp(np.log(result["dp_dv"]), np.log(rho[::-1]), cum_prob[::-1],
+                                                        left=1, right=0)
+
+    return result
+
+
+def query_galaxies(skymap, glade_ids, cat_file=None, interval=0.9, volume_table=None):
+    """
+    Batch query of a loaded sky map for Glade galaxies.
+
+    :param skymap: Skymap (see read_skymap)
+    :param glade_ids: GladeIDs of the galaxies (scalar or array)
+    :param cat_file: path to the catalog .npy file (default: taken from config.ini)
+    :param interval: probability of the central distance credible interval
+    :param volume_table: volume credible level table (see volume_credible_table) to add 3D credible levels (optional)
+    :return: Table of the query_points results, with the GladeID column (NaN for GladeIDs not in the catalog)
+    """
+    glade_ids = np.atleast_1d(glade_ids)
+    galaxy_cat = load_catalog(cat_file)
+    idx = find_rows(glade_ids, cat_file)
+    missing = idx < 0
+    rows = galaxy_cat[np.where(missing, 0, idx)]
+
+    result = query_points(skymap, column(rows, "ra"), column(rows, "dec"), column(rows, "dist"), interval=interval,
+                          volume_table=volume_table)
+    for name in result.colnames:
+        result[name][missing] = np.nan
+    result.add_column(glade_ids, name="GladeID", index=0)
+    return result
+
+
+def volume_credible_table(skymap, n=64, prob_max=0.9999):
+    """
+    Tabulates the 3D credible regions of the sky map: for each density threshold rho, the probability and the volume
+    of the region where dP/dV >= rho.
+
+    :param skymap: Skymap (see read_skymap)
+    :param n: number of density thresholds
+    :param prob_max: only pixels within this 2D credible level are considered
+    :return: density thresholds (descending) [Mpc^-3], cumulative probability, cumulative volume [Mpc^3]
+    """
+    pixarea = hp.nside2pixarea(skymap.nside)
+    good = (skymap.credible_levels <= prob_max) & np.isfinite(skymap.dist_mu) & (skymap.dist_sigma > 0)
+    prob = skymap.prob[good]
+    mu = skymap.dist_mu[good]
+    sigma = skymap.dist_sigma[good]
+
+    # dP/dV = k * exp(-(r - mu)^2 / (2 sigma^2)) along the line of sight of each pixel
+    norm = _r2_moment(np.inf, mu, sigma)
+    k = prob / pixarea / norm / (sigma * SQRT_2PI)
+    peak = k * np.exp(-0.5 * (np.minimum(mu, 0) / sigma) ** 2)
+    rho = np.logspace(np.log10(peak.max()), np.log10(peak.max()) - 8, n)
+
+    cum_prob = np.empty(n)
+    cum_volume = np.empty(n)
+    for i in range(n):
+        # dP/dV >= rho[i] for |r - mu| <= w
+        w = sigma * np.sqrt(2 * np.log(np.maximum(k / rho[i], 1)))
+        r_lo = np.maximum(mu - w, 0)
+        r_hi = np.maximum(mu + w, 0)
+        cum_prob[i] = np.sum(prob * (_r2_moment(r_hi, mu, sigma) - _r2_moment(r_lo, mu, sigma)) / norm)
+        cum_volume[i] = np.sum(pixarea * (r_hi ** 3 - r_lo ** 3) / 3)
+
+    return rho, cum_prob, cum_volume
+
+
+def credible_volume(skymap, credzone=0.9, volume_table=None):
+    """
+    Returns the 3D credible volume of the sky map.
+
+    :param skymap: Skymap (see read_skymap)
+    :param credzone: probability to consider credible, could also be a list
+    :param volume_table: volume credible level table (see volume_credible_table, computed if not given)
+    :return: credible volume [Mpc^3]
+    """
+    if volume_table is None:
+        volume_table = volume_credible_table(skymap)
+    rho, cum_prob, cum_volume = volume_table
+    return np.interp(credzone, cum_prob, cum_volume)
@@ -0,0 +1,172 @@
+import os
+import healpy as hp
+import numpy as np
+from configparser import ConfigParser
+from wisegcn.shared import share_arrays, attach_arrays, release
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+SKYMAP_FIELDS = ("prob", "dist_mu", "dist_sigma", "dist_norm")
+
+# sky maps shared by this process (inherited by forked children): path -> handle, arrays, blocks, reference count
+_shared = {}
+
+
+def get_cache_mode():
+    """Returns the sky map sharing mode defined in config.ini: none (default), npy or shm"""
+    mode = config.get('EVENT FILES', 'SKYMAP_CACHE') if config.has_option('EVENT FILES', 'SKYMAP_CACHE') else 'none'
+    return mode.strip().lower()
+
+
+def get_cache_path(skymap_path):
+    """Returns the path to the .npy cache of a sky map, next to the FITS file"""
+    base = skymap_path
+    for ext in ('.gz', '.fits'):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    return base + '.npy'
+
+
+def read_skymap_arrays(skymap_path):
+    """Reads the 3D sky map FITS file, returns a dictionary of the prob, dist_mu, dist_sigma and dist_norm arrays"""
+    return dict(zip(SKYMAP_FIELDS, hp.read_map(skymap_path, field=None, verbose=False)))
+
+
+def get_working_nside():
+    """Returns the working nside for sky area and tiling estimates defined in config.ini (None - native nside)"""
+    nside = config.getint('SKYMAP', 'NSIDE') if config.has_option('SKYMAP', 'NSIDE') else 0
+    return nside if nside > 0 else None
+
+
+def get_working_dtype():
+    """Returns the working dtype of the sky map probability for sky area and tiling estimates defined in config.ini"""
+    return np.dtype(config.get('SKYMAP', 'DTYPE') if config.has_option('SKYMAP', 'DTYPE') else 'float64')
+
+
+def get_compare_precision():
+    """Returns whether to compare the sky areas at the working nside and dtype with the full precision ones, defined in
+    config.ini (default: False, the comparison reads the sky map at full precision again)"""
+    return config.getboolean('SKYMAP', 'COMPARE_PRECISION') if config.has_option('SKYMAP', 'COMPARE_PRECISION') \
+        else False
+
+
+def load_skymap(skymap_path, fields=SKYMAP_FIELDS, dtype=None, nside=None):
+    """
+    Loads only the sky map fields a stage needs: from the shared copy, if the sky map was shared (see share_skymap),
+    otherwise from the FITS file.
+
+    :param skymap_path: path to skymap FITS file
+    :param fields: fields to load (see SKYMAP_FIELDS)
+    :param dtype: cast the arrays to dtype (e.g. float32, default: keep float64)
+    :param nside: downsample to this working nside (only for prob, the total probability is conserved)
+    :return: dictionary of the arrays
+    """
+    fields = tuple(fields)
+    if nside is not None and fields != ("prob",):
+        raise ValueError("Only the probability can be downsampled.")
+
+    if skymap_path in _shared:
+        arrays = {key: _shared[skymap_path]["arrays"][key] for key in fields}
+    else:
+        field = [SKYMAP_FIELDS.index(key) for key in fields]
+        if len(field) == 1:
+            maps = [hp.read_map(skymap_path, field=field[0], verbose=False)]
+        else:
+            maps = hp.read_map(skymap_path, field=field, verbose=False)
+        arrays = dict(zip(fields, maps))
+
+    if nside is not None and nside != hp.npix2nside(len(arrays["prob"])):
+        arrays["prob"] = hp.ud_grade(arrays["prob"], nside, power=-2)
+    if dtype is not None:
+        arrays = {key: np.asarray(arr, dtype=dtype) for key, arr in arrays.items()}
+    return arrays
+
+
+def share_skymap(skymap_path, arrays=None, mode=None):
+    """
+    Loads a 3D sky map once, and shares it with the other processes (if already shared, just adds a reference).
+    In npy mode the sky map is cached as a .npy file next to the FITS file, and memory-mapped;
+    in shm mode it is copied into shared memory blocks.
+
+    :param skymap_path: path to skymap FITS file
+    :param arrays: sky map arrays, if already read (see read_skymap_arrays)
+    :param mode: npy, shm or none (default: EVENT FILES/SKYMAP_CACHE in config.ini)
+    :return: picklable handle, for attach_skymap (None in none mode)
+    """
+    if skymap_path in _shared:
+        _shared[skymap_path]["refs"] += 1
+        return _shared[skymap_path]["handle"]
+
+    if mode is None:
+        mode = get_cache_mode()
+
+    blocks = []
+    if mode == "npy":
+        cache_path = get_cache_path(skymap_path)
+        if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(skymap_path):
+            if arrays is None:
+                arrays = read_skymap_arrays(skymap_path)
+            np.save(cache_path, np.vstack([arrays[key] for key in SKYMAP_FIELDS]))
+        handle = {"npy": cache_path}
+        blocks, arrays = attach_skymap(handle)
+    elif mode == "shm":
+        if arrays is None:
+            arrays = read_skymap_arrays(skymap_path)
+        blocks, spec = share_arrays(arrays)
+        handle = {"shm": spec}
+        # view the shared copy, and let the private one go
+        arrays = {key: np.ndarray(arrays[key].shape, dtype=arrays[key].dtype, buffer=shm.buf)
+                  for key, shm in zip(SKYMAP_FIELDS, blocks)}
+    else:
+        if arrays is None:
+            arrays = read_skymap_arrays(skymap_path)
+        handle = None
+
+    _shared[skymap_path] = {"handle": handle, "arrays": arrays, "blocks": blocks, "refs": 1}
+    return handle
+
+
+def attach_skymap(handle):
+    """
+    Attach (zero-copy) to a sky map shared by share_skymap, e.g. in a worker process.
+
+    :param handle: handle returned by share_skymap
+    :return: list of shared memory blocks (release with shared.release), and a dictionary of the sky map arrays
+    """
+    if "npy" in handle:
+        skymap = np.load(handle["npy"], mmap_mode='r')
+        return [], dict(zip(SKYMAP_FIELDS, skymap))
+    return attach_arrays(handle["shm"])
+
+
+def get_skymap_arrays(skymap_path):
+    """Returns the sky map arrays: the shared copy, if the sky map was shared by this process (or its parent),
+    otherwise read from the FITS file"""
+    if skymap_path in _shared:
+        return _shared[skymap_path]["arrays"]
+    return read_skymap_arrays(skymap_path)
+
+
+def unshare_skymap(skymap_path, keep_cache=False):
+    """
+    Removes a reference to a shared sky map. The last reference frees the shared memory blocks and deletes the .npy
+    cache (unless keep_cache).
+    """
+    entry = _shared.get(skymap_path)
+    if entry is None:
+        return
+
+    entry["refs"] -= 1
+    if entry["refs"] > 0:
+        return
+
+    del _shared[skymap_path]
+    entry["arrays"] = None
+    if entry["handle"] is not None and "shm" in entry["handle"]:
+        release(entry["blocks"], unlink=True)
+    elif entry["handle"] is not None and not keep_cache:
+        try:
+            os.remove(entry["handle"]["npy"])
+        except OSError:
+            pass
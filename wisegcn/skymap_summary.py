@@ -0,0 +1,249 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+import logging
+import healpy as hp
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from configparser import ConfigParser
+from wisegcn.skymap import find_credible_levels, distance_moments
+from wisegcn.skymap_cache import load_skymap, get_skymap_arrays, get_working_nside, get_working_dtype
+from wisegcn.utils import get_sky_area
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+CONTOUR_CREDZONES = (0.5, 0.9)
+
+# summaries computed by this process: digest -> summary
+_summaries = {}
+
+
+def _get(option, default):
+    return config.get('SKYMAP', option) if config.has_option('SKYMAP', option) else default
+
+
+def get_summary_path(skymap_path):
+    """Returns the folder of the cached sky map summaries (default: next to the FITS file)"""
+    path = _get('SUMMARY_PATH', '')
+    return path if path else os.path.join(os.path.dirname(skymap_path), '')
+
+
+def skymap_digest(skymap_path, chunksize=1 << 20):
+    """Returns the sha256 digest of the sky map FITS file (an Update with the same sky map has the same digest)"""
+    sha = hashlib.sha256()
+    with open(skymap_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunksize), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def count_modes(prob, credzone=0.9):
+    """
+    Returns the number of disconnected modes (islands) of the credzone region.
+
+    :param prob: HEALPix probability (RING ordering)
+    :param credzone: localization probability to consider credible
+    :return: number of modes
+    """
+    nside = hp.npix2nside(len(prob))
+    pix = np.flatnonzero(find_credible_levels(prob) <= credzone)
+    if len(pix) == 0:
+        return 0
+
+    # connect every pixel of the region to its neighbours in the region
+    index = np.full(len(prob), -1)
+    index[pix] = np.arange(len(pix))
+    neighbours = hp.get_all_neighbours(nside, pix)
+    rows = np.broadcast_to(np.arange(len(pix)), neighbours.shape)
+    cols = np.where(neighbours >= 0, index[neighbours], -1)
+    linked = cols >= 0
+    graph = coo_matrix((np.ones(np.sum(linked)), (rows[linked], cols[linked])), shape=(len(pix), len(pix)))
+    return int(connected_components(graph, directed=False)[0])
+
+
+def distance_summary(arrays, credzone=0.9):
+    """
+    Returns the mean and standard deviation of the distance within the credzone region (the conditional distance
+    distributions of the pixels, weighted by their probability).
+
+    :param arrays: sky map arrays (see skymap_cache.get_skymap_arrays)
+    :param credzone: localization probability to consider credible
+    :return: mean and standard deviation [Mpc] (NaN for sky maps without distance)
+    """
+    prob, dist_mu, dist_sigma = arrays["prob"], arrays["dist_mu"], arrays["dist_sigma"]
+    mask = (find_credible_levels(prob) <= credzone) & np.isfinite(dist_mu) & (dist_sigma > 0)
+    if not np.any(mask) or np.sum(prob[mask]) <= 0:
+        return np.nan, np.nan
+
+    mean, std = distance_moments(dist_mu[mask], dist_sigma[mask])
+    w = prob[mask] / np.sum(prob[mask])
+    total_mean = np.sum(w * mean)
+    total_std = np.sqrt(max(np.sum(w * (std ** 2 + mean ** 2)) - total_mean ** 2, 0))
+    return float(total_mean), float(total_std)
+
+
+def contours(prob, credzone=0.9):
+    """
+    Returns the outline of the credzone region: the polygons bounding its HEALPix pixels.
+
+    :param prob: HEALPix probability (RING ordering), preferably downsampled (see SKYMAP/SUMMARY_NSIDE)
+    :param credzone: localization probability to consider credible
+    :return: list of polygons, each a list of [RA, Dec] vertices in deg
+    """
+    nside = hp.npix2nside(len(prob))
+    pix = np.flatnonzero(find_credible_levels(prob) <= credzone)
+    if len(pix) == 0:
+        return []
+
+    # pixel corners, in the same (counter-clockwise) order for every pixel: keep the edges that are not shared with
+    # another pixel of the region (an inner edge appears once in each direction)
+    corners = np.round(np.moveaxis(hp.boundaries(nside, pix, step=1).reshape(len(pix), 3, 4), 1, 2), 9)
+    keys = [[tuple(v) for v in pixel] for pixel in corners]
+    edges = {(pixel[i], pixel[(i + 1) % 4]) for pixel in keys for i in range(4)}
+    outer = {}
+    for a, b in edges:
+        if (b, a) not in edges:
+            outer.setdefault(a, []).append(b)
+
+    # chain the outer edges into closed polygons
+    polygons = []
+    while outer:
+        start = next(iter(outer))
+        polygon = [start]
+        vertex = start
+        while True:
+            following = outer[vertex]
+            nxt = following.pop()
+            if not following:
+                del outer[vertex]
+            if nxt == start:
+                break
+            polygon.append(nxt)
+            vertex = nxt
+            if vertex not in outer:
+                break
+        theta, phi = hp.vec2ang(np.array(polygon))
+        polygons.append(np.round(np.column_stack((np.rad2deg(phi), 90 - np.rad2deg(theta))), 3).tolist())
+    return polygons
+
+
+def _write_png(filename, rgb):
+    """Writes an RGB image (height x width x 3 uint8 array) as a PNG file"""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    height, width = rgb.shape[:2]
+    # every scanline starts with filter type 0
+    raw = np.hstack((np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, -1))).tobytes()
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 9)))
+        f.write(chunk(b"IEND", b""))
+
+
+def preview_image(filename, prob, width=360):
+    """
+    Writes a small equirectangular preview of the sky map (RA increasing to the left), with the 50% and 90% credible
+    contours.
+
+    :param filename: PNG file name
+    :param prob: HEALPix probability (RING ordering)
+    :param width: image width in pixels (the height is half the width)
+    """
+    nside = hp.npix2nside(len(prob))
+    height = width // 2
+    ra = 360 - (np.arange(width) + 0.5) * 360 / width
+    dec = 90 - (np.arange(height) + 0.5) * 180 / height
+    ra, dec = np.meshgrid(ra, dec)
+    pix = hp.ang2pix(nside, np.deg2rad(90 - dec), np.deg2rad(ra))
+
+    # "hot" color map: black, red, yellow, white
+    v = prob[pix] / np.max(prob)
+    rgb = np.stack([np.clip(3 * v - i, 0, 1) for i in range(3)], axis=-1)
+
+    # the contours are where the credible level crosses the credzone between neighbouring image pixels
+    levels = find_credible_levels(prob)[pix]
+    for credzone in CONTOUR_CREDZONES:
+        inside = levels <= credzone
+        edge = np.zeros_like(inside)
+        edge[:, 1:] |= inside[:, 1:] != inside[:, :-1]
+        edge[1:, :] |= inside[1:, :] != inside[:-1, :]
+        rgb[edge] = (0, 1, 1)
+
+    _write_png(filename, np.round(255 * rgb).astype(np.uint8))
+
+
+def summarize_skymap(skymap_path, credzones=(0.5, 0.9), log=None):
+    """
+    Summarizes a sky map for the alert emails: credible areas (at the working nside and dtype, see utils.get_sky_area),
+    number of modes, distance within the 90% region, credible contours and a preview image. The summary is computed
+    once per sky map digest, and cached on disk, so Updates with the same sky map reuse it.
+
+    :param skymap_path: path to skymap FITS file
+    :param credzones: localization probabilities of the areas
+    :param log: logger
+    :return: dictionary: digest, area (credzone -> area in deg^2), modes, dist_mean, dist_std, contours (credzone ->
+             list of polygons, see contours) and preview (PNG file name)
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    digest = skymap_digest(skymap_path)
+    summary_nside = int(_get('SUMMARY_NSIDE', '64'))
+    nside = get_working_nside()
+    dtype = get_working_dtype()
+    settings = {"credzones": [float(c) for c in credzones], "nside": nside, "dtype": dtype.name,
+                "summary_nside": summary_nside}
+
+    summary = _summaries.get(digest)
+    cache_file = os.path.join(get_summary_path(skymap_path), digest + ".json")
+    if summary is None and os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                summary = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"Failed to read the sky map summary {cache_file}: {e}")
+    if summary is not None and summary["settings"] == settings and os.path.exists(summary["preview"]):
+        log.info(f"Reusing the summary of sky map {digest[:12]}.")
+        _summaries[digest] = summary
+        return summary
+
+    area = get_sky_area(skymap_path, credzone=list(credzones), nside=nside, dtype=dtype, log=log)
+
+    prob = load_skymap(skymap_path, fields=("prob",))["prob"]
+    coarse = hp.ud_grade(prob, min(summary_nside, hp.npix2nside(len(prob))), power=-2)
+    dist_mean, dist_std = distance_summary(get_skymap_arrays(skymap_path))
+
+    preview = os.path.join(get_summary_path(skymap_path), digest + ".png")
+    preview_image(preview, coarse)
+
+    summary = {"digest": digest,
+               "settings": settings,
+               "area": {str(float(c)): float(a) for c, a in zip(credzones, area)},
+               "modes": count_modes(coarse),
+               "dist_mean": dist_mean,
+               "dist_std": dist_std,
+               "contours": {str(float(c)): contours(coarse, c) for c in CONTOUR_CREDZONES},
+               "preview": preview}
+
+    tmp_file = cache_file + ".tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(summary, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        log.warning(f"Failed to cache the sky map summary to {cache_file}: {e}")
+
+    log.info(f"Sky map {digest[:12]}: {summary['modes']} modes, distance {dist_mean:.0f} +/- {dist_std:.0f} Mpc.")
+    _summaries[digest] = summary
+    return summary
+
+
+def get_area(summary, credzones):
+    """Returns the areas [deg^2] of the credzones from a summary (see summarize_skymap)"""
+    return [summary["area"][str(float(c))] for c in credzones]
@@ -4,6 +4,7 @@ import logging
 from astropy import units as u
 from astropy.coordinates import Angle
 from wisegcn.email_alert import send_mail
+from wisegcn.skymap_cache import load_skymap, get_working_nside, get_working_dtype
 
 
 def tile_region(skymap_path, credzone=0.9, tile_area=1, log=None):
@@ -12,16 +13,19 @@ def tile_region(skymap_path, credzone=0.9, tile_area=1, log=None):
 
     # Read the HEALPix sky map:
     try:
-        prob, dist_mu, dist_sigma, dist_norm = hp.read_map(skymap_path, field=None, verbose=False)
+        # only the probability, at the working nside and dtype
+        prob = load_skymap(skymap_path, fields=("prob",), dtype=get_working_dtype(),
+                           nside=get_working_nside())["prob"]
     except Exception as e:
         log.error('Failed to read sky map!')
         send_mail(subject="[GW@Wise] Failed to read LVC sky map",
                   text='''FITS file: {}
                               Exception: {}'''.format(skymap_path, e),
                   log=log)
+        raise
 
     sort_idx = np.flipud(np.argsort(prob, kind="stable"))
-    sorted_credible_levels = np.cumsum(prob[sort_idx])
+    sorted_credible_levels = np.cumsum(prob[sort_idx], dtype=np.float64)
     credible_levels = np.empty_like(sorted_credible_levels)
     credible_levels[sort_idx] = sorted_credible_levels
 
@@ -1,7 +1,14 @@
 import os
+import json
+import time
+import hashlib
+import logging
 import requests
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
-from ccdproc import ImageFileCollection
+from astropy.io import fits
+from astropy.table import Table
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 from astropy.time import Time
@@ -10,7 +17,15 @@ config = ConfigParser(inline_comment_prefixes=';')
 config.read("config.ini")
 
 
-def get_nightly_image_list(date, telescope="C28"):
+# primary header keywords used for the pointings
+HEADER_KEYS = ("object", "jd", "exptime", "readoutm", "ra", "dec")
+
+
+def _get(option, default):
+    return config.get('TREASUREMAP', option) if config.has_option('TREASUREMAP', option) else default
+
+
+def get_night_path(date, telescope="C28"):
     path = os.path.join(config.get("WISE", "OBS_PATH"), config.get(telescope, "OBS_DIR"))
     if telescope == "C28":
         path = os.path.join(path, date + "c28")
@@ -18,27 +33,89 @@ def get_nightly_image_list(date, telescope="C28"):
         path = os.path.join(path, date + "c18")
     else:
         path = os.path.join(path, date)
-    imlist = ImageFileCollection(path)
+    return path
+
+
+def read_primary_header(filename):
+    """Reads only the primary header block of a FITS file, returns the HEADER_KEYS values (None if missing or if the
+    file can't be read or parsed)"""
+    try:
+        header = fits.getheader(filename, ext=0)
+        values = {key: header.get(key) for key in HEADER_KEYS}
+    except Exception as e:
+        # a truncated or malformed frame (OSError, ValueError, VerifyError...) only skips that file
+        logging.getLogger(__name__).warning(f"Failed to read {filename}: {e}")
+        return {key: None for key in HEADER_KEYS}
+    return {key: value if isinstance(value, (str, int, float)) else None for key, value in values.items()}
+
+
+def _get_cache_file(date, telescope):
+    return os.path.join(_get('CACHE_PATH', '.'), f"{telescope}_{date}_headers.json")
+
+
+def get_nightly_image_list(date, telescope="C28", log=None):
+    """
+    Scans the primary headers of the night's FITS images in parallel. Headers are cached per file (by modification
+    time and size), so incremental runs only read the new frames.
+
+    :param date: night date (YYYYMMDD)
+    :param telescope: telescope name
+    :param log: logger
+    :return: Table of the file names and their HEADER_KEYS values
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    path = get_night_path(date, telescope)
+    filenames = sorted(os.path.join(path, f) for f in os.listdir(path)
+                       if f.lower().endswith((".fits", ".fit", ".fts", ".fits.gz", ".fits.fz")))
+
+    cache_file = _get_cache_file(date, telescope)
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as fid:
+            cache = json.load(fid)
+
+    stats = {f: os.stat(f) for f in filenames}
+    new = [f for f in filenames
+           if f not in cache or cache[f]["mtime"] != stats[f].st_mtime or cache[f]["size"] != stats[f].st_size]
+    log.info(f"{len(filenames)} images in {path}, reading {len(new)} new headers...")
 
-    return imlist
+    with ThreadPoolExecutor(max_workers=int(_get('NTHREADS', '8'))) as executor:
+        for f, values in zip(new, executor.map(read_primary_header, new)):
+            cache[f] = {"mtime": stats[f].st_mtime, "size": stats[f].st_size, "header": values}
 
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    with open(cache_file, "w") as fid:
+        json.dump({f: cache[f] for f in filenames}, fid)
 
-def get_observed_target_list(date, telescope="C28"):
-    imlist = get_nightly_image_list(date, telescope)
-    idx = ["GladeID" in obj for obj in imlist.summary["object"]]
+    headers = [cache[f]["header"] for f in filenames]
+    return Table({"file": filenames,
+                  "object": [h["object"] or "" for h in headers],
+                  "jd": np.array([h["jd"] if h["jd"] is not None else np.nan for h in headers], dtype=float),
+                  "exptime": np.array([h["exptime"] if h["exptime"] is not None else np.nan for h in headers],
+                                      dtype=float),
+                  "readoutm": [h["readoutm"] or "" for h in headers],
+                  "ra": [h["ra"] or "" for h in headers],
+                  "dec": [h["dec"] or "" for h in headers]})
 
-    jd = imlist.summary[idx]["jd"] * u.day
-    jd = jd + imlist.summary[idx]["exptime"]/2 * u.s  # get mid-exposure time
+
+def get_observed_target_list(date, telescope="C28", log=None):
+    imlist = get_nightly_image_list(date, telescope, log)
+    idx = ["GladeID" in obj for obj in imlist["object"]]
+
+    jd = imlist[idx]["jd"] * u.day
+    jd = jd + imlist[idx]["exptime"]/2 * u.s  # get mid-exposure time
     # fix JD for RBI flood delay (C28):
     if telescope == "C28":
         rbi_delay = 27 * u.s
-        rbi_idx = ["RBI Flood" in readout for readout in imlist.summary[idx]["readoutm"]]
+        rbi_idx = ["RBI Flood" in readout for readout in imlist[idx]["readoutm"]]
         jd[rbi_idx] = jd[rbi_idx] + rbi_delay
     t = Time(jd, format="jd")
     t.format = "fits"  # convert to string
     t = t.value
 
-    coo = SkyCoord(ra=imlist.summary[idx]["ra"], dec=imlist.summary[idx]["dec"], unit=(u.hourangle, u.deg))
+    coo = SkyCoord(ra=imlist[idx]["ra"], dec=imlist[idx]["dec"], unit=(u.hourangle, u.deg))
     ra = coo.ra.value
     dec = coo.dec.value
     return ra, dec, t
@@ -76,16 +153,94 @@ def prepare_json_data(graceid, api_token, ra, dec, time,
     return json_data
 
 
-def post(json_data, base="http://treasuremap.space/api/v0/", target="pointings"):
-    r = requests.post(url=base + target, json=json_data)
-    print(r.text)
+def post(json_data, base="http://treasuremap.space/api/v0/", target="pointings", headers=None):
+    r = requests.post(url=base + target, json=json_data, headers=headers, timeout=float(_get('TIMEOUT', '60')))
+    logging.getLogger(__name__).info(r.text)
+    return r
+
+
+def _pointing_key(graceid, pointing):
+    return "|".join([graceid, pointing["instrumentid"], pointing["time"], pointing["ra"], pointing["dec"]])
+
+
+def _load_ledger():
+    ledger_file = os.path.join(_get('CACHE_PATH', '.'), "treasuremap_posted.json")
+    if os.path.exists(ledger_file):
+        with open(ledger_file) as fid:
+            return ledger_file, set(json.load(fid))
+    return ledger_file, set()
+
+
+def post_pointings(json_data, base="http://treasuremap.space/api/v0/", target="pointings", batch_size=None,
+                   retries=None, backoff=None, log=None):
+    """
+    Posts pointings in bounded batches, retrying failed batches with exponential back-off.
+    Posted pointings are recorded in a ledger (in TREASUREMAP/CACHE_PATH), so re-running never posts a pointing twice,
+    and every batch carries an Idempotency-Key header.
+
+    :param json_data: see prepare_json_data
+    :param base: Treasure Map API base URL (could be a local stand-in)
+    :param target: API target
+    :param batch_size: maximal number of pointings per request (default: TREASUREMAP/BATCH_SIZE in config.ini)
+    :param retries: number of retries of a failed batch (default: TREASUREMAP/RETRIES in config.ini)
+    :param backoff: initial retry delay [s] (default: TREASUREMAP/BACKOFF in config.ini)
+    :param log: logger
+    :return: number of posted pointings
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+    if batch_size is None:
+        batch_size = int(_get('BATCH_SIZE', '100'))
+    if retries is None:
+        retries = int(_get('RETRIES', '3'))
+    if backoff is None:
+        backoff = float(_get('BACKOFF', '2'))
+
+    graceid = json_data["graceid"]
+    ledger_file, ledger = _load_ledger()
+    pointings = [p for p in json_data["pointings"] if _pointing_key(graceid, p) not in ledger]
+    if len(pointings) < len(json_data["pointings"]):
+        log.info(f"Skipping {len(json_data['pointings']) - len(pointings)} already posted pointings.")
+
+    posted = 0
+    for start in range(0, len(pointings), batch_size):
+        batch = pointings[start:start + batch_size]
+        keys = [_pointing_key(graceid, p) for p in batch]
+        idempotency_key = hashlib.sha256("\n".join(keys).encode()).hexdigest()
+        for attempt in range(retries + 1):
+            try:
+                r = post(dict(json_data, pointings=batch), base, target, headers={"Idempotency-Key": idempotency_key})
+                if r.status_code < 500 and r.status_code != 429:
+                    r.raise_for_status()
+                    break
+                error = f"HTTP {r.status_code}"
+            except requests.HTTPError as e:
+                log.error(f"Failed to post pointings {start + 1}-{start + len(batch)}: {e}")
+                return posted
+            except requests.RequestException as e:
+                error = repr(e)
+            if attempt == retries:
+                log.error(f"Failed to post pointings {start + 1}-{start + len(batch)} after {attempt + 1} attempts "
+                          f"({error}).")
+                return posted
+            delay = backoff * 2 ** attempt
+            log.warning(f"Failed to post pointings ({error}), retrying in {delay:.0f} s...")
+            time.sleep(delay)
+
+        posted += len(batch)
+        ledger.update(keys)
+        with open(ledger_file, "w") as fid:
+            json.dump(sorted(ledger), fid)
+        log.info(f"Posted pointings {start + 1}-{start + len(batch)} of {len(pointings)}.")
+
+    return posted
 
 
 def submit_nightly_pointings(date, graceid, api_token=None,
                              telescope="C28", instrumentid=57,
                              band="other", depth=21, depth_unit="ab_mag",
                              pos_angle=0, status="completed",
-                             base=None, target=None):
+                             base=None, target=None, log=None):
     if api_token is None:
         api_token = config.get("TREASUREMAP", "APITOKEN")
     if base is None:
@@ -93,7 +248,7 @@ def submit_nightly_pointings(date, graceid, api_token=None,
     if target is None:
         target = config.get("TREASUREMAP", "TARGET")
 
-    ra, dec, t = get_observed_target_list(date, telescope)
+    ra, dec, t = get_observed_target_list(date, telescope, log)
     if telescope == "C28":
         instrumentid = 57
     elif telescope == "C18":
@@ -102,4 +257,4 @@ def submit_nightly_pointings(date, graceid, api_token=None,
     json_data = prepare_json_data(graceid, api_token, ra, dec, t,
                                   band, instrumentid, depth, depth_unit,
                                   pos_angle, status)
-    post(json_data, base, target)
+    return post_pointings(json_data, base, target, log=log)
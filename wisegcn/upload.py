@@ -0,0 +1,160 @@
+import os
+import time
+import shlex
+import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
+from configparser import ConfigParser
+from schedulertml import rtml
+from wisegcn import metrics
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+# the Scheduler import run on the remote host over the persistent session: what schedulertml's
+# import_to_remote_scheduler runs, without opening a new connection per call
+DEFAULT_IMPORT_CMD = 'python -c "from schedulertml import rtml; rtml.import_to_scheduler(r\'{cygwin_path}{filename}\')"'
+
+_executor = None
+_last = {}  # telescope -> the last upload submitted to it
+_last_lock = threading.Lock()
+_sessions_lock = threading.Lock()
+
+
+def _get(option, default):
+    return config.get('UPLOAD', option) if config.has_option('UPLOAD', option) else default
+
+
+def _ssh_options(host, user):
+    control_path = os.path.join(tempfile.gettempdir(), f"wisegcn-ssh-{user}@{host}")
+    return ["-o", "ControlMaster=auto",
+            "-o", f"ControlPath={control_path}",
+            "-o", f"ControlPersist={_get('PERSIST', '600')}",
+            "-o", "BatchMode=yes"]
+
+
+def _run(cmd, timeout):
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"'{' '.join(cmd)}' failed ({result.returncode}): {result.stderr.strip()}")
+    return result.stdout
+
+
+def open_session(host, user):
+    """Opens (or reuses) a persistent SSH master connection to user@host"""
+    ssh = shlex.split(_get('SSH', 'ssh'))
+    options = _ssh_options(host, user)
+    timeout = float(_get('TIMEOUT', '60'))
+    with _sessions_lock:
+        check = subprocess.run(ssh + options + ["-O", "check", f"{user}@{host}"], capture_output=True)
+        if check.returncode != 0:
+            _run(ssh + options + ["-N", "-f", f"{user}@{host}"], timeout)
+
+
+def close_session(host, user):
+    """Closes the persistent SSH master connection to user@host"""
+    ssh = shlex.split(_get('SSH', 'ssh'))
+    subprocess.run(ssh + _ssh_options(host, user) + ["-O", "exit", f"{user}@{host}"], capture_output=True)
+
+
+def _copy_and_import(rtml_filename, telescope):
+    host = config.get(telescope, 'HOST')
+    user = config.get(telescope, 'USER')
+    import_cmd = config.get(telescope, 'IMPORT_CMD').strip() if config.has_option(telescope, 'IMPORT_CMD') else ''
+    if not import_cmd:
+        import_cmd = DEFAULT_IMPORT_CMD
+
+    if import_cmd == 'schedulertml':
+        # let schedulertml handle the connection (a new SSH session per upload)
+        return rtml.import_to_remote_scheduler(rtml_filename,
+                                               username=user,
+                                               remote_host=host,
+                                               remote_path=config.get(telescope, 'PATH'),
+                                               cygwin_path=config.get(telescope, 'CYGWIN_PATH'))
+
+    ssh = shlex.split(_get('SSH', 'ssh'))
+    scp = shlex.split(_get('SCP', 'scp'))
+    options = _ssh_options(host, user)
+    timeout = float(_get('TIMEOUT', '60'))
+
+    open_session(host, user)
+    _run(scp + options + [rtml_filename, f"{user}@{host}:{config.get(telescope, 'PATH')}"], timeout)
+    cmd = import_cmd.format(filename=os.path.basename(rtml_filename),
+                            path=config.get(telescope, 'PATH'),
+                            cygwin_path=config.get(telescope, 'CYGWIN_PATH'))
+    return _run(ssh + options + [f"{user}@{host}", cmd], timeout)
+
+
+def upload_plan(rtml_filename, telescope, log=None):
+    """
+    Uploads an RTML plan to the telescope's remote Scheduler and imports it, retrying with exponential back-off.
+
+    :param rtml_filename: RTML plan file name
+    :param telescope: telescope name (config.ini section)
+    :param log: logger
+    :return: result of the import, or None if the upload failed
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    retries = int(_get('RETRIES', '3'))
+    backoff = float(_get('BACKOFF', '2'))
+
+    t0 = time.monotonic()
+    for attempt in range(retries + 1):
+        try:
+            result = _copy_and_import(rtml_filename, telescope)
+            log.info(f"Uploaded {rtml_filename} to the {telescope} in {time.monotonic() - t0:.2f} s "
+                     f"(attempt {attempt + 1}).")
+            if result:
+                log.info(result)
+            return result
+        except Exception as e:
+            if attempt == retries:
+                metrics.inc("wisegcn_failures_total", component="upload")
+                log.error(f"Failed to upload {rtml_filename} to the {telescope} after {attempt + 1} attempts: {e}")
+                return None
+            delay = backoff * 2 ** attempt
+            log.warning(f"Failed to upload {rtml_filename} to the {telescope} ({e}), retrying in {delay:.0f} s...")
+            time.sleep(delay)
+
+
+def _upload_after(previous, rtml_filename, telescope, log):
+    if previous is not None:
+        # a newer plan replaces the previous one, so it must not be overtaken by it
+        wait([previous])
+    return upload_plan(rtml_filename, telescope, log)
+
+
+def submit_upload(rtml_filename, telescope, log=None, pending=None):
+    """
+    Uploads a plan in the background (see upload_plan), so the next plan can be prepared meanwhile.
+    The uploads to the same telescope are done in the order they were submitted (also across alerts).
+
+    :param rtml_filename: RTML plan file name
+    :param telescope: telescope name (config.ini section)
+    :param log: logger
+    :param pending: list of the alert's pending uploads, the upload is appended to it (see wait_uploads)
+    :return: future
+    """
+    global _executor
+    with _last_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=int(_get('MAX_PARALLEL', '4')), thread_name_prefix="upload")
+        previous = _last.get(telescope)
+        if previous is not None and previous.done():
+            previous = None
+        future = _executor.submit(_upload_after, previous, rtml_filename, telescope, log)
+        _last[telescope] = future
+    if pending is not None:
+        pending.append(future)
+    return future
+
+
+def wait_uploads(pending):
+    """Waits for an alert's uploads to finish (see submit_upload), and returns their results"""
+    results = [future.result() for future in pending]
+    pending.clear()
+    return results
@@ -1,7 +1,9 @@
+import logging
 import healpy as hp
 import numpy as np
-from configparser import ConfigParser
-from astropy.table import Table
+from wisegcn.catalog import load_catalog, find_rows, column
+from wisegcn.skymap import find_credible_levels
+from wisegcn.skymap_cache import load_skymap, get_working_nside, get_working_dtype, get_compare_precision
 
 
 def get_coo_healpix_probability(ra, dec, skymap_path):
@@ -17,7 +19,8 @@ def get_coo_healpix_probability(ra, dec, skymap_path):
     try:
         prob, dist_mu, dist_sigma, dist_norm = hp.read_map(skymap_path, field=None, verbose=False)
     except Exception:
-        print('Failed to read sky map!')
+        logging.getLogger(__name__).exception(f'Failed to read sky map {skymap_path}!')
+        raise
 
     # Skymap parameters:
     npix = len(prob)
@@ -40,68 +43,101 @@ def get_galaxy_healpix_probability(glade_id, skymap_path):
     Returns the healpix probability of a Glade galaxy.
 
     :param glade_id: GladeID of the galaxy
-    :param skymap_path: path to skymap FITS file
+    :param skymap_path: path to skymap FITS file, or a preloaded Skymap (see wisegcn.skymap.read_skymap)
     :return: healpix probability
     """
-    # Read the HEALPix sky map:
-    try:
-        prob, dist_mu, dist_sigma, dist_norm = hp.read_map(skymap_path, field=None, verbose=False)
-    except Exception:
-        print('Failed to read sky map!')
+    return get_galaxies_healpix_probability(glade_id, skymap_path)[0]
 
-    # settings:
-    config = ConfigParser(inline_comment_prefixes=';')
-    config.read('config.ini')
-    cat_file = config.get('CATALOG', 'PATH') + config.get('CATALOG', 'NAME') + '.npy'  # galaxy catalog file
 
-    # Load the galaxy catalog (glade_id, RA, DEC, distance, Bmag):
-    galaxy_cat = np.load(cat_file)
-    galaxy_cat = Table(galaxy_cat, names=('ID', 'RA', 'Dec', 'Dist', 'Bmag'))
-    # galaxy_cat = galaxy_cat[np.where(galaxy_cat['Dist'] > 0)]  # remove entries with a negative distance
-    # galaxy_cat = galaxy_cat[np.where(~np.isnan(galaxy_cat['Bmag']))]  # remove entries with no Bmag
+def get_galaxies_healpix_probability(glade_ids, skymap):
+    """
+    Returns the healpix probabilities of Glade galaxies.
 
-    # Galaxy ID:
-    idx = np.where(galaxy_cat["ID"]==glade_id)[0][0]
+    :param glade_ids: array of GladeIDs
+    :param skymap: path to skymap FITS file, or a preloaded Skymap (see wisegcn.skymap.read_skymap)
+    :return: array of healpix probabilities (NaN for GladeIDs not in the catalog)
+    """
+    # Read the HEALPix sky map:
+    if isinstance(skymap, str):
+        try:
+            prob = hp.read_map(skymap, field=0, verbose=False)
+        except Exception:
+            logging.getLogger(__name__).exception(f'Failed to read sky map {skymap}!')
+            raise
+    else:
+        prob = skymap.prob
+
+    # Load the galaxy catalog (glade_id, RA, DEC, distance, Bmag), and find the galaxies:
+    galaxy_cat = load_catalog()
+    rows = find_rows(glade_ids)
 
     # Skymap parameters:
     npix = len(prob)
     nside = hp.npix2nside(npix)
 
     # Convert galaxy WCS (RA, DEC) to spherical coordinates (theta, phi):
-    theta = 0.5 * np.pi - np.deg2rad(galaxy_cat['Dec'][idx])
-    phi = np.deg2rad(galaxy_cat['RA'][idx])
-    # d = np.array(galaxy_cat['Dist'][idx])
+    theta = 0.5 * np.pi - np.deg2rad(column(galaxy_cat[rows], "dec"))
+    phi = np.deg2rad(column(galaxy_cat[rows], "ra"))
 
     # Convert galaxy coordinates to skymap pixels:
     galaxy_pix = hp.ang2pix(nside, theta, phi)
 
     p = prob[galaxy_pix]
+    p[rows < 0] = np.nan
 
     return p
 
 
-def get_sky_area(skymap_path, credzone=0.5):
+def get_sky_area(skymap_path, credzone=0.5, nside=None, dtype=None, log=None, compare=None):
     """
     Returns the credzone sky area in degrees
     :param skymap_path: path to skymap file
     :param credzone: localization probability to consider credible, could also be a list
+    :param nside: working nside (default: SKYMAP/NSIDE in config.ini, native nside if not set)
+    :param dtype: working dtype (default: SKYMAP/DTYPE in config.ini, float64 if not set)
+    :param log: logger (to report the precision loss of the working nside and dtype)
+    :param compare: report the precision loss of the working nside and dtype to the log, by computing the area at
+                    full precision too (default: SKYMAP/COMPARE_PRECISION in config.ini, False if not set)
     :return: credzone area in deg^2
     """
-
-    # Read the HEALPix sky map:
+    if nside is None:
+        nside = get_working_nside()
+    if dtype is None:
+        dtype = get_working_dtype()
+    if compare is None:
+        compare = get_compare_precision()
+
+    # Read the HEALPix sky map (only the probability):
     try:
-        prob, dist_mu, dist_sigma, dist_norm = hp.read_map(skymap_path, field=None, verbose=False)
+        prob = load_skymap(skymap_path, fields=("prob",), dtype=dtype, nside=nside)["prob"]
     except Exception:
-        print('Failed to read sky map!')
+        logging.getLogger(__name__).exception(f'Failed to read sky map {skymap_path}!')
+        raise
+
+    area = credible_area(prob, credzone)
+
+    if compare and log is not None and (nside is not None or np.dtype(dtype) != np.float64):
+        # report the precision loss of the working nside and dtype
+        full_area = credible_area(load_skymap(skymap_path, fields=("prob",))["prob"], credzone)
+        for c, a, full in zip(np.atleast_1d(credzone), np.atleast_1d(area), np.atleast_1d(full_area)):
+            log.info(f"{c} area is {a:.2f} deg^2 at nside={hp.npix2nside(len(prob))} ({np.dtype(dtype).name}), "
+                     f"{full:.2f} deg^2 at full precision ({100 * (a - full) / full:+.2f}%).")
+
+    return area
 
+
+def credible_area(prob, credzone=0.5):
+    """
+    Returns the credzone sky area in degrees of a HEALPix probability map
+    :param prob: HEALPix probability
+    :param credzone: localization probability to consider credible, could also be a list
+    :return: credzone area in deg^2
+    """
     # Skymap parameters:
     npix = len(prob)
     nside = hp.npix2nside(npix)
 
-    sort_idx = np.flipud(np.argsort(prob, kind="stable"))
-    sorted_credible_levels = np.cumsum(prob[sort_idx])
-    credible_levels = np.empty_like(sorted_credible_levels)
-    credible_levels[sort_idx] = sorted_credible_levels
+    credible_levels = find_credible_levels(prob)
 
     if np.isscalar(credzone):
         area = np.sum(credible_levels <= credzone) * hp.nside2pixarea(nside, degrees=True)
@@ -0,0 +1,113 @@
+from io import BytesIO
+from xml.etree.ElementTree import iterparse, ParseError
+
+# WhereWhen elements to read (path of local tag names below WhereWhen/ObsDataLocation)
+_OBSERVATORY_LOCATION = ("ObsDataLocation", "ObservatoryLocation")
+_ASTRO_COORD_SYSTEM = ("ObsDataLocation", "ObservationLocation", "AstroCoordSystem")
+_ISO_TIME = ("ObsDataLocation", "ObservationLocation", "AstroCoords", "Time", "TimeInstant", "ISOTime")
+
+
+class Filtered(Exception):
+    """Raised to stop parsing a VOEvent that was filtered out"""
+
+
+def _local(tag):
+    return tag.rpartition('}')[2]
+
+
+def get_root(payload):
+    """
+    Returns the local tag name (e.g. VOEvent or Transport) and the attributes of the payload's root element,
+    without parsing the whole payload ((None, {}) if it is not valid XML)
+    """
+    try:
+        for event, elem in iterparse(BytesIO(payload), events=("start",)):
+            return _local(elem.tag), dict(elem.attrib)
+    except ParseError:
+        pass
+    return None, {}
+
+
+def extract_params(payload, names):
+    """
+    Reads only the given "What" parameters from the raw XML, stopping as soon as all of them were read.
+
+    :param payload: VOEvent XML (bytes)
+    :param names: parameter names
+    :return: dictionary of the parameter values (strings) by name (missing parameters are left out), or None if the
+             payload is not valid XML
+    """
+    names = set(names)
+    params = {}
+    try:
+        for event, elem in iterparse(BytesIO(payload), events=("end",)):
+            if _local(elem.tag) == "Param" and elem.attrib.get('name') in names:
+                params[elem.attrib['name']] = elem.attrib.get('value')
+                if len(params) == len(names):
+                    break
+    except ParseError:
+        return None
+    return params
+
+
+def parse_voevent(payload, roles=None, notice_types=None):
+    """
+    Reads the VOEvent parameters in a single streaming pass, stopping as soon as the VOEvent is filtered out.
+
+    :param payload: VOEvent XML (bytes)
+    :param roles: roles to accept (e.g. ['observation'], default: all)
+    :param notice_types: notice types (Packet_Type) to accept (default: all)
+    :return: dictionary of the "What" parameters (by name), with the VOEvent attributes (ivorn, role, version), Who
+             (author_ivorn, date_ivorn), WhereWhen (observatorylocation_id, astrocoordsystem_id, isotime) and How
+             (how_description), or None if the VOEvent was filtered out (or is not a VOEvent)
+    """
+    params = {}
+    description = ""
+    path = []
+
+    try:
+        for event, elem in iterparse(BytesIO(payload), events=("start", "end")):
+            tag = _local(elem.tag)
+
+            if event == "start":
+                if not path:
+                    # root element
+                    if tag != "VOEvent":
+                        raise Filtered
+                    if roles is not None and elem.attrib.get('role') not in roles:
+                        raise Filtered
+                    for key in ('ivorn', 'role', 'version'):
+                        params[key] = elem.attrib.get(key)
+                path.append(tag)
+                continue
+
+            path.pop()
+            if len(path) < 2:
+                continue
+            section = path[1]
+
+            if section == "What" and tag == "Param":
+                name = elem.attrib.get('name')
+                params[name] = elem.attrib.get('value')
+                if name == "Packet_Type" and notice_types is not None and int(params[name]) not in notice_types:
+                    raise Filtered
+            elif section == "Who":
+                if tag == "contactName" and path[-1] == "Author":
+                    params['author_ivorn'] = elem.text
+                elif tag == "Date" and len(path) == 2:
+                    params['date_ivorn'] = elem.text
+            elif section == "WhereWhen":
+                where = tuple(path[2:]) + (tag,)
+                if where == _OBSERVATORY_LOCATION:
+                    params['observatorylocation_id'] = elem.attrib.get('id')
+                elif where == _ASTRO_COORD_SYSTEM:
+                    params['astrocoordsystem_id'] = elem.attrib.get('id')
+                elif where == _ISO_TIME:
+                    params['isotime'] = elem.text
+            elif section == "How" and tag == "Description" and len(path) == 2:
+                description = description + ", " + (elem.text or "")
+    except (Filtered, ParseError):
+        return None
+
+    params['how_description'] = description
+    return params
@@ -1,29 +1,48 @@
 from astropy import units as u
-from astropy.coordinates import Angle
+from astropy.table import Table
 from astropy.time import Time
-from wisegcn.observing_tools import is_night, next_sunset, next_sunrise, is_observable_in_interval, change_iers_url
+import healpy as hp
+import numpy as np
+import time
+from wisegcn.observing_tools import is_night, next_sunset, next_sunrise, is_observable_in_interval_grid, \
+    is_visible_in_interval, change_iers_url
 from configparser import ConfigParser
-from schedulertml import rtml
 from wisegcn.email_alert import send_mail
+from wisegcn.plan_output import write_plan
+from wisegcn.logger import dump_table
+from wisegcn.skymap_cache import load_skymap
+from wisegcn.upload import submit_upload, wait_uploads
 from wisegcn import tile
+from wisegcn import metrics
 import logging
 
 config = ConfigParser(inline_comment_prefixes=';')
 config.read("config.ini")
 
 
-def process_galaxy_list(galaxies, alertname='GW', ra_event=None, dec_event=None, log=None):
-    """Get the full galaxy list, and find which are good to observe at Wise"""
+def _progressive(option, default):
+    return config.get('PROGRESSIVE', option) if config.has_option('PROGRESSIVE', option) else default
 
-    if log is None:
-        log = logging.getLogger(__name__)
 
-    log.info("Event most probable RA={}, Dec={}.".format(
-        ra_event.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
-        dec_event.to_string(sep=':', precision=2, alwayssign=True, pad=True)))
+def is_progressive():
+    """Is the progressive planning mode (a quick plan first, see process_quick_plan) enabled in config.ini?"""
+    return _progressive('ENABLED', 'False').strip().lower() in ('true', 'yes', 'on', '1')
+
+
+def get_telescopes():
+    return [tel.strip() for tel in config.get('WISE', 'TELESCOPES').split(',')]
+
+
+def get_eventname(alertname):
+    """Returns the event name of an alert name, e.g. S191216ap for LVC#S191216ap-2-Initial (a name without '#', e.g.
+    GW, is taken as the event name)"""
+    return alertname.split('#')[-1].split('-')[0]
 
-    eventname = alertname.split('#')[1]
-    eventname = eventname.split('-')[0]
+
+def get_observing_night(log=None):
+    """Returns the start (now, or next sunset if it's daytime) and end (next sunrise) of the observing night"""
+    if log is None:
+        log = logging.getLogger(__name__)
 
     t = Time.now()
     if not is_night(lat=config.getfloat('WISE', 'LAT')*u.deg,
@@ -47,123 +66,243 @@ def process_galaxy_list(galaxies, alertname='GW', ra_event=None, dec_event=None,
                              sun_alt_twilight=config.getfloat('OBSERVING', 'SUN_ALT_MAX')*u.deg)
     log.debug("Now/sunset = {}, sunrise = {}".format(t, t_sunrise))
 
-    telescopes = config.get('WISE', 'TELESCOPES').split(',')
+    return t, t_sunrise
+
+
+def is_observable_at_wise(ra, dec, telescope, t1, t2):
+    """Are the targets observable by the telescope between t1 and t2? Returns boolean mask, and the airmass,
+    hour angle and lunar distance arrays"""
+    return is_observable_in_interval_grid(ra=ra, dec=dec, lat=config.getfloat('WISE', 'LAT')*u.deg,
+                                          lon=config.getfloat('WISE', 'LON')*u.deg,
+                                          alt=config.getfloat('WISE', 'ALT')*u.m,
+                                          t1=t1, t2=t2,
+                                          ha_min=config.getfloat(telescope, 'HOURANGLE_MIN')*u.hourangle,
+                                          ha_max=config.getfloat(telescope, 'HOURANGLE_MAX')*u.hourangle,
+                                          airmass_min=config.getfloat(telescope, 'AIRMASS_MIN'),
+                                          airmass_max=config.getfloat(telescope, 'AIRMASS_MAX'),
+                                          min_lunar_distance=config.getfloat(telescope, 'MIN_LUNAR_DIST')*u.deg,
+                                          return_values=True)
+
+
+def is_visible_at_wise(ra, dec, t1, t2, telescopes=None):
+    """Cheap analytic pre-filter: could the targets [deg] be observed by any of the telescopes between t1 and t2?
+    Returns a boolean mask (see is_visible_in_interval)"""
+    if telescopes is None:
+        telescopes = get_telescopes()
+
+    visible = np.zeros(np.shape(ra), dtype=bool)
+    for telescope in telescopes:
+        visible |= is_visible_in_interval(ra=ra*u.deg, dec=dec*u.deg, lat=config.getfloat('WISE', 'LAT')*u.deg,
+                                          lon=config.getfloat('WISE', 'LON')*u.deg,
+                                          t1=t1, t2=t2,
+                                          ha_min=config.getfloat(telescope, 'HOURANGLE_MIN')*u.hourangle,
+                                          ha_max=config.getfloat(telescope, 'HOURANGLE_MAX')*u.hourangle,
+                                          airmass_max=config.getfloat(telescope, 'AIRMASS_MAX'))
+    return visible
+
+
+def deliver_plan(targets, telescope, alertname, eventname, details="", log=None, pending=None):
+    """Write the observing plan, send it by email and upload it (in the background) to the telescope's remote
+    Scheduler. The upload is appended to the alert's pending uploads (see upload.wait_uploads).
+    If there is nothing to observe in progressive mode, an empty plan is uploaded instead, to withdraw the quick plan
+    (see process_quick_plan)."""
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    if len(targets) == 0:
+        log.info("Nothing to observe.")
+        send_mail(subject=f"[GW@Wise] {eventname} {telescope} observing plan",
+                  text=f"Nothing to observe for alert {alertname}.{details}")
+        if not is_progressive():
+            return
+        # the plan written with the same alert name replaces the quick plan on the Scheduler
+        log.info(f"Withdrawing the quick plan of alert {alertname}.")
+        filenames = write_plan(targets, telescope, alertname)
+    else:
+        filenames = write_plan(targets, telescope, alertname)
+        metrics.inc("wisegcn_targets_planned_total", len(targets), telescope=telescope)
+
+        log.info(f"Created observing plan for alert {alertname}.")
+        send_mail(subject=f"[GW@Wise] {eventname} {telescope} observing plan",
+                  text=f"{telescope} observing plan for alert {alertname}.{details}",
+                  files=list(filenames.values()))
+
+    upload_plan(filenames, telescope, log, pending)
+
+
+def upload_plan(filenames, telescope, log=None, pending=None):
+    """Uploads (in the background) a written plan (see plan_output.write_plan) to the telescope's remote Scheduler,
+    if an RTML plan was written and the telescope has a host. The upload is appended to pending (see
+    upload.wait_uploads)."""
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    # upload to remote Scheduler
+    if "rtml" not in filenames:
+        log.info("No RTML plan was written, skipping plan upload.")
+    elif not config.get(telescope, 'HOST'):
+        log.info("No host name was provided, skipping plan upload.")
+    else:
+        submit_upload(filenames["rtml"], telescope, log, pending)
+
+
+def withdraw_quick_plan(alertname, log=None):
+    """Replaces the quick plans (see process_quick_plan) on all the telescopes with empty plans, e.g. when there are no
+    galaxies to observe after all"""
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    log.info(f"Withdrawing the quick plan of alert {alertname}.")
+    targets = Table({"name": np.array([], dtype=str), "ra": [], "dec": [], "priority": np.array([], dtype=int),
+                     "Index": np.array([], dtype=int), "Probability": []},
+                    meta={"kind": "Tile", "columns": ["Index", "RA", "Dec", "Probability"]})
+    pending = []
+    for telescope in get_telescopes():
+        upload_plan(write_plan(targets, telescope, alertname), telescope, log, pending)
+    wait_uploads(pending)
+
+
+def record_plan_latency(phase, latency, log=None):
+    """Records the latency [s] from the alert to a plan phase (quick or full) against the latency budget"""
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    budget = float(_progressive('BUDGET', '60'))
+    metrics.observe("wisegcn_plan_latency_seconds", latency, phase=phase)
+    if latency > budget:
+        metrics.inc("wisegcn_latency_budget_exceeded_total", phase=phase)
+        log.warning(f"The {phase} plan was ready {latency:.1f} s after the alert, over the {budget:.0f} s budget.")
+    else:
+        log.info(f"The {phase} plan was ready {latency:.1f} s after the alert (budget {budget:.0f} s).")
+
+
+def process_quick_plan(skymap_path, alertname='GW', started=None, log=None):
+    """
+    Progressive planning, first phase: plans the most probable pixels of a coarse sky map that are visible (analytic
+    check, see is_visible_at_wise), and uploads the plans right away, without emails. The full plan, written with the
+    same alert name, replaces it when ready.
+
+    :param skymap_path: path to skymap FITS file
+    :param alertname: alert name
+    :param started: time.perf_counter() at the alert arrival, for the latency budget (default: now)
+    :param log: logger
+    :return: number of planned targets
+    """
+    if log is None:
+        log = logging.getLogger(__name__)
+    if started is None:
+        started = time.perf_counter()
+
+    n_targets = int(_progressive('TARGETS', '20'))  # maximal number of targets per telescope
+    nside = int(_progressive('NSIDE', '64'))
+
+    t, t_sunrise = get_observing_night(log)
+    telescopes = get_telescopes()
+
+    prob = load_skymap(skymap_path, fields=("prob",), nside=nside)["prob"]
+    # the most probable pixels, enough for all the telescopes even if most of them are not visible
+    m = min(len(prob), 10 * n_targets * len(telescopes))
+    top = np.argpartition(prob, len(prob) - m)[len(prob) - m:]
+    top = top[np.argsort(prob[top], kind="stable")[::-1]]
+    theta, phi = hp.pix2ang(nside, top)
+    ra = np.rad2deg(phi)
+    dec = 90 - np.rad2deg(theta)
+
+    n_planned = 0
+    pending = []  # not waited for: the full plan follows
+    for tel in range(0, len(telescopes)):
+        candidates = np.arange(tel, len(top), len(telescopes))
+        visible = is_visible_at_wise(ra[candidates], dec[candidates], t, t_sunrise, telescopes=[telescopes[tel]])
+        idx = candidates[visible][:n_targets]
+        if len(idx) == 0:
+            log.info(f"Nothing to observe in the quick plan for the {telescopes[tel]}.")
+            continue
+
+        targets = Table({"name": ["Tile_Q{:.0f}".format(i + 1) for i in idx],
+                         "ra": ra[idx],
+                         "dec": dec[idx],
+                         "priority": len(idx) - np.arange(len(idx)),
+                         "Index": idx + 1,
+                         "Probability": prob[top[idx]]},
+                        meta={"kind": "Tile", "columns": ["Index", "RA", "Dec", "Probability"]})
+        filenames = write_plan(targets, telescopes[tel], alertname)
+        n_planned += len(idx)
+        log.info(f"Created a quick plan of {len(idx)} targets for the {telescopes[tel]}.")
+
+        upload_plan(filenames, telescopes[tel], log, pending)
+
+    record_plan_latency("quick", time.perf_counter() - started, log)
+    return n_planned
+
+
+def process_galaxy_list(galaxies, alertname='GW', ra_event=None, dec_event=None, log=None):
+    """Get the full galaxy list, and find which are good to observe at Wise"""
+
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    log.info("Event most probable RA={}, Dec={}.".format(
+        ra_event.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
+        dec_event.to_string(sep=':', precision=2, alwayssign=True, pad=True)))
+    details = "\nEvent most probable at RA={}, Dec={}.".format(
+        ra_event.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
+        dec_event.to_string(sep=':', precision=2, alwayssign=True, pad=True))
+
+    eventname = get_eventname(alertname)
+
+    t, t_sunrise = get_observing_night(log)
+
+    telescopes = get_telescopes()
     max_galaxies = config.getint('GALAXIES', 'MAXGALAXIESPLAN')  # maximal number of galaxies to use in observation plan
 
     # change IERS table URL (to fix URL timeout problems)
     change_iers_url(url=config.get('IERS', 'URL'))
 
-    nothing_to_observe = True
+    pending = []  # this alert's uploads
     for tel in range(0, len(telescopes)):
         log.info("Writing a plan for the {}".format(telescopes[tel]))
-        root = rtml.init(name=config.get('OBSERVING', 'USER'),
-                         email=config.get('OBSERVING', 'EMAIL'))
-
-        log.debug("Index\tGladeID\tRA\t\tDec\t\tAirmass\tHA\tLunarDist\tDist\tBmag\tScore\t\tDist factor")
-
-        csv_filename = f"{telescopes[tel]}_GalaxyList.csv"
-        fid = open(csv_filename, "w")
-        fid.write("Index,GladeID,RA,Dec,Airmass,HA,LunarDist,Dist,Bmag,Score,Dist factor\n")
-
-        n_galaxies_in_plan = 0
-        for i in range(tel, galaxies.shape[0], len(telescopes)):
-
-            ra = Angle(galaxies[i, 1] * u.deg)
-            dec = Angle(galaxies[i, 2] * u.deg)
-            is_observe, airmass, ha, lunar_dist = is_observable_in_interval(ra=ra, dec=dec, lat=config.getfloat('WISE', 'LAT')*u.deg,
-                                                    lon=config.getfloat('WISE', 'LON')*u.deg,
-                                                    alt=config.getfloat('WISE', 'ALT')*u.m,
-                                                    t1=t, t2=t_sunrise,
-                                                    ha_min=config.getfloat(telescopes[tel], 'HOURANGLE_MIN')*u.hourangle,
-                                                    ha_max=config.getfloat(telescopes[tel], 'HOURANGLE_MAX')*u.hourangle,
-                                                    airmass_min=config.getfloat(telescopes[tel], 'AIRMASS_MIN'),
-                                                    airmass_max=config.getfloat(telescopes[tel], 'AIRMASS_MAX'),
-                                                    min_lunar_distance=config.getfloat(telescopes[tel], 'MIN_LUNAR_DIST')*u.deg,
-                                                    return_values=True)
-
-            if is_observe:
-                nothing_to_observe = False
-                n_galaxies_in_plan += 1
-                log.debug(
-                    "{}:\t{:.0f}\t{}\t{}\t{:+.2f}\t{:+.2f}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.6g}\t\t{:.2f}\t\tadded to plan!".format(
-                        i + 1, galaxies[i, 0],
-                        ra.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
-                        dec.to_string(sep=':', precision=2, alwayssign=True, pad=True),
-                        airmass, ha, lunar_dist, galaxies[i, 3], galaxies[i, 4], galaxies[i, 5], galaxies[i, 6]))
-                fid.write("{},{:.0f},{},{},{:+.2f},{:+.2f},{:.2f},{:.2f},{:.2f},{:.6g},{:.2f}\n".format(
-                        i + 1, galaxies[i, 0],
-                        ra.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
-                        dec.to_string(sep=':', precision=2, alwayssign=True, pad=True),
-                        airmass, ha, lunar_dist, galaxies[i, 3], galaxies[i, 4], galaxies[i, 5], galaxies[i, 6]))
-
-                root = rtml.add_request(root,
-                                        request_id="GladeID_{:.0f}".format(galaxies[i, 0]),
-                                        bestefforts=config.get('OBSERVING', 'BESTEFFORTS'),
-                                        user=config.get('OBSERVING', 'USER'),
-                                        description=config.get('OBSERVING', 'DESCRIPTION'),
-                                        project=alertname,
-                                        airmass_min=config.get(telescopes[tel], 'AIRMASS_MIN'),
-                                        airmass_max=config.get(telescopes[tel], 'AIRMASS_MAX'),
-                                        hourangle_min=config.get(telescopes[tel], 'HOURANGLE_MIN'),
-                                        hourangle_max=config.get(telescopes[tel], 'HOURANGLE_MAX'),
-                                        priority=str(min(max_galaxies, galaxies.shape[0])-n_galaxies_in_plan+1))
-
-                rtml.add_target(root,
-                                request_id="GladeID_{:.0f}".format(galaxies[i, 0]),
-                                ra=ra.to_string(unit=u.degree, decimal=True),
-                                dec=dec.to_string(unit=u.degree, decimal=True, alwayssign=True),
-                                name="GladeID_{:.0f}".format(galaxies[i, 0]))
-
-                rtml.add_picture(root,
-                                 filt=config.get(telescopes[tel], 'FILTER'),
-                                 target_name="GladeID_{:.0f}".format(galaxies[i, 0]),
-                                 exptime=config.get(telescopes[tel], 'EXPTIME'),
-                                 binning=config.get(telescopes[tel], 'BINNING'))
-            else:
-                log.debug(
-                    "{}:\t{:.0f}\t{}\t{}\t{:+.2f}\t{:+.2f}\t{:+.2f}\t{:.2f}\t{:.2f}\t{:.6g}\t\t{:.2f}".format(
-                        i + 1, galaxies[i, 0],
-                        ra.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
-                        dec.to_string(sep=':', precision=2, alwayssign=True, pad=True),
-                        airmass, ha, lunar_dist, galaxies[i, 3], galaxies[i, 4], galaxies[i, 5], galaxies[i, 6]))
-
-            if n_galaxies_in_plan >= max_galaxies:
-                # maximal number of galaxies per plan has been reached
-                break
-
-        if nothing_to_observe:
-            log.info("Nothing to observe.")
-            send_mail(subject=f"[GW@Wise] {eventname} {telescopes[tel]} observing plan",
-                      text="Nothing to observe for alert {}.\nEvent most probable at RA={}, Dec={}."
-                      .format(alertname,
-                              ra_event.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
-                              dec_event.to_string(sep=':', precision=2, alwayssign=True, pad=True)))
-
-        else:
-            rtml_filename = config.get('WISE', 'PATH') + alertname + '_' + telescopes[tel] + '.xml'
-            rtml.write(root, rtml_filename)
-
-            fid.close()
-
-            log.info(f"Created observing plan for alert {alertname}.")
-            send_mail(subject=f"[GW@Wise] {eventname} {telescopes[tel]} observing plan",
-                      text="{} observing plan for alert {}.\nEvent most probable at RA={}, Dec={}."
-                      .format(telescopes[tel], alertname,
-                              ra_event.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
-                              dec_event.to_string(sep=':', precision=2, alwayssign=True, pad=True)),
-                      files=[rtml_filename, csv_filename])
-
-            # upload to remote Scheduler
-            if not config.get(telescopes[tel], 'HOST'):
-                log.info("No host name was provided, skipping plan upload.")
-            else:
-                result = rtml.import_to_remote_scheduler(rtml_filename,
-                                                         username=config.get(telescopes[tel], 'USER'),
-                                                         remote_host=config.get(telescopes[tel], 'HOST'),
-                                                         remote_path=config.get(telescopes[tel], 'PATH'),
-                                                         cygwin_path=config.get(telescopes[tel], 'CYGWIN_PATH'))
-                log.info(result)
 
+        # check all the telescope's galaxies at once
+        candidates = np.arange(tel, galaxies.shape[0], len(telescopes))
+        is_observe, airmass, ha, lunar_dist = is_observable_at_wise(galaxies[candidates, 1]*u.deg,
+                                                                    galaxies[candidates, 2]*u.deg,
+                                                                    telescopes[tel], t, t_sunrise)
+        airmass = np.asarray(airmass, dtype=float)
+        # maximal number of galaxies per plan
+        selected = np.flatnonzero(is_observe)[:max_galaxies]
+        n_checked = selected[-1] + 1 if len(selected) >= max_galaxies else len(candidates)
+
+        # the checked galaxies, up to the last one added to the plan
+        checked = candidates[:n_checked]
+        dump_table(log, f"{telescopes[tel]}_galaxies",
+                   {"Index": checked + 1, "GladeID": galaxies[checked, 0], "RA": galaxies[checked, 1],
+                    "Dec": galaxies[checked, 2], "Airmass": airmass[:n_checked], "HA": ha[:n_checked],
+                    "LunarDist": lunar_dist[:n_checked], "Dist": galaxies[checked, 3],
+                    "Bmag": galaxies[checked, 4], "Score": galaxies[checked, 5],
+                    "Dist factor": galaxies[checked, 6], "added": is_observe[:n_checked]})
+
+        idx = candidates[selected]
+        values = np.column_stack((airmass[selected], ha[selected], lunar_dist[selected]))
+        targets = Table({"name": ["GladeID_{:.0f}".format(glade_id) for glade_id in galaxies[idx, 0]],
+                         "ra": galaxies[idx, 1],
+                         "dec": galaxies[idx, 2],
+                         "priority": min(max_galaxies, galaxies.shape[0]) - np.arange(len(idx)),
+                         "Index": idx + 1,
+                         "GladeID": galaxies[idx, 0],
+                         "Airmass": values[:, 0],
+                         "HA": values[:, 1],
+                         "LunarDist": values[:, 2],
+                         "Dist": galaxies[idx, 3],
+                         "Bmag": galaxies[idx, 4],
+                         "Score": galaxies[idx, 5],
+                         "Dist factor": galaxies[idx, 6]},
+                        meta={"kind": "Galaxy",
+                              "columns": ["Index", "GladeID", "RA", "Dec", "Airmass", "HA", "LunarDist", "Dist",
+                                          "Bmag", "Score", "Dist factor"]})
+
+        deliver_plan(targets, telescopes[tel], alertname, eventname, details, log, pending)
+
+    wait_uploads(pending)
     return
 
 
@@ -171,136 +310,44 @@ def process_tiles(skymap_path, alertname='GW', log=None):
     if log is None:
         log = logging.getLogger(__name__)
 
-    eventname = alertname.split('#')[1]
-    eventname = eventname.split('-')[0]
-
-    t = Time.now()
-    if not is_night(lat=config.getfloat('WISE', 'LAT')*u.deg,
-                    lon=config.getfloat('WISE', 'LON')*u.deg,
-                    alt=config.getfloat('WISE', 'ALT')*u.m,
-                    t=t,
-                    sun_alt_twilight=config.getfloat('OBSERVING', 'SUN_ALT_MAX')*u.deg):
-        log.info("Daytime at Wise! Preparing a plan for next sunset.")
-        t = next_sunset(lat=config.getfloat('WISE', 'LAT')*u.deg,
-                        lon=config.getfloat('WISE', 'LON')*u.deg,
-                        alt=config.getfloat('WISE', 'ALT')*u.m,
-                        t=t,
-                        sun_alt_twilight=config.getfloat('OBSERVING', 'SUN_ALT_MAX')*u.deg)
-    else:
-        log.info("It's nighttime at Wise! Preparing a plan for NOW.")
+    eventname = get_eventname(alertname)
 
-    t_sunrise = next_sunrise(lat=config.getfloat('WISE', 'LAT')*u.deg,
-                             lon=config.getfloat('WISE', 'LON')*u.deg,
-                             alt=config.getfloat('WISE', 'ALT')*u.m,
-                             t=t,
-                             sun_alt_twilight=config.getfloat('OBSERVING', 'SUN_ALT_MAX')*u.deg)
-    log.debug("Now/sunset = {}, sunrise = {}".format(t, t_sunrise))
+    t, t_sunrise = get_observing_night(log)
 
-    telescopes = config.get('WISE', 'TELESCOPES').split(', ')
+    telescopes = get_telescopes()
 
     # change IERS table URL (to fix URL timeout problems)
     change_iers_url(url=config.get('IERS', 'URL'))
 
-    nothing_to_observe = True
+    pending = []  # this alert's uploads
     for tel in range(0, len(telescopes)):
         log.info("Writing a plan for the {}".format(telescopes[tel]))
-        root = rtml.init(name=config.get('OBSERVING', 'USER'),
-                         email=config.get('OBSERVING', 'EMAIL'))
 
         # Tile the credible region
         ra, dec, probability = tile.tile_region(skymap_path, credzone=config.getfloat("TILE", "CREDZONE"),
                                                 tile_area=config.getfloat("TILE", "SIZE")*config.getfloat(telescopes[tel], "FOV"), log=log)
-
-        log.debug("Index\tRA\t\tDec\tAirmass\tHA\tLunarDist\tProbability")
-
-        csv_filename = f"{telescopes[tel]}_TileList.csv"
-        fid = open(csv_filename, "w")
-        fid.write("Index,RA,Dec,Airmass,HA,LunarDist,Probability\n")
-
-        for i in range(len(ra)):
-            is_observe, airmass, ha, lunar_dist = is_observable_in_interval(
-                                                    ra=ra[i], dec=dec[i], lat=config.getfloat('WISE', 'LAT')*u.deg,
-                                                    lon=config.getfloat('WISE', 'LON')*u.deg,
-                                                    alt=config.getfloat('WISE', 'ALT')*u.m,
-                                                    t1=t, t2=t_sunrise,
-                                                    ha_min=config.getfloat(telescopes[tel], 'HOURANGLE_MIN')*u.hourangle,
-                                                    ha_max=config.getfloat(telescopes[tel], 'HOURANGLE_MAX')*u.hourangle,
-                                                    airmass_min=config.getfloat(telescopes[tel], 'AIRMASS_MIN'),
-                                                    airmass_max=config.getfloat(telescopes[tel], 'AIRMASS_MAX'),
-                                                    min_lunar_distance=config.getfloat(telescopes[tel], 'MIN_LUNAR_DIST')*u.deg,
-                                                    return_values=True)
-
-            if is_observe:
-                nothing_to_observe = False
-                log.debug(
-                    "{}:\t{}\t{}\t{:+.2f}\t{:+.2f}\t{:.2f}\t{:.6g}\t\tadded to plan!".format(
-                        i + 1,
-                        ra[i].to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
-                        dec[i].to_string(sep=':', precision=2, alwayssign=True, pad=True),
-                        airmass, ha, lunar_dist, probability[i]))
-                fid.write("{},{},{},{:+.2f},{:+.2f},{:.2f},{:.6g}\n".format(
-                        i + 1,
-                        ra[i].to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
-                        dec[i].to_string(sep=':', precision=2, alwayssign=True, pad=True),
-                        airmass, ha, lunar_dist, probability[i]))
-
-                root = rtml.add_request(root,
-                                        request_id="Tile_{:.0f}".format(i+1),
-                                        bestefforts=config.get('OBSERVING', 'BESTEFFORTS'),
-                                        user=config.get('OBSERVING', 'USER'),
-                                        description=config.get('OBSERVING', 'DESCRIPTION'),
-                                        project=alertname,
-                                        airmass_min=config.get(telescopes[tel], 'AIRMASS_MIN'),
-                                        airmass_max=config.get(telescopes[tel], 'AIRMASS_MAX'),
-                                        hourangle_min=config.get(telescopes[tel], 'HOURANGLE_MIN'),
-                                        hourangle_max=config.get(telescopes[tel], 'HOURANGLE_MAX'),
-                                        priority=str(len(ra)-i))
-
-                rtml.add_target(root,
-                                request_id="Tile_{:.0f}".format(i+1),
-                                ra=ra[i].to_string(unit=u.degree, decimal=True),
-                                dec=dec[i].to_string(unit=u.degree, decimal=True, alwayssign=True),
-                                name="Tile_{:.0f}".format(i+1))
-
-                rtml.add_picture(root,
-                                 filt=config.get(telescopes[tel], 'FILTER'),
-                                 target_name="Tile_{:.0f}".format(i+1),
-                                 exptime=config.get(telescopes[tel], 'EXPTIME'),
-                                 binning=config.get(telescopes[tel], 'BINNING'))
-            else:
-                log.debug(
-                    "{}:\t{}\t{}\t{:+.2f}\t{:+.2f}\t{:+.2f}\t{:.6g}".format(
-                        i + 1,
-                        ra.to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
-                        dec.to_string(sep=':', precision=2, alwayssign=True, pad=True),
-                        airmass, ha, lunar_dist, probability[i]))
-
-        if nothing_to_observe:
-            log.info("Nothing to observe.")
-            send_mail(subject=f"[GW@Wise] {eventname} {telescopes[tel]} observing plan",
-                      text=f"Nothing to observe for alert {alertname}.")
-
-        else:
-            rtml_filename = config.get('WISE', 'PATH') + alertname + '_' + telescopes[tel] + '.xml'
-            rtml.write(root, rtml_filename)
-
-            fid.close()
-
-            log.info(f"Created observing plan for alert {alertname}.")
-            send_mail(subject=f"[GW@Wise] {eventname} {telescopes[tel]} observing plan",
-                      text="{} observing plan for alert {}."
-                      .format(telescopes[tel], alertname),
-                      files=[rtml_filename, csv_filename])
-
-            # upload to remote Scheduler
-            if not config.get(telescopes[tel], 'HOST'):
-                log.info("No host name was provided, skipping plan upload.")
-            else:
-                result = rtml.import_to_remote_scheduler(rtml_filename,
-                                                         username=config.get(telescopes[tel], 'USER'),
-                                                         remote_host=config.get(telescopes[tel], 'HOST'),
-                                                         remote_path=config.get(telescopes[tel], 'PATH'),
-                                                         cygwin_path=config.get(telescopes[tel], 'CYGWIN_PATH'))
-                log.info(result)
-
+        is_observe, airmass, ha, lunar_dist = is_observable_at_wise(ra, dec, telescopes[tel], t, t_sunrise)
+        airmass = np.asarray(airmass, dtype=float)
+
+        dump_table(log, f"{telescopes[tel]}_tiles",
+                   {"Index": np.arange(1, len(ra) + 1), "RA": ra.deg, "Dec": dec.deg, "Airmass": airmass,
+                    "HA": ha, "LunarDist": lunar_dist, "Probability": probability, "added": is_observe})
+
+        idx = np.flatnonzero(is_observe)
+        values = np.column_stack((airmass[idx], ha[idx], lunar_dist[idx]))
+        targets = Table({"name": ["Tile_{:.0f}".format(i + 1) for i in idx],
+                         "ra": ra.deg[idx],
+                         "dec": dec.deg[idx],
+                         "priority": len(ra) - idx,
+                         "Index": idx + 1,
+                         "Airmass": values[:, 0],
+                         "HA": values[:, 1],
+                         "LunarDist": values[:, 2],
+                         "Probability": probability[idx]},
+                        meta={"kind": "Tile",
+                              "columns": ["Index", "RA", "Dec", "Airmass", "HA", "LunarDist", "Probability"]})
+
+        deliver_plan(targets, telescopes[tel], alertname, eventname, log=log, pending=pending)
+
+    wait_uploads(pending)
     return
@@ -0,0 +1,177 @@
+import multiprocessing
+import multiprocessing.context
+import multiprocessing.util
+import signal
+import logging
+import lxml.etree
+import gcn
+from wisegcn import metrics
+from configparser import ConfigParser
+
+config = ConfigParser(inline_comment_prefixes=';')
+config.read("config.ini")
+
+_pool = None
+
+
+class _AlertProcess(multiprocessing.context.ForkProcess):
+    """Alert worker process, not daemonic, so it can fork its own galaxy scoring pool (see galaxy_list.get_scoring_pool).
+    The workers are still stopped with the pool (see close_pool)."""
+
+    @property
+    def daemon(self):
+        return False
+
+    @daemon.setter
+    def daemon(self, value):
+        pass
+
+
+class _AlertContext(type(multiprocessing.get_context("fork"))):
+    Process = _AlertProcess
+
+
+def _fork_scoring_pool():
+    # fork the galaxy scoring pool now, after the catalog was memory-mapped, rather than on the first alert
+    nproc = config.getint('GALAXIES', 'NPROC') if config.has_option('GALAXIES', 'NPROC') else 1
+    if nproc > 1:
+        from wisegcn.galaxy_list import get_scoring_pool
+        get_scoring_pool(nproc)
+
+
+def warm_up(log=None):
+    """Import the heavy stacks, memory-map the galaxy catalog and load the ephemerides in the current process"""
+    if log is None:
+        log = logging.getLogger(__name__)
+
+    import healpy as hp
+    import scipy.stats  # noqa: F401
+    import scipy.special  # noqa: F401
+    from astropy import units as u
+    from astropy.time import Time
+    from wisegcn import handler  # noqa: F401
+    from wisegcn.catalog import load_catalog
+    from wisegcn.observing_tools import change_iers_url, is_night, lunar_distance, local_sidereal_time
+    from wisegcn.rules import get_rules
+
+    log.info("Warming up: loading the galaxy catalog...")
+    try:
+        cat = load_catalog()
+        log.info(f"Galaxy catalog memory-mapped ({cat.shape[0]} entries).")
+    except OSError as e:
+        log.warning(f"Failed to load the galaxy catalog: {e}")
+
+    hp.ang2pix(1, 0.5, 0.5)
+
+    # compile the alert filtering rules once, for all the workers
+    get_rules()
+
+    log.info("Warming up: loading IERS tables and ephemerides...")
+    change_iers_url(url=config.get('IERS', 'URL'))
+    lat = config.getfloat('WISE', 'LAT')*u.deg
+    lon = config.getfloat('WISE', 'LON')*u.deg
+    alt = config.getfloat('WISE', 'ALT')*u.m
+    t = Time.now()
+    try:
+        is_night(lat=lat, lon=lon, alt=alt, t=t)
+        lunar_distance(0*u.deg, 0*u.deg, lat=lat, lon=lon, alt=alt, t=t)
+        # tonight's LST table, inherited by the workers
+        local_sidereal_time(lon, t)
+    except Exception as e:
+        log.warning(f"Failed to load the ephemerides: {e}")
+
+
+def _init_worker():
+    from wisegcn.email_alert import flush_mail
+    # let the listener handle Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # pool workers skip atexit: deliver the worker's queued emails when the pool is closed (see close_pool)
+    multiprocessing.util.Finalize(None, flush_mail, exitpriority=10)
+    _fork_scoring_pool()
+
+
+def _run(payload):
+    from wisegcn.handler import process_gcn
+    root = lxml.etree.fromstring(payload)
+    process_gcn(payload, root)
+
+
+def _run_alert(payload, params):
+    from wisegcn.handler import process_alert
+    process_alert(payload, params)
+
+
+def _report_error(e):
+    metrics.inc("wisegcn_queue_depth", -1, queue="workers")
+    logging.getLogger(__name__).error(f"Worker failed to process alert: {e!r}")
+
+
+def _report_done(result):
+    metrics.inc("wisegcn_queue_depth", -1, queue="workers")
+
+
+def init_pool(processes=None, log=None):
+    """
+    Warm up the current process and fork a pool of hot workers.
+    The workers inherit the loaded modules, the memory-mapped catalog and the ephemerides (copy-on-write). With
+    GALAXIES/NPROC > 1, every worker (or this process, without workers) forks its galaxy scoring pool.
+
+    :param processes: number of worker processes (default: WORKERS/N in config.ini)
+    :param log: logger
+    :return: worker pool
+    """
+    global _pool
+
+    if processes is None:
+        processes = config.getint('WORKERS', 'N') if config.has_option('WORKERS', 'N') else 0
+
+    warm_up(log)
+
+    if processes > 0:
+        _pool = _AlertContext().Pool(processes=processes, initializer=_init_worker)
+    else:
+        # the alerts are processed here
+        _fork_scoring_pool()
+
+    return _pool
+
+
+def close_pool():
+    global _pool
+    from wisegcn.galaxy_list import close_scoring_pool
+    close_scoring_pool()
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+
+def dispatch_gcn(payload, root):
+    """Hand over the notice to a hot worker (or process it here, if there is no pool)"""
+    from wisegcn.handler import process_gcn, LVC_NOTICE_TYPES
+
+    # filter here, so only relevant notices reach the workers
+    notice_type = gcn.handlers.get_notice_type(root)
+    metrics.inc("wisegcn_notices_received_total", type=notice_type)
+    if notice_type not in LVC_NOTICE_TYPES:
+        metrics.inc("wisegcn_notices_filtered_total", reason="notice_type")
+        return
+
+    if _pool is None:
+        process_gcn(payload, root)
+        return
+
+    metrics.inc("wisegcn_queue_depth", queue="workers")
+    _pool.apply_async(_run, (payload,), callback=_report_done, error_callback=_report_error)
+
+
+def dispatch_alert(payload, params):
+    """Hand over an already parsed and filtered notice to a hot worker (or process it here, if there is no pool)"""
+    from wisegcn.handler import process_alert
+
+    if _pool is None:
+        process_alert(payload, params)
+        return
+
+    metrics.inc("wisegcn_queue_depth", queue="workers")
+    _pool.apply_async(_run_alert, (payload, params), callback=_report_done, error_callback=_report_error)